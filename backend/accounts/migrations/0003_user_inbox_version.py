@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-18 04:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0002_alter_user_profile_picture'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='inbox_version',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.7 on 2026-10-18 05:44
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0003_user_inbox_version'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='user',
+            name='inbox_version',
+        ),
+    ]
@@ -66,6 +66,14 @@ class UserUpdateSerializer(serializers.ModelSerializer):
         model = User
         fields = ('first_name', 'last_name', 'bio', 'profile_picture')
 
+    def update(self, instance, validated_data):
+        for attr, value in validated_data.items():
+            setattr(instance, attr, value)
+        # The instance was loaded at authentication: writing every column back
+        # would undo presence changes made since
+        instance.save(update_fields=[*validated_data, 'updated_at'])
+        return instance
+
 
 class UserListSerializer(serializers.ModelSerializer):
     full_name = serializers.ReadOnlyField()
@@ -76,3 +84,14 @@ class UserListSerializer(serializers.ModelSerializer):
             'id', 'email', 'username', 'first_name', 'last_name', 'full_name',
             'bio', 'profile_picture', 'is_online', 'last_seen'
         )
+
+
+class ContactSerializer(UserListSerializer):
+    """
+    A user as embedded in room payloads. Presence is left out: those payloads
+    are cached by inbox version, which presence changes do not bump, and
+    clients track presence live instead.
+    """
+
+    class Meta(UserListSerializer.Meta):
+        fields = tuple(f for f in UserListSerializer.Meta.fields if f not in ('is_online', 'last_seen'))
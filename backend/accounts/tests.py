@@ -0,0 +1,64 @@
+"""
+Query budgets for the accounts endpoints.
+
+The profile and lookup endpoints must cost the same number of statements
+whether the users table holds a handful of rows or thousands.
+"""
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APITestCase
+from rest_framework_simplejwt.tokens import AccessToken
+
+from accounts.models import User
+from chat.tests.factories import make_users
+
+
+class AccountsQueryBudgetTests(APITestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = make_users(1, 'owner')[0]
+        cls.target = make_users(1, 'target')[0]
+
+    def count_queries(self, method, path, data=None):
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(self.user)}')
+        with CaptureQueriesContext(connection) as ctx:
+            response = getattr(self.client, method)(path, data, format='json')
+        self.assertLess(response.status_code, 400, response.content[:500])
+        return len(ctx.captured_queries)
+
+    def measure_at_scales(self, method, path, data=None):
+        counts = {'small': self.count_queries(method, path, data)}
+        make_users(2000, 'filler')
+        counts['2000 users'] = self.count_queries(method, path, data)
+        self.assertEqual(len(set(counts.values())), 1, f'query count depends on data size: {counts}')
+        return counts['small']
+
+    def test_profile(self):
+        # auth only; the profile is the authenticated user
+        self.assertLessEqual(self.measure_at_scales('get', '/api/auth/profile/'), 1)
+
+    def test_user_lookup(self):
+        for params in ({'user_id': self.target.id}, {'username': self.target.username},
+                       {'email': self.target.email}):
+            with self.subTest(params=params):
+                self.assertLessEqual(self.count_queries('get', '/api/auth/users/lookup/', params), 2)
+        self.assertLessEqual(
+            self.measure_at_scales('get', '/api/auth/users/lookup/', {'username': self.target.username}), 2
+        )
+
+
+class ProfileUpdateTests(APITestCase):
+
+    def test_profile_update_keeps_concurrent_presence_changes(self):
+        user = make_users(1, 'owner')[0]
+        self.client.force_authenticate(user)
+        # The user's socket connects after the request authenticated with ``user``
+        User.objects.filter(id=user.id).update(is_online=True)
+
+        response = self.client.patch('/api/auth/profile/', {'bio': 'Hello'}, format='json')
+
+        self.assertEqual(response.status_code, 200)
+        user.refresh_from_db()
+        self.assertEqual(user.bio, 'Hello')
+        self.assertTrue(user.is_online)
@@ -9,6 +9,8 @@ from django.core.mail import send_mail
 from django.utils.http import urlsafe_base64_encode, urlsafe_base64_decode
 from django.utils.encoding import force_bytes, force_str
 from django.contrib.auth.tokens import default_token_generator
+from chat.inbox import bump_contact_inboxes
+from flowchat.metrics import track
 from .models import User
 from .serializers import (
     UserRegistrationSerializer, UserLoginSerializer, 
@@ -55,7 +57,8 @@ class RegisterView(generics.CreateAPIView):
             "If you did not sign up, you can ignore this email."
         )
         try:
-            send_mail(subject, message, settings.DEFAULT_FROM_EMAIL, [user.email], fail_silently=False)
+            with track('email'):
+                send_mail(subject, message, settings.DEFAULT_FROM_EMAIL, [user.email], fail_silently=False)
         except Exception as e:
             logger.error("Failed to send verification email to %s: %s", user.email, e, exc_info=True)
             pass
@@ -109,26 +112,28 @@ def firebase_custom_token(request):
 
         # Ensure Firebase Auth user exists and is populated with email/display name
         display_name = (request.user.first_name + ' ' + request.user.last_name).strip() or request.user.username
-        try:
-            fb_user = fb_auth.get_user(uid)
-            # Update email/display name if missing or changed
-            needs_update = False
-            update_args = {}
-            if request.user.email and fb_user.email != request.user.email:
-                update_args['email'] = request.user.email
-            if display_name and fb_user.display_name != display_name:
-                update_args['display_name'] = display_name
-            if update_args:
-                fb_auth.update_user(uid, **update_args)
-        except fb_auth.UserNotFoundError:
-            fb_auth.create_user(uid=uid, email=request.user.email or None, display_name=display_name or None)
+        with track('firebase'):
+            try:
+                fb_user = fb_auth.get_user(uid)
+                # Update email/display name if missing or changed
+                needs_update = False
+                update_args = {}
+                if request.user.email and fb_user.email != request.user.email:
+                    update_args['email'] = request.user.email
+                if display_name and fb_user.display_name != display_name:
+                    update_args['display_name'] = display_name
+                if update_args:
+                    fb_auth.update_user(uid, **update_args)
+            except fb_auth.UserNotFoundError:
+                fb_auth.create_user(uid=uid, email=request.user.email or None, display_name=display_name or None)
 
         additional_claims = {
             'email': request.user.email,
             'username': request.user.username,
             'provider': 'django',
         }
-        token_bytes = fb_auth.create_custom_token(uid, additional_claims)
+        with track('firebase'):
+            token_bytes = fb_auth.create_custom_token(uid, additional_claims)
         token = token_bytes.decode('utf-8') if isinstance(token_bytes, (bytes, bytearray)) else token_bytes
         return Response({'custom_token': token}, status=status.HTTP_200_OK)
     except Exception as e:
@@ -187,6 +192,13 @@ class ProfileView(generics.RetrieveUpdateAPIView):
             return UserUpdateSerializer
         return UserProfileSerializer
 
+    def perform_update(self, serializer):
+        serializer.save()
+        # Name and picture are shown in other users' room lists
+        bump_contact_inboxes(
+            self.request.user.id, {'event': 'contact_updated', 'user_id': self.request.user.id}
+        )
+
 
 
 
@@ -4,10 +4,15 @@ from .models import ChatRoom, ChatRoomMember, MessageMetadata
 
 @admin.register(ChatRoom)
 class ChatRoomAdmin(admin.ModelAdmin):
-    list_display = ('id', 'name', 'room_type', 'created_by', 'member_count', 'created_at')
+    list_display = ('id', 'name', 'room_type', 'created_by', 'member_count', 'message_count', 'last_activity_at', 'created_at')
     list_filter = ('room_type', 'created_at')
     search_fields = ('name', 'description', 'created_by__email')
-    readonly_fields = ('id', 'created_at', 'updated_at', 'firebase_collection_name')
+    readonly_fields = (
+        'id', 'created_at', 'updated_at', 'firebase_collection_name',
+        'last_message', 'last_message_firebase_id', 'last_message_type', 'last_message_sender',
+        'last_message_preview', 'last_message_at', 'message_count', 'last_activity_at',
+        'dm_user_low', 'dm_user_high',
+    )
     
     def member_count(self, obj):
         return obj.members.count()
@@ -16,8 +21,9 @@ class ChatRoomAdmin(admin.ModelAdmin):
 
 @admin.register(ChatRoomMember)
 class ChatRoomMemberAdmin(admin.ModelAdmin):
-    list_display = ('user', 'room', 'role', 'joined_at', 'last_read_at')
+    list_display = ('user', 'room', 'role', 'joined_at', 'last_read_at', 'unread_count')
     list_filter = ('role', 'joined_at')
+    list_select_related = ('user', 'room')
     search_fields = ('user__email', 'room__name')
 
 
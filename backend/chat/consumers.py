@@ -1,76 +1,147 @@
-import json
+import logging
+import time
+import uuid
+from asgiref.sync import sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
+from django.conf import settings
 from django.contrib.auth import get_user_model
-from .models import ChatRoom, ChatRoomMember
+from django.db import transaction
+from django.utils import timezone
+from redis.exceptions import RedisError
+from flowchat import jsoncodec
+from . import presence, wire, writebehind
+from .inbox import room_group_name, user_group_name
+from .ingest import store_messages
+from .membership import is_member, member_room_ids
+from .models import LAST_MESSAGE_PREVIEW_LENGTH, ChatRoom, MessageMetadata
+from .outbound import OutboundBatcher, OutboundQueue, wants_batches
+from .receipts import watermarks
+from .serializers import MessageMetadataBatchItemSerializer
+from .typing_indicators import TypingThrottle, is_stale
 
 User = get_user_model()
+logger = logging.getLogger(__name__)
 
 
-class ChatConsumer(AsyncWebsocketConsumer):
-    async def connect(self):
-        self.room_id = self.scope['url_route']['kwargs']['room_id']
-        self.room_group_name = f'chat_{self.room_id}'
-        self.user = self.scope['user']
+class EventConsumer(AsyncWebsocketConsumer):
+    """
+    Sends events to the client and reads its messages in the frame encoding
+    negotiated through the WebSocket subprotocol (see chat.wire): compact
+    MessagePack for clients that offer it, JSON text frames otherwise.
+    """
+    frames = wire.JSONFrames()
+    batcher = None
+    outbound = None
 
-        # Check if user is authenticated and is a member of the room
-        if not self.user.is_authenticated:
-            await self.close()
-            return
+    async def accept(self, subprotocol=None):
+        if subprotocol is None:
+            self.frames, subprotocol = wire.negotiate(self.scope.get('subprotocols'))
+        await super().accept(subprotocol)
 
-        is_member = await self.check_room_membership()
-        if not is_member:
-            await self.close()
-            return
+    async def send_event(self, payload):
+        if self.outbound is not None:
+            self.outbound.put(payload)
+        else:
+            await self.deliver_event(payload)
 
-        # Join room group
-        await self.channel_layer.group_add(
-            self.room_group_name,
-            self.channel_name
-        )
+    async def deliver_event(self, payload):
+        if self.batcher is not None:
+            await self.batcher.add(payload)
+        else:
+            await self.send_frame(self.frames.encode(payload))
 
-        await self.accept()
+    async def send_batch(self, payloads):
+        if len(payloads) == 1:
+            await self.send_frame(self.frames.encode(payloads[0]))
+        else:
+            await self.send_frame(self.frames.encode_batch(payloads))
 
-        # Update user online status
-        await self.update_user_status(True)
+    async def send_frame(self, data):
+        if self.frames.binary:
+            await self.send(bytes_data=data)
+        else:
+            await self.send(text_data=data)
 
-    async def disconnect(self, close_code):
-        # Leave room group
-        await self.channel_layer.group_discard(
-            self.room_group_name,
-            self.channel_name
-        )
+    async def read_event(self, text_data=None, bytes_data=None):
+        """The client's message, or None once a malformed frame has been reported."""
+        try:
+            if text_data is not None:
+                return jsoncodec.loads(text_data)
+            return self.frames.decode(bytes_data)
+        except ValueError:
+            await self.send_event({
+                'error': self.frames.error if text_data is None else wire.JSONFrames.error
+            })
+            return None
 
-        # Update user online status
-        if hasattr(self, 'user') and self.user.is_authenticated:
-            await self.update_user_status(False)
 
-    async def receive(self, text_data):
-        try:
-            text_data_json = json.loads(text_data)
-            message_type = text_data_json.get('type', 'chat_message')
-
-            if message_type == 'chat_message':
-                await self.handle_chat_message(text_data_json)
-            elif message_type == 'typing':
-                await self.handle_typing(text_data_json)
-            elif message_type == 'read_receipt':
-                await self.handle_read_receipt(text_data_json)
-
-        except json.JSONDecodeError:
-            await self.send(text_data=json.dumps({
-                'error': 'Invalid JSON'
-            }))
-
-    async def handle_chat_message(self, data):
+class RoomEventsConsumer(EventConsumer):
+    """
+    Client messages and room group events shared by the single-room and the
+    multiplexed chat sockets. Handlers take the room explicitly and every
+    event sent to the client carries its ``room_id``.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.typing = TypingThrottle(self.broadcast_typing)
+
+    async def accept(self, subprotocol=None):
+        await super().accept(subprotocol)
+        # Events are written by a separate task from a bounded queue, so a
+        # slow client can't stall this consumer
+        if settings.WS_OUTBOUND_QUEUE_SIZE > 0:
+            self.outbound = OutboundQueue(self.deliver_event, self.close)
+        # Clients opting in with ?batch=1 get events in array frames
+        if wants_batches(self.scope):
+            self.batcher = OutboundBatcher(self.send_batch)
+
+    def release_outbound(self):
+        if self.outbound is not None:
+            self.outbound.discard(f'user={self.user.id}')
+        if self.batcher is not None:
+            self.batcher.discard()
+
+    async def handle_client_message(self, room_id, data):
+        message_type = data.get('type', 'chat_message')
+
+        if message_type == 'chat_message':
+            await self.handle_chat_message(room_id, data)
+        elif message_type == 'typing':
+            await self.handle_typing(room_id, data)
+        elif message_type == 'read_receipt':
+            await self.handle_read_receipt(room_id, data)
+        elif message_type == 'read_up_to':
+            self.handle_read_up_to(room_id, data)
+        elif message_type == 'heartbeat':
+            await self.heartbeat()
+
+    async def handle_chat_message(self, room_id, data):
         message = data.get('message', '')
         firebase_message_id = data.get('firebase_message_id', '')
 
+        # With write-behind enabled, {"persist": true} records the metadata
+        # here so the client can skip the REST create call
+        if data.get('persist') and writebehind.is_enabled():
+            item = MessageMetadataBatchItemSerializer(data={
+                'room_id': room_id,
+                'firebase_message_id': firebase_message_id,
+                'message_type': data.get('message_type', 'text'),
+                'preview': str(data.get('preview', message))[:LAST_MESSAGE_PREVIEW_LENGTH],
+            })
+            if item.is_valid():
+                fields = item.validated_data
+                await self.persist_message(
+                    room_id, fields['firebase_message_id'], fields['message_type'], fields['preview']
+                )
+
         # Send message to room group
         await self.channel_layer.group_send(
-            self.room_group_name,
+            room_group_name(room_id),
             {
                 'type': 'chat_message',
+                'room_id': room_id,
                 'message': message,
                 'firebase_message_id': firebase_message_id,
                 'sender_id': self.user.id,
@@ -79,76 +150,351 @@ class ChatConsumer(AsyncWebsocketConsumer):
             }
         )
 
-    async def handle_typing(self, data):
-        is_typing = data.get('is_typing', False)
+    async def handle_typing(self, room_id, data):
+        # Throttled: only changes in typing state reach the room group
+        await self.typing.update(room_id, bool(data.get('is_typing', False)))
 
+    async def broadcast_typing(self, room_id, is_typing):
         # Send typing indicator to room group
         await self.channel_layer.group_send(
-            self.room_group_name,
+            room_group_name(room_id),
             {
                 'type': 'typing_indicator',
+                'room_id': room_id,
                 'is_typing': is_typing,
                 'user_id': self.user.id,
-                'user_name': self.user.full_name
+                'user_name': self.user.full_name,
+                'sent_at': time.time(),
+                'expires_in': settings.TYPING_TIMEOUT
             }
         )
 
-    async def handle_read_receipt(self, data):
+    async def handle_read_receipt(self, room_id, data):
         firebase_message_id = data.get('firebase_message_id', '')
 
         # Send read receipt to room group
         await self.channel_layer.group_send(
-            self.room_group_name,
+            room_group_name(room_id),
             {
                 'type': 'read_receipt',
+                'room_id': room_id,
                 'firebase_message_id': firebase_message_id,
                 'user_id': self.user.id,
                 'user_name': self.user.full_name
             }
         )
 
+    def handle_read_up_to(self, room_id, data):
+        firebase_message_id = data.get('firebase_message_id')
+        if not firebase_message_id or not isinstance(firebase_message_id, str):
+            return
+        # Optional timestamp of the read message, ordering reports from
+        # different tabs; anything but a number is ignored
+        timestamp = data.get('timestamp')
+        if isinstance(timestamp, bool) or not isinstance(timestamp, (int, float)):
+            timestamp = None
+
+        # Watermark mode: coalesced with the room's other readers and
+        # broadcast as one read_receipts event per window
+        watermarks.add(self.channel_layer, room_id, self.user.id, firebase_message_id, timestamp)
+
     # Receive message from room group
     async def chat_message(self, event):
         # Send message to WebSocket
-        await self.send(text_data=json.dumps({
+        await self.send_event({
             'type': 'chat_message',
+            'room_id': event['room_id'],
             'message': event['message'],
             'firebase_message_id': event['firebase_message_id'],
             'sender_id': event['sender_id'],
             'sender_name': event['sender_name'],
             'timestamp': event['timestamp']
-        }))
+        })
 
     async def typing_indicator(self, event):
-        # Don't send typing indicator to the sender
-        if event['user_id'] != self.user.id:
-            await self.send(text_data=json.dumps({
+        # Don't send typing indicator to the sender, nor one that went stale
+        # waiting behind other traffic
+        if event['user_id'] != self.user.id and not is_stale(event):
+            await self.send_event({
                 'type': 'typing_indicator',
+                'room_id': event['room_id'],
                 'is_typing': event['is_typing'],
                 'user_id': event['user_id'],
-                'user_name': event['user_name']
-            }))
+                'user_name': event['user_name'],
+                'expires_in': event['expires_in']
+            })
 
     async def read_receipt(self, event):
         # Send read receipt to WebSocket
-        await self.send(text_data=json.dumps({
+        await self.send_event({
             'type': 'read_receipt',
+            'room_id': event['room_id'],
             'firebase_message_id': event['firebase_message_id'],
             'user_id': event['user_id'],
             'user_name': event['user_name']
-        }))
+        })
+
+    async def read_receipts(self, event):
+        # Maps reader id to the last message they have read; everything
+        # up to and including it counts as read
+        payload = {
+            'type': 'read_receipts',
+            'room_id': event['room_id'],
+            'receipts': event['receipts']
+        }
+        if event.get('timestamps'):
+            payload['timestamps'] = event['timestamps']
+        await self.send_event(payload)
+
+    async def track_presence(self, online):
+        # With the tracker, only a user's first and last live connection
+        # change their status, and the flush worker writes it
+        if presence.is_enabled():
+            track = presence.connection_opened if online else presence.connection_closed
+            try:
+                await sync_to_async(track)(self.user.id, self.channel_name)
+                return
+            except RedisError:
+                logger.warning("Presence tracker unavailable, writing online status directly", exc_info=True)
+        await self.update_user_status(online)
+
+    async def heartbeat(self):
+        # Renews this connection's presence lease
+        if presence.is_enabled():
+            try:
+                await sync_to_async(presence.heartbeat)(self.user.id, self.channel_name)
+            except RedisError:
+                logger.warning("Presence tracker unavailable, lease not renewed", exc_info=True)
 
     @database_sync_to_async
-    def check_room_membership(self):
+    def update_user_status(self, is_online):
+        # Ticket-authenticated sockets carry a TicketUser, not a User row
+        fields = {'is_online': is_online}
+        if not is_online:
+            fields['last_seen'] = timezone.now()
+        User.objects.filter(pk=self.user.id).update(**fields)
+
+    async def persist_message(self, room_id, firebase_message_id, message_type, preview):
         try:
-            ChatRoomMember.objects.get(
-                user=self.user,
-                room__id=self.room_id
+            await sync_to_async(writebehind.enqueue_message)(
+                room_id, self.user.id, firebase_message_id, message_type, preview
             )
-            return True
-        except ChatRoomMember.DoesNotExist:
-            return False
+        except RedisError:
+            logger.warning("Write-behind queue unavailable, writing message metadata directly", exc_info=True)
+            await self.store_message(room_id, firebase_message_id, message_type, preview)
 
     @database_sync_to_async
-    def update_user_status(self, is_online):
-        self.user.set_online_status(is_online)
+    def store_message(self, room_id, firebase_message_id, message_type, preview):
+        message = MessageMetadata(
+            firebase_message_id=firebase_message_id,
+            room_id=room_id,
+            sender_id=self.user.id,
+            message_type=message_type,
+        )
+        with transaction.atomic():
+            store_messages([message], {firebase_message_id: preview})
+
+
+class ChatConsumer(RoomEventsConsumer):
+    """Single-room chat socket (ws/chat/<room_id>/)."""
+
+    async def connect(self):
+        self.room_id = self.scope['url_route']['kwargs']['room_id']
+        self.room_group_name = room_group_name(self.room_id)
+        self.user = self.scope['user']
+
+        # Check if user is authenticated and is a member of the room
+        if not self.user.is_authenticated:
+            await self.close()
+            return
+
+        # A connect ticket vouches for the rooms it was issued for; other
+        # rooms (e.g. joined since) are looked up
+        is_member = str(self.room_id) in getattr(self.user, 'rooms', {})
+        if not is_member:
+            is_member = await self.check_room_membership()
+        if not is_member:
+            await self.close()
+            return
+
+        # Join room group
+        await self.channel_layer.group_add(
+            self.room_group_name,
+            self.channel_name
+        )
+
+        await self.accept()
+
+        # Update user online status
+        await self.track_presence(True)
+
+    async def disconnect(self, close_code):
+        await self.typing.stop_all()
+        self.release_outbound()
+
+        # Leave room group
+        await self.channel_layer.group_discard(
+            self.room_group_name,
+            self.channel_name
+        )
+
+        # Update user online status
+        if hasattr(self, 'user') and self.user.is_authenticated:
+            await self.track_presence(False)
+
+    async def receive(self, text_data=None, bytes_data=None):
+        data = await self.read_event(text_data, bytes_data)
+        if isinstance(data, dict):
+            await self.handle_client_message(self.room_id, data)
+
+    @database_sync_to_async
+    def check_room_membership(self):
+        return is_member(self.user.id, self.room_id)
+
+
+class MultiplexChatConsumer(RoomEventsConsumer):
+    """
+    One chat socket for all of a user's rooms (ws/chat/).
+
+    The client subscribes with {"type": "subscribe", "room_ids": [...]} and
+    leaves with {"type": "unsubscribe", "room_ids": [...]}; both are answered
+    with the room ids that took effect. Other client messages are those of
+    ChatConsumer plus the ``room_id`` they are for, and every event sent back
+    carries its ``room_id``. Authentication, the online-status write and the
+    socket itself are paid once per client rather than once per room.
+    """
+    MAX_ROOMS = 500
+
+    async def connect(self):
+        self.user = self.scope['user']
+        self.room_ids = set()
+
+        if not self.user.is_authenticated:
+            await self.close()
+            return
+
+        await self.accept()
+
+        # Update user online status
+        await self.track_presence(True)
+
+    async def disconnect(self, close_code):
+        await self.typing.stop_all()
+        self.release_outbound()
+        for room_id in getattr(self, 'room_ids', ()):
+            await self.channel_layer.group_discard(room_group_name(room_id), self.channel_name)
+
+        # Update user online status
+        if hasattr(self, 'user') and self.user.is_authenticated:
+            await self.track_presence(False)
+
+    async def receive(self, text_data=None, bytes_data=None):
+        data = await self.read_event(text_data, bytes_data)
+        if not isinstance(data, dict):
+            return
+
+        message_type = data.get('type')
+        if message_type == 'subscribe':
+            await self.subscribe(data.get('room_ids'))
+        elif message_type == 'unsubscribe':
+            await self.unsubscribe(data.get('room_ids'))
+        elif message_type == 'heartbeat':
+            await self.heartbeat()
+        else:
+            room_id = self.canonical_room_id(data.get('room_id'))
+            if room_id not in self.room_ids:
+                await self.send_event({
+                    'error': 'Not subscribed to this room',
+                    'room_id': data.get('room_id'),
+                })
+                return
+            await self.handle_client_message(room_id, data)
+
+    @staticmethod
+    def canonical_room_id(room_id):
+        try:
+            return str(uuid.UUID(str(room_id)))
+        except ValueError:
+            return None
+
+    def requested_rooms(self, room_ids):
+        if not isinstance(room_ids, list):
+            return []
+        return list(dict.fromkeys(filter(None, map(self.canonical_room_id, room_ids))))
+
+    async def subscribe(self, room_ids):
+        requested = [room_id for room_id in self.requested_rooms(room_ids) if room_id not in self.room_ids]
+        requested = requested[:max(self.MAX_ROOMS - len(self.room_ids), 0)]
+
+        # Rooms vouched for by the connect ticket need no lookup; the rest
+        # are checked together
+        vouched = getattr(self.user, 'rooms', {})
+        allowed = {room_id for room_id in requested if room_id in vouched}
+        unknown = [room_id for room_id in requested if room_id not in allowed]
+        if unknown:
+            allowed.update(await self.member_rooms(unknown))
+
+        subscribed = [room_id for room_id in requested if room_id in allowed]
+        for room_id in subscribed:
+            await self.channel_layer.group_add(room_group_name(room_id), self.channel_name)
+        self.room_ids.update(subscribed)
+
+        await self.send_event({
+            'type': 'subscribed',
+            'room_ids': subscribed,
+            'rejected': [room_id for room_id in self.requested_rooms(room_ids) if room_id not in self.room_ids],
+        })
+
+    async def unsubscribe(self, room_ids):
+        left = [room_id for room_id in self.requested_rooms(room_ids) if room_id in self.room_ids]
+        for room_id in left:
+            await self.typing.stop(room_id)
+            await self.channel_layer.group_discard(room_group_name(room_id), self.channel_name)
+        self.room_ids.difference_update(left)
+
+        await self.send_event({
+            'type': 'unsubscribed',
+            'room_ids': left,
+        })
+
+    @database_sync_to_async
+    def member_rooms(self, room_ids):
+        return {str(room_id) for room_id in member_room_ids(self.user.id, map(uuid.UUID, room_ids))}
+
+
+class UserConsumer(EventConsumer):
+    """
+    Per-user notification socket (ws/user/). Receives inbox events pushed by
+    chat.inbox whenever the user's rooms list changes, so clients don't need
+    to poll the rooms endpoint.
+    """
+
+    async def connect(self):
+        self.user = self.scope['user']
+
+        if not self.user.is_authenticated:
+            await self.close()
+            return
+
+        self.user_group_name = user_group_name(self.user.id)
+        await self.channel_layer.group_add(
+            self.user_group_name,
+            self.channel_name
+        )
+
+        await self.accept()
+
+    async def disconnect(self, close_code):
+        if hasattr(self, 'user_group_name'):
+            await self.channel_layer.group_discard(
+                self.user_group_name,
+                self.channel_name
+            )
+
+    async def receive(self, text_data=None, bytes_data=None):
+        # Server-to-client only; ignore anything the client sends
+        pass
+
+    async def inbox_event(self, event):
+        payload = {key: value for key, value in event.items() if key != 'type'}
+        await self.send_event({'type': 'inbox_update', **payload})
@@ -0,0 +1,186 @@
+"""
+Per-user inbox versions and push notifications.
+
+Every write that changes what a user sees in the rooms list bumps that user's
+inbox version, a Redis counter under INBOX_VERSION_PREFIX. ChatRoomListView
+turns the version into an ETag, so repeat polls can be answered with 304 Not
+Modified after one Redis round trip, without touching the rooms, members or
+messages tables.
+
+Bumps run once the write's transaction commits, as one pipelined INCR per
+user, so a message to a 5,000-member group takes no row locks for them and
+a reader can never pair a new version with pre-commit data. A counter that
+is missing (expired after VERSION_TTL idle seconds, or lost with Redis)
+restarts from the current time in microseconds, above any version it handed
+out before. When Redis is unavailable lists are served without an ETag, and
+failed bumps are logged: until the next successful bump those users may be
+answered 304 for a list that changed.
+Presence is deliberately not versioned, and so is left out of room payloads.
+
+When an ``event`` is given, it is also pushed to each affected user's
+``user_<id>`` channel-layer group (see UserConsumer) once the surrounding
+transaction commits, so connected clients don't have to poll at all.
+Call these helpers inside the transaction of the write they describe.
+"""
+import asyncio
+import hashlib
+import logging
+import time
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import transaction
+from redis.exceptions import RedisError
+
+from flowchat.redis_client import get_redis
+from .models import LAST_MESSAGE_PREVIEW_LENGTH, ChatRoomMember, ChatRoomRemoval
+
+logger = logging.getLogger(__name__)
+
+# Counters of users who neither poll nor get bumped for this long are dropped
+VERSION_TTL = 7 * 24 * 3600
+
+
+def user_group_name(user_id):
+    return f'user_{user_id}'
+
+
+def room_group_name(room_id):
+    return f'chat_{room_id}'
+
+
+def notify_users(user_ids, event):
+    """Push an inbox event to the users' notification sockets after commit."""
+    user_ids = set(user_ids)
+    if not user_ids or event is None:
+        return
+    message = {'type': 'inbox_event', **event}
+
+    def send():
+        channel_layer = get_channel_layer()
+        if channel_layer is None:
+            return
+        # One event loop (and channel-layer connection) for every recipient,
+        # with the sends running concurrently
+        async_to_sync(_send_to_users)(channel_layer, list(user_ids), message)
+
+    transaction.on_commit(send)
+
+
+async def _send_to_users(channel_layer, user_ids, message):
+    results = await asyncio.gather(
+        *(channel_layer.group_send(user_group_name(user_id), message) for user_id in user_ids),
+        return_exceptions=True,
+    )
+    failed = [(user_id, result) for user_id, result in zip(user_ids, results) if isinstance(result, Exception)]
+    if failed:
+        # Notifications are best effort; clients resync via the changes feed
+        user_id, error = failed[0]
+        logger.warning(
+            "Failed to push inbox event to %d of %d users (first: user %s)", len(failed), len(user_ids), user_id,
+            exc_info=error,
+        )
+
+
+def version_key(user_id):
+    return f'{settings.INBOX_VERSION_PREFIX}:{user_id}'
+
+
+def _queue_start(pipe, key):
+    # A missing counter restarts above anything it issued before being lost
+    pipe.set(key, time.time_ns() // 1000, nx=True)
+
+
+def inbox_version(user_id):
+    """The user's current inbox version, or None when Redis is unavailable."""
+    key = version_key(user_id)
+    try:
+        pipe = get_redis().pipeline(transaction=False)
+        _queue_start(pipe, key)
+        pipe.get(key)
+        pipe.expire(key, VERSION_TTL)
+        version = pipe.execute()[1]
+    except RedisError as exc:
+        logger.warning("Inbox versions unavailable, serving the rooms list without an ETag: %s", exc)
+        return None
+    return version
+
+
+def _increment_versions(user_ids):
+    try:
+        pipe = get_redis().pipeline(transaction=False)
+        for user_id in user_ids:
+            key = version_key(user_id)
+            _queue_start(pipe, key)
+            pipe.incr(key)
+            pipe.expire(key, VERSION_TTL)
+        pipe.execute()
+    except RedisError:
+        logger.error("Failed to bump the inbox version of %d users", len(user_ids), exc_info=True)
+
+
+def bump_inbox_versions(user_ids, event=None):
+    """Invalidate the rooms list of the given users once the transaction commits."""
+    user_ids = set(user_ids)
+    if user_ids:
+        transaction.on_commit(lambda: _increment_versions(user_ids))
+        notify_users(user_ids, event)
+
+
+def bump_contact_inboxes(user_id, event=None):
+    """Invalidate the rooms list of everyone sharing a room with the user (profile edits)."""
+    contact_ids = set(
+        ChatRoomMember.objects.filter(room__chatroommember__user_id=user_id)
+        .values_list('user_id', flat=True)
+    )
+    bump_inbox_versions(contact_ids, event)
+
+
+def bump_room_inboxes(room_ids, event=None):
+    """Invalidate the rooms list of every current member of the given rooms."""
+    room_ids = set(room_ids)
+    if room_ids:
+        member_ids = ChatRoomMember.objects.filter(room_id__in=room_ids).values_list('user_id', flat=True)
+        bump_inbox_versions(member_ids, event)
+
+
+def record_room_removals(room_id, user_ids):
+    """Leave tombstones for users who lost access to a room and invalidate their lists."""
+    user_ids = set(user_ids)
+    ChatRoomRemoval.objects.bulk_create(
+        [ChatRoomRemoval(user_id=uid, room_id=room_id) for uid in user_ids]
+    )
+    bump_inbox_versions(user_ids, {'event': 'room_removed', 'room_id': str(room_id)})
+
+
+def message_event(message, preview=''):
+    """Inbox event for a newly recorded message (channel layers need plain types)."""
+    return {
+        'event': 'message_created',
+        'room_id': str(message.room_id),
+        'message': {
+            'id': str(message.id),
+            'firebase_message_id': message.firebase_message_id,
+            'message_type': message.message_type,
+            'sender_id': message.sender_id,
+            'preview': (preview or '')[:LAST_MESSAGE_PREVIEW_LENGTH],
+            'created_at': message.created_at.isoformat(),
+        },
+    }
+
+
+def room_event(name, room_id):
+    return {'event': name, 'room_id': str(room_id)}
+
+
+def inbox_etag(user, full_path):
+    """
+    Weak ETag for a rooms-list response, or None when the inbox version is
+    unavailable; includes the path so pages differ.
+    """
+    version = inbox_version(user.pk)
+    if version is None:
+        return None
+    path_hash = hashlib.md5(full_path.encode()).hexdigest()[:12]
+    return f'W/"inbox-{user.pk}-{version}-{path_hash}"'
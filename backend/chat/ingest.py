@@ -0,0 +1,49 @@
+"""
+Bulk recording of message metadata.
+
+Shared by the batch endpoint and the write-behind worker: a whole batch is
+one INSERT ... ON CONFLICT DO NOTHING keyed on firebase_message_id plus a
+constant number of statements per affected room, however many messages it
+holds. Call inside a transaction.
+"""
+from .inbox import bump_room_inboxes, message_event
+from .models import ChatRoom, MessageMetadata
+
+
+def _newest(messages):
+    return max(messages, key=lambda message: (message.created_at, str(message.pk)))
+
+
+def store_messages(messages, previews=None):
+    """
+    Upsert unsaved MessageMetadata instances (distinct firebase_message_ids)
+    and update the summaries, unread counters and inboxes of their rooms.
+
+    ``previews`` maps firebase_message_id to preview text. Returns
+    ``{firebase_message_id: (stored message, created)}``; ``created`` is False
+    when the id was already recorded, by this or another message.
+    """
+    previews = previews or {}
+    # Ids are generated client-side, so a stored row with a different id
+    # was recorded before this batch
+    MessageMetadata.objects.bulk_create(messages, ignore_conflicts=True)
+    stored = MessageMetadata.objects.in_bulk(
+        [message.firebase_message_id for message in messages], field_name='firebase_message_id'
+    )
+
+    results = {}
+    created_by_room = {}
+    for message in messages:
+        existing = stored[message.firebase_message_id]
+        created = existing.pk == message.pk
+        if created:
+            created_by_room.setdefault(existing.room_id, []).append(existing)
+        results[message.firebase_message_id] = (existing, created)
+
+    rooms = ChatRoom.objects.in_bulk(created_by_room.keys())
+    for room_id, created in created_by_room.items():
+        latest = _newest(created)
+        preview = previews.get(latest.firebase_message_id, '')
+        rooms[room_id].record_messages(created, preview)
+        bump_room_inboxes([room_id], message_event(latest, preview))
+    return results
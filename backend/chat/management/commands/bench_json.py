@@ -0,0 +1,101 @@
+import random
+import time
+import uuid
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+from rest_framework.utils import json as drf_json
+
+from flowchat import jsoncodec
+
+
+def _user(user_id):
+    return {
+        'id': user_id,
+        'email': f'user{user_id}@example.com',
+        'username': f'user{user_id}',
+        'first_name': 'Ada',
+        'last_name': f'Lovelace {user_id}',
+        'full_name': f'Ada Lovelace {user_id}',
+        'bio': 'Analytical engine enthusiast. ' * 2,
+        'profile_picture': f'https://res.cloudinary.com/demo/image/upload/v1/profile_pictures/{user_id}.jpg',
+    }
+
+
+def rooms_page(rooms, members, now=None):
+    """A rooms-list response shaped like ChatRoomSerializer output."""
+    now = now or timezone.now()
+    rng = random.Random(rooms * 1000 + members)
+    results = []
+    for index in range(rooms):
+        room_id = str(uuid.UUID(int=rng.getrandbits(128)))
+        users = [_user(rng.randint(1, 10_000)) for _ in range(members)]
+        last_at = (now - timedelta(seconds=index * 37)).isoformat()
+        results.append({
+            'id': room_id,
+            'name': f'Room {index} ✨',
+            'room_type': 'group',
+            'description': 'Weekly sync, notes and links',
+            'avatar_url': None,
+            'created_by': users[0],
+            'members': [
+                {'user': user, 'role': 'admin' if n == 0 else 'member', 'joined_at': last_at, 'last_read_at': last_at}
+                for n, user in enumerate(users)
+            ],
+            'member_count': members,
+            'last_message': {
+                'id': str(uuid.UUID(int=rng.getrandbits(128))),
+                'firebase_message_id': f'fm-{rng.getrandbits(64):x}',
+                'room': room_id,
+                'sender': users[-1],
+                'message_type': 'text',
+                'preview': 'Sounds good — see you at 10 📅',
+                'read_by': [],
+                'created_at': last_at,
+            },
+            'unread_count': rng.randint(0, 40),
+            'created_at': (now - timedelta(days=index)).isoformat(),
+            'updated_at': last_at,
+            'firebase_collection_name': f'chat_rooms/{room_id}/messages',
+        })
+    return {'next': 'https://api.example.com/api/chat/rooms/?cursor=cD0y', 'previous': None, 'results': results}
+
+
+def _per_call(func, iterations):
+    started = time.perf_counter()
+    for _ in range(iterations):
+        func()
+    return (time.perf_counter() - started) / iterations
+
+
+class Command(BaseCommand):
+    help = "Compare DRF's stdlib JSON against flowchat.jsoncodec on a rooms-list payload"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rooms', type=int, default=50, help='Rooms in the page')
+        parser.add_argument('--members', type=int, default=8, help='Members per room')
+        parser.add_argument('--iterations', type=int, default=500)
+
+    def handle(self, *args, **options):
+        payload = rooms_page(options['rooms'], options['members'])
+        iterations = options['iterations']
+        stdlib_renderer, fast_renderer = JSONRenderer(), jsoncodec.FastJSONRenderer()
+        body = stdlib_renderer.render(payload)
+        assert drf_json.loads(fast_renderer.render(payload)) == drf_json.loads(body)
+
+        backend = 'orjson' if jsoncodec.orjson is not None else 'stdlib (orjson not installed)'
+        self.stdout.write(
+            f'{options["rooms"]} rooms x {options["members"]} members, {len(body) / 1024:.1f} KiB, '
+            f'{iterations} iterations, codec backend: {backend}'
+        )
+        for label, baseline, fast in (
+            ('render', lambda: stdlib_renderer.render(payload), lambda: fast_renderer.render(payload)),
+            ('parse', lambda: drf_json.loads(body), lambda: jsoncodec.loads(body)),
+        ):
+            baseline_s, fast_s = _per_call(baseline, iterations), _per_call(fast, iterations)
+            self.stdout.write(
+                f'{label:>6}: stdlib {baseline_s * 1e6:8.1f} us  fast {fast_s * 1e6:8.1f} us  '
+                f'speedup {baseline_s / fast_s:5.1f}x'
+            )
@@ -0,0 +1,63 @@
+import json
+import os
+import socket
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from chat import writebehind
+from flowchat.redis_client import get_redis
+
+
+class Command(BaseCommand):
+    help = 'Write queued message metadata (MESSAGE_WRITE_BEHIND) to PostgreSQL in batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=settings.MESSAGE_WRITE_BEHIND_BATCH_SIZE,
+            help='Most entries written per INSERT',
+        )
+        parser.add_argument(
+            '--max-staleness', type=float, default=settings.MESSAGE_WRITE_BEHIND_MAX_STALENESS,
+            help='Seconds an entry may wait in the queue before it is written',
+        )
+        parser.add_argument('--once', action='store_true', help='Drain what is queued now, then exit')
+        parser.add_argument('--stats', action='store_true', help='Print queue depth and flush metrics, then exit')
+
+    def handle(self, *args, **options):
+        client = get_redis()
+        writebehind.ensure_group(client)
+        if options['stats']:
+            self.stdout.write(json.dumps(writebehind.queue_stats(client), indent=2, sort_keys=True))
+            return
+
+        batch_size = options['batch_size']
+        # Gather for at most half the budget so the write itself fits in the rest
+        linger = options['max_staleness'] / 2
+        # Entries a dead worker held longer than this are taken over
+        claim_idle_ms = int(options['max_staleness'] * 2000)
+        consumer = f'{socket.gethostname()}-{os.getpid()}'
+        self.stdout.write(f'Draining {writebehind.stream_name()} as {consumer}')
+
+        while True:
+            batch = writebehind.read_entries(client, consumer, batch_size, int(linger * 1000), claim_idle_ms)
+            if not batch:
+                if options['once']:
+                    return
+                continue
+            # Keep reading until the batch is full or its oldest entry is due
+            while len(batch) < batch_size:
+                remaining = linger - (time.time() - writebehind.oldest_queued_at(batch))
+                if remaining <= 0:
+                    break
+                more = writebehind.read_entries(
+                    client, consumer, batch_size - len(batch), max(int(remaining * 1000), 1), claim_idle_ms
+                )
+                if not more:
+                    break
+                batch.extend(more)
+
+            close_old_connections()
+            writebehind.flush(client, batch)
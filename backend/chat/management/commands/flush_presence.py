@@ -0,0 +1,27 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from chat import presence
+
+
+class Command(BaseCommand):
+    help = 'Persist presence changes (PRESENCE_TRACKER) and expire dead connections on an interval'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--interval', type=float, default=settings.PRESENCE_FLUSH_INTERVAL,
+            help='Seconds between flushes',
+        )
+        parser.add_argument('--once', action='store_true', help='Flush once, then exit')
+
+    def handle(self, *args, **options):
+        while True:
+            close_old_connections()
+            started = time.monotonic()
+            presence.flush()
+            if options['once']:
+                return
+            time.sleep(max(options['interval'] - (time.monotonic() - started), 0))
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from chat.models import ChatRoomRemoval
+from chat.views import ChatRoomChangesView
+
+
+class Command(BaseCommand):
+    help = 'Delete room removal tombstones the changes feed no longer relies on (run daily)'
+
+    def handle(self, *args, **options):
+        # Cursors older than SYNC_RETENTION get a full reset, so their
+        # tombstones are never read again
+        cutoff = timezone.now() - ChatRoomChangesView.SYNC_RETENTION
+        deleted, _ = ChatRoomRemoval.objects.filter(removed_at__lt=cutoff).delete()
+        self.stdout.write(f'Deleted {deleted} room removals from before {cutoff.isoformat()}')
@@ -0,0 +1,327 @@
+import asyncio
+import multiprocessing
+import random
+import resource
+import time
+import uuid
+from collections import Counter
+
+from asgiref.sync import sync_to_async
+from channels.layers import channel_layers
+from channels.testing import WebsocketCommunicator
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.test import override_settings
+
+from chat import outbound, wire
+from chat.tickets import TicketUser, issue_ticket
+from flowchat import jsoncodec
+
+IN_MEMORY_LAYER = {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}
+
+# Synthetic users get ids far above any real ones; their online-status
+# writes match no rows
+FIRST_USER_ID = 10 ** 9
+
+KINDS = ('chat', 'typing', 'receipt')
+
+
+def build_plan(connections_count, rooms, sizes, seed):
+    """Spread ``rooms`` rooms of the given sizes (cycled) over the connections round-robin."""
+    rng = random.Random(seed)
+    user_rooms = {index: [] for index in range(connections_count)}
+    room_sizes = {}
+    cursor = 0
+    for index in range(rooms):
+        size = min(sizes[index % len(sizes)], connections_count)
+        room_id = str(uuid.UUID(int=rng.getrandbits(128)))
+        room_sizes[room_id] = size
+        for _ in range(size):
+            user_rooms[cursor % connections_count].append(room_id)
+            cursor += 1
+    return user_rooms, room_sizes
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return float('nan')
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+
+class LoadClient:
+    """One synthetic user's multiplexed chat socket."""
+
+    def __init__(self, application, index, room_ids, options):
+        user_id = FIRST_USER_ID + index
+        self.user = TicketUser(user_id, f'Load User {index}', {room_id: 'member' for room_id in room_ids})
+        self.room_ids = room_ids
+        self.application = application
+        self.options = options
+        self.frames = wire.JSONFrames()
+        self.last_seen = {}  # room id -> newest firebase message id received
+        self.typing = set()
+        self.delivered = Counter()
+        self.latencies = []
+
+    async def connect(self):
+        query = f'ticket={issue_ticket(self.user, self.user.rooms)}'
+        if self.options['batch']:
+            query += '&batch=1'
+        subprotocols = [wire.MSGPACK_SUBPROTOCOL] if self.options['msgpack'] else None
+        self.communicator = WebsocketCommunicator(self.application, f'/ws/chat/?{query}', subprotocols=subprotocols)
+        connected, subprotocol = await self.communicator.connect(timeout=30)
+        if not connected:
+            raise CommandError(f'Connection for user {self.user.id} was refused')
+        if subprotocol == wire.MSGPACK_SUBPROTOCOL:
+            self.frames = wire.MsgpackFrames()
+        if self.room_ids:
+            await self.send({'type': 'subscribe', 'room_ids': self.room_ids})
+            while (await self.receive()) and 'subscribed' not in self.delivered:
+                pass
+            self.delivered.clear()
+
+    async def send(self, payload):
+        if self.frames.binary:
+            await self.communicator.send_to(bytes_data=self.frames.encode(payload))
+        else:
+            await self.communicator.send_to(text_data=self.frames.encode(payload))
+
+    async def receive(self):
+        output = await self.communicator.receive_output(timeout=3600)
+        if output['type'] != 'websocket.send':
+            return False
+        now = time.time()
+        if output.get('text') is not None:
+            events = jsoncodec.loads(output['text'])
+        else:
+            events = self.frames.decode(output['bytes'])
+        for event in events if isinstance(events, list) else [events]:
+            event_type = event.get('type', 'error')
+            self.delivered[event_type] += 1
+            if event_type == 'chat_message':
+                self.latencies.append(now - event['timestamp'])
+                self.last_seen[event['room_id']] = event['firebase_message_id']
+        return True
+
+    async def read(self):
+        while await self.receive():
+            pass
+
+    async def act(self, kind, rng):
+        """Send one event of ``kind`` to a random room of the user's; returns the room."""
+        room_id = rng.choice(self.room_ids)
+        if kind == 'chat':
+            await self.send({
+                'type': 'chat_message',
+                'room_id': room_id,
+                'message': 'load ' * 8,
+                'firebase_message_id': uuid.uuid4().hex,
+                'timestamp': time.time(),
+            })
+        elif kind == 'typing':
+            is_typing = room_id not in self.typing
+            self.typing.symmetric_difference_update([room_id])
+            await self.send({'type': 'typing', 'room_id': room_id, 'is_typing': is_typing})
+        else:
+            await self.send({
+                'type': 'read_up_to',
+                'room_id': room_id,
+                'firebase_message_id': self.last_seen.get(room_id, 'fm-0'),
+            })
+        return room_id
+
+
+async def run_clients(application, user_rooms, options, seed):
+    """Connect, drive traffic at the target rate for the duration, drain, disconnect."""
+    rng = random.Random(seed)
+    clients = [LoadClient(application, index, room_ids, options) for index, room_ids in user_rooms.items()]
+    started = time.perf_counter()
+    for offset in range(0, len(clients), 100):
+        await asyncio.gather(*(client.connect() for client in clients[offset:offset + 100]))
+    connect_s = time.perf_counter() - started
+    readers = [asyncio.ensure_future(client.read()) for client in clients]
+
+    senders = [client for client in clients if client.room_ids]
+    weights = [options['chat_weight'], options['typing_weight'], options['receipt_weight']]
+    sent = Counter()
+    chat_rooms = Counter()  # room id -> chat messages sent there
+    loop = asyncio.get_running_loop()
+    interval = 1 / options['rate']
+    next_at = loop.time()
+    end = next_at + options['duration']
+    while senders and loop.time() < end:
+        delay = next_at - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        next_at += interval
+        kind = rng.choices(KINDS, weights)[0]
+        room_id = await rng.choice(senders).act(kind, rng)
+        sent[kind] += 1
+        if kind == 'chat':
+            chat_rooms[room_id] += 1
+    sent_s = time.perf_counter() - started - connect_s
+
+    await asyncio.sleep(options['drain'])
+    for reader in readers:
+        reader.cancel()
+    await asyncio.gather(*readers, return_exceptions=True)
+    for client in clients:
+        await client.communicator.disconnect()
+    # The consumers' database connections belong to the sync worker thread
+    await sync_to_async(connections.close_all)()
+
+    delivered = Counter()
+    latencies = []
+    for client in clients:
+        delivered.update(client.delivered)
+        latencies.extend(client.latencies)
+    return {
+        'connections': len(clients),
+        'connect_s': connect_s,
+        'sent_s': sent_s,
+        'sent': sent,
+        'chat_rooms': chat_rooms,
+        'delivered': delivered,
+        'latencies': latencies,
+    }
+
+
+def run_process(user_rooms, options, seed):
+    from flowchat.asgi import application
+
+    cpu = resource.getrusage(resource.RUSAGE_SELF)
+    started = time.perf_counter()
+    result = asyncio.run(run_clients(application, user_rooms, options, seed))
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    result.update({
+        'wall_s': time.perf_counter() - started,
+        'cpu_s': usage.ru_utime + usage.ru_stime - cpu.ru_utime - cpu.ru_stime,
+        # KiB on Linux
+        'maxrss_kib': usage.ru_maxrss,
+        'outbound': dict(outbound.counters),
+    })
+    return result
+
+
+def _process_main(user_rooms, options, seed, results):
+    results.put(run_process(user_rooms, options, seed))
+
+
+class Command(BaseCommand):
+    help = (
+        'Load-test websocket fan-out: open synthetic ticket-authenticated chat sockets '
+        'in-process against the ASGI app, drive chat/typing/receipt traffic and report '
+        'delivery latency, throughput, CPU and memory. Each process hosts both the load '
+        'generator and the consumers it talks to, so CPU includes the generator.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--connections', type=int, default=200, help='Sockets (one synthetic user each)')
+        parser.add_argument('--rooms', type=int, default=20)
+        parser.add_argument(
+            '--room-size', default='10',
+            help='Members per room; a comma-separated list is cycled over the rooms (e.g. 2,10,100)',
+        )
+        parser.add_argument('--rate', type=float, default=200.0, help='Client messages per second, all kinds')
+        parser.add_argument('--duration', type=float, default=10.0, help='Seconds of traffic')
+        parser.add_argument('--drain', type=float, default=2.0, help='Seconds to wait for deliveries afterwards')
+        parser.add_argument('--chat-weight', type=float, default=6)
+        parser.add_argument('--typing-weight', type=float, default=3)
+        parser.add_argument('--receipt-weight', type=float, default=1)
+        parser.add_argument(
+            '--layer', choices=('memory', 'configured'), default='memory',
+            help="In-memory channel layer, or CHANNEL_LAYERS from settings (e.g. a local Redis)",
+        )
+        parser.add_argument(
+            '--processes', type=int, default=1,
+            help='Split the connections over this many processes (needs --layer configured)',
+        )
+        parser.add_argument('--msgpack', action='store_true', help='Negotiate MessagePack frames')
+        parser.add_argument('--batch', action='store_true', help='Ask for batched frames (needs WS_BATCH_WINDOW)')
+        parser.add_argument('--seed', type=int, default=1)
+
+    def handle(self, *args, **options):
+        sizes = [int(size) for size in options['room_size'].split(',')]
+        if options['processes'] > 1 and options['layer'] == 'memory':
+            raise CommandError('The in-memory channel layer cannot span processes; use --layer configured')
+        if options['rate'] <= 0 or options['connections'] <= 0 or min(sizes) <= 0:
+            raise CommandError('--rate, --connections and --room-size must be positive')
+
+        user_rooms, room_sizes = build_plan(options['connections'], options['rooms'], sizes, options['seed'])
+        shares = [
+            {index: rooms for index, rooms in user_rooms.items() if index % options['processes'] == share}
+            for share in range(options['processes'])
+        ]
+        share_options = {**options, 'rate': options['rate'] / options['processes']}
+
+        layers = IN_MEMORY_LAYER if options['layer'] == 'memory' else None
+        with override_settings(**({'CHANNEL_LAYERS': layers} if layers else {})):
+            channel_layers.backends.clear()
+            try:
+                if options['processes'] == 1:
+                    results = [run_process(shares[0], share_options, options['seed'])]
+                else:
+                    results = self.run_processes(shares, share_options, options['seed'])
+            finally:
+                channel_layers.backends.clear()
+
+        self.report(options, room_sizes, results)
+
+    def run_processes(self, shares, options, seed):
+        # Forked children must not share the parent's database connections
+        connections.close_all()
+        context = multiprocessing.get_context('fork')
+        queue = context.Queue()
+        processes = [
+            context.Process(target=_process_main, args=(share, options, seed + index, queue))
+            for index, share in enumerate(shares)
+        ]
+        for process in processes:
+            process.start()
+        results = [queue.get() for _ in processes]
+        for process in processes:
+            process.join()
+        return results
+
+    def report(self, options, room_sizes, results):
+        sent, chat_rooms, delivered, latencies = Counter(), Counter(), Counter(), []
+        for result in results:
+            sent.update(result['sent'])
+            chat_rooms.update(result['chat_rooms'])
+            delivered.update(result['delivered'])
+            latencies.extend(result['latencies'])
+        latencies.sort()
+        sent_s = max(result['sent_s'] for result in results)
+        # Every member of the room, the sender included, gets each message.
+        # Senders pick rooms weighted by membership, so count per room.
+        expected = sum(room_sizes[room_id] * count for room_id, count in chat_rooms.items())
+
+        write = self.stdout.write
+        write(
+            f'{options["connections"]} connections, {len(room_sizes)} rooms of {options["room_size"]} members, '
+            f'layer {options["layer"]}, {options["processes"]} process(es), '
+            f'frames {"msgpack" if options["msgpack"] else "json"}{", batched" if options["batch"] else ""}'
+        )
+        write(
+            f'connect: {max(result["connect_s"] for result in results):.2f}s  '
+            f'sent: {sum(sent.values())} ({sum(sent.values()) / sent_s:.1f}/s of {options["rate"]:g}/s target)  '
+            + '  '.join(f'{kind}={sent[kind]}' for kind in KINDS)
+        )
+        write(
+            f'delivered: {sum(delivered.values())} events ({sum(delivered.values()) / sent_s:.1f}/s)  '
+            + '  '.join(f'{kind}={n}' for kind, n in sorted(delivered.items()))
+        )
+        if expected:
+            write(f'chat fan-out: {delivered["chat_message"]}/{expected:.0f} expected deliveries')
+        write(
+            f'chat latency ms: p50 {percentile(latencies, 0.50) * 1000:.2f}  '
+            f'p95 {percentile(latencies, 0.95) * 1000:.2f}  p99 {percentile(latencies, 0.99) * 1000:.2f}  '
+            f'max {(latencies[-1] if latencies else float("nan")) * 1000:.2f}  ({len(latencies)} samples)'
+        )
+        for index, result in enumerate(results):
+            write(
+                f'process {index}: {result["connections"]} connections  cpu {result["cpu_s"]:.2f}s '
+                f'({result["cpu_s"] / result["wall_s"]:.0%} of {result["wall_s"]:.1f}s)  '
+                f'max rss {result["maxrss_kib"] / 1024:.1f} MiB'
+                + ''.join(f'  {reason}={n}' for reason, n in sorted(result['outbound'].items()))
+            )
@@ -0,0 +1,115 @@
+"""
+Cached room membership for authorization checks.
+
+With MEMBERSHIP_CACHE enabled, each user's memberships are kept in the
+shared ``memberships`` cache as one ``{room_id: role}`` entry, so the
+membership check in front of most chat endpoints and every ChatConsumer
+connect is a cache hit instead of a join. Disabled, the same helpers run a
+single indexed lookup per check.
+
+Every write that adds or removes memberships must call invalidate_memberships()
+for the affected users inside its transaction: the entries are dropped right
+away and again once the transaction commits, so a concurrent reader cannot
+cache the pre-commit state for longer than the commit takes.
+"""
+import logging
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from redis.exceptions import RedisError
+
+from .models import ChatRoomMember
+
+logger = logging.getLogger(__name__)
+
+
+def is_enabled():
+    return settings.MEMBERSHIP_CACHE
+
+
+def cache_key(user_id):
+    return f'chat:memberships:{user_id}'
+
+
+def _room_key(room_id):
+    """Canonical room id string, or None if ``room_id`` is not a UUID."""
+    try:
+        return str(uuid.UUID(str(room_id)))
+    except ValueError:
+        return None
+
+
+def _load(user_id):
+    return {
+        str(room_id): role
+        for room_id, role in ChatRoomMember.objects.filter(user_id=user_id).values_list('room_id', 'role')
+    }
+
+
+def user_memberships(user_id):
+    """All of the user's rooms as ``{room_id: role}``, from the cache when possible."""
+    if not is_enabled():
+        return _load(user_id)
+    cache = caches['memberships']
+    try:
+        memberships = cache.get(cache_key(user_id))
+    except RedisError:
+        logger.warning("Membership cache unavailable, reading memberships directly", exc_info=True)
+        return _load(user_id)
+    if memberships is None:
+        memberships = _load(user_id)
+        try:
+            cache.set(cache_key(user_id), memberships, settings.MEMBERSHIP_CACHE_TIMEOUT)
+        except RedisError:
+            logger.warning("Failed to cache memberships of user %s", user_id, exc_info=True)
+    return memberships
+
+
+def membership_role(user_id, room_id):
+    """The user's role in the room, or None if they are not a member."""
+    room_key = _room_key(room_id)
+    if room_key is None:
+        return None
+    if not is_enabled():
+        return (
+            ChatRoomMember.objects.filter(user_id=user_id, room_id=room_key)
+            .values_list('role', flat=True).first()
+        )
+    return user_memberships(user_id).get(room_key)
+
+
+def is_member(user_id, room_id):
+    return membership_role(user_id, room_id) is not None
+
+
+def member_room_ids(user_id, room_ids):
+    """The subset of ``room_ids`` (UUIDs) the user belongs to."""
+    room_ids = set(room_ids)
+    if not room_ids:
+        return set()
+    if not is_enabled():
+        return set(
+            ChatRoomMember.objects.filter(user_id=user_id, room_id__in=room_ids)
+            .values_list('room_id', flat=True)
+        )
+    memberships = user_memberships(user_id)
+    return {room_id for room_id in room_ids if str(room_id) in memberships}
+
+
+def invalidate_memberships(user_ids):
+    """Drop the cached memberships of users whose rooms or roles changed."""
+    keys = [cache_key(user_id) for user_id in set(user_ids)]
+    if not keys or not is_enabled():
+        return
+
+    def delete():
+        try:
+            caches['memberships'].delete_many(keys)
+        except RedisError:
+            # Stale entries expire after MEMBERSHIP_CACHE_TIMEOUT
+            logger.warning("Failed to invalidate cached memberships", exc_info=True)
+
+    delete()
+    transaction.on_commit(delete)
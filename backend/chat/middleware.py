@@ -7,6 +7,8 @@ from django.contrib.auth import get_user_model
 from django.utils.functional import LazyObject
 from rest_framework_simplejwt.tokens import AccessToken
 
+from .tickets import read_ticket
+
 User = get_user_model()
 
 
@@ -27,34 +29,39 @@ class JWTAuthMiddleware:
     Custom Channels middleware that authenticates via JWT access token passed as
     a `token` query parameter on the WebSocket URL.
     Example: ws://host/ws/chat/<room_id>/?token=<ACCESS_TOKEN>
+
+    A connect ticket (`ticket` query parameter, see chat.tickets) is preferred:
+    it is checked by signature alone, without a database query.
+    Example: ws://host/ws/chat/<room_id>/?ticket=<TICKET>
     """
 
-    def __init__(self, inner):
+    def __init__(self, inner, ticket_inner=None):
         self.inner = inner
+        # Called instead of ``inner`` for ticket-authenticated sockets, so
+        # they can skip session authentication (and its thread hop) as well
+        self.ticket_inner = ticket_inner or inner
 
-    def __call__(self, scope):
-        return JWTAuthMiddlewareInstance(scope, self)
-
-
-class JWTAuthMiddlewareInstance:
-    def __init__(self, scope, middleware):
-        self.scope = dict(scope)
-        self.middleware = middleware
-
-    async def __call__(self, receive, send):
-        query_string = self.scope.get('query_string', b'').decode()
+    async def __call__(self, scope, receive, send):
+        scope = dict(scope)
+        query_string = scope.get('query_string', b'').decode()
         params = urllib.parse.parse_qs(query_string)
+        ticket = params.get('ticket', [None])[0]
         token = params.get('token', [None])[0]
 
+        if ticket:
+            user = read_ticket(ticket)
+            if user is not None:
+                scope['user'] = user
+                return await self.ticket_inner(scope, receive, send)
+        # An expired or invalid ticket falls back to the token, if one was sent
         if token:
             user = await get_user_from_token(token)
             if user is not None:
-                self.scope['user'] = user
+                scope['user'] = user
 
-        inner = self.middleware.inner
-        return await inner(self.scope, receive, send)
+        return await self.inner(scope, receive, send)
 
 
 # Convenience wrapper compatible with Channels' AuthMiddlewareStack usage
 def JWTAuthMiddlewareStack(inner):
-    return JWTAuthMiddleware(AuthMiddlewareStack(inner))
+    return JWTAuthMiddleware(AuthMiddlewareStack(inner), ticket_inner=inner)
@@ -0,0 +1,106 @@
+# Generated by Django 4.2.7 on 2026-10-18 04:04
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+from django.db.models.functions import Coalesce
+
+
+def backfill_room_summaries(apps, schema_editor):
+    ChatRoom = apps.get_model('chat', 'ChatRoom')
+    ChatRoomMember = apps.get_model('chat', 'ChatRoomMember')
+    MessageMetadata = apps.get_model('chat', 'MessageMetadata')
+
+    latest = MessageMetadata.objects.filter(room=models.OuterRef('pk')).order_by('-created_at')
+    message_count = (
+        MessageMetadata.objects.filter(room=models.OuterRef('pk'))
+        .order_by().values('room').annotate(total=models.Count('pk')).values('total')
+    )
+    ChatRoom.objects.update(
+        last_message=models.Subquery(latest.values('pk')[:1]),
+        last_message_firebase_id=Coalesce(
+            models.Subquery(latest.values('firebase_message_id')[:1]), models.Value('')
+        ),
+        last_message_type=Coalesce(
+            models.Subquery(latest.values('message_type')[:1]), models.Value('')
+        ),
+        last_message_sender=models.Subquery(latest.values('sender')[:1]),
+        last_message_at=models.Subquery(latest.values('created_at')[:1]),
+        message_count=Coalesce(
+            models.Subquery(message_count, output_field=models.IntegerField()), 0
+        ),
+    )
+    ChatRoom.objects.update(
+        last_activity_at=Coalesce('last_message_at', 'updated_at')
+    )
+
+    unread_count = (
+        MessageMetadata.objects.filter(
+            room=models.OuterRef('room'), created_at__gt=models.OuterRef('last_read_at')
+        )
+        .exclude(sender=models.OuterRef('user'))
+        .order_by().values('room').annotate(total=models.Count('pk')).values('total')
+    )
+    ChatRoomMember.objects.update(
+        unread_count=Coalesce(
+            models.Subquery(unread_count, output_field=models.IntegerField()), 0
+        )
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('chat', '0004_merge_20250904_0002'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatroom',
+            name='last_activity_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name='chatroom',
+            name='last_message',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='chat.messagemetadata'),
+        ),
+        migrations.AddField(
+            model_name='chatroom',
+            name='last_message_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='chatroom',
+            name='last_message_firebase_id',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='chatroom',
+            name='last_message_preview',
+            field=models.CharField(blank=True, max_length=140),
+        ),
+        migrations.AddField(
+            model_name='chatroom',
+            name='last_message_sender',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='chatroom',
+            name='last_message_type',
+            field=models.CharField(blank=True, max_length=10),
+        ),
+        migrations.AddField(
+            model_name='chatroom',
+            name='message_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='chatroommember',
+            name='unread_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_room_summaries, migrations.RunPython.noop),
+    ]
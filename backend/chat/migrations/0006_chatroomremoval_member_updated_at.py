@@ -0,0 +1,34 @@
+# Generated by Django 4.2.7 on 2026-10-18 04:07
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('chat', '0005_chatroom_summary_member_unread_count'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatroommember',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.CreateModel(
+            name='ChatRoomRemoval',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('room_id', models.UUIDField()),
+                ('removed_at', models.DateTimeField(auto_now_add=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='room_removals', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'db_table': 'chat_room_removals',
+                'indexes': [models.Index(fields=['user', 'removed_at'], name='chat_room_r_user_id_cd60ac_idx')],
+            },
+        ),
+    ]
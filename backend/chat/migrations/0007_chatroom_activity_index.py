@@ -0,0 +1,17 @@
+# Generated by Django 4.2.7 on 2026-10-18 04:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0006_chatroomremoval_member_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='chatroom',
+            index=models.Index(fields=['-last_activity_at', '-id'], name='chat_rooms_activity_idx'),
+        ),
+    ]
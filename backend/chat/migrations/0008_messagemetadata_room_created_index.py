@@ -0,0 +1,17 @@
+# Generated by Django 4.2.7 on 2026-10-18 04:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0007_chatroom_activity_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='messagemetadata',
+            index=models.Index(fields=['room', '-created_at', '-id'], name='message_room_created_idx'),
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 4.2.7 on 2026-10-18 04:20
+
+from collections import defaultdict
+
+from django.db import migrations
+
+
+def backfill_direct_pairs(apps, schema_editor):
+    """
+    Set the pair key on direct rooms.
+
+    The pair is the creator plus the other member (one of them may have left).
+    Where several DMs share a pair, only the most recently active one gets the
+    key; the others keep NULL keys (which the unique constraint allows) and
+    stay as they are. Their messages live in their own Firestore collections,
+    so merging them here would make those conversations unreachable.
+    """
+    ChatRoom = apps.get_model('chat', 'ChatRoom')
+    ChatRoomMember = apps.get_model('chat', 'ChatRoomMember')
+
+    members = defaultdict(set)
+    for room_id, user_id in ChatRoomMember.objects.filter(room__room_type='direct').values_list('room_id', 'user_id'):
+        members[room_id].add(user_id)
+
+    keepers = {}
+    rooms = ChatRoom.objects.filter(room_type='direct').order_by('-last_activity_at', 'created_at')
+    for room in rooms:
+        participants = members[room.id] | {room.created_by_id}
+        if len(participants) == 2:
+            keepers.setdefault(tuple(sorted(participants)), room)
+
+    for (low, high), keeper in keepers.items():
+        keeper.dm_user_low_id, keeper.dm_user_high_id = low, high
+        keeper.save(update_fields=['dm_user_low', 'dm_user_high'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0009_chatroom_direct_pair'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_direct_pairs, migrations.RunPython.noop),
+    ]
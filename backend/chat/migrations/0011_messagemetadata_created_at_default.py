@@ -0,0 +1,19 @@
+# Generated by Django 4.2.7 on 2026-10-18 04:27
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0010_backfill_direct_pairs'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='messagemetadata',
+            name='created_at',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False),
+        ),
+    ]
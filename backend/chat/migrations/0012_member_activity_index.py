@@ -0,0 +1,38 @@
+# Generated by Django 4.2.7 on 2026-10-18 05:32
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+import django.utils.timezone
+
+
+def copy_room_activity(apps, schema_editor):
+    """Give every membership its room's last_activity_at."""
+    ChatRoom = apps.get_model('chat', 'ChatRoom')
+    ChatRoomMember = apps.get_model('chat', 'ChatRoomMember')
+    ChatRoomMember.objects.update(
+        last_activity_at=Subquery(ChatRoom.objects.filter(pk=OuterRef('room_id')).values('last_activity_at'))
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0011_messagemetadata_created_at_default'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='chatroom',
+            name='chat_rooms_activity_idx',
+        ),
+        migrations.AddField(
+            model_name='chatroommember',
+            name='last_activity_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.RunPython(copy_room_activity, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='chatroommember',
+            index=models.Index(fields=['user', '-last_activity_at', '-room'], name='chat_members_activity_idx'),
+        ),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 4.2.7 on 2026-10-18 09:10
+
+from django.db import migrations, models
+from django.db.models import F, OuterRef, Subquery
+from django.db.models.functions import Greatest
+
+
+def unread_to_read_counts(apps, schema_editor):
+    """Turn each stored unread counter into the matching read counter."""
+    ChatRoom = apps.get_model('chat', 'ChatRoom')
+    ChatRoomMember = apps.get_model('chat', 'ChatRoomMember')
+    message_count = Subquery(ChatRoom.objects.filter(pk=OuterRef('room_id')).values('message_count'))
+    ChatRoomMember.objects.update(read_message_count=Greatest(message_count - F('unread_count'), 0))
+
+
+def read_to_unread_counts(apps, schema_editor):
+    ChatRoom = apps.get_model('chat', 'ChatRoom')
+    ChatRoomMember = apps.get_model('chat', 'ChatRoomMember')
+    message_count = Subquery(ChatRoom.objects.filter(pk=OuterRef('room_id')).values('message_count'))
+    ChatRoomMember.objects.update(unread_count=Greatest(message_count - F('read_message_count'), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0012_member_activity_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatroommember',
+            name='read_message_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(unread_to_read_counts, read_to_unread_counts),
+        migrations.RemoveField(
+            model_name='chatroommember',
+            name='unread_count',
+        ),
+    ]
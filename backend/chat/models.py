@@ -1,10 +1,16 @@
+from django.conf import settings
 from django.db import models
 from django.contrib.auth import get_user_model
 from django.utils import timezone
 import uuid
+from collections import Counter
+from datetime import timedelta
 
 User = get_user_model()
 
+# Maximum length of the text snippet kept on ChatRoom for the rooms list
+LAST_MESSAGE_PREVIEW_LENGTH = 140
+
 
 class ChatRoom(models.Model):
     ROOM_TYPES = (
@@ -21,9 +27,40 @@ class ChatRoom(models.Model):
     members = models.ManyToManyField(User, through='ChatRoomMember', related_name='chat_rooms')
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+
+    # Summary of the latest message, maintained by record_message() so the
+    # rooms list never has to look at message_metadata.
+    last_message = models.ForeignKey(
+        'MessageMetadata', on_delete=models.SET_NULL, null=True, blank=True, related_name='+'
+    )
+    last_message_firebase_id = models.CharField(max_length=255, blank=True)
+    last_message_type = models.CharField(max_length=10, blank=True)
+    last_message_sender = models.ForeignKey(
+        User, on_delete=models.SET_NULL, null=True, blank=True, related_name='+'
+    )
+    last_message_preview = models.CharField(max_length=LAST_MESSAGE_PREVIEW_LENGTH, blank=True)
+    last_message_at = models.DateTimeField(null=True, blank=True)
+    message_count = models.PositiveIntegerField(default=0)
+    last_activity_at = models.DateTimeField(default=timezone.now)
+
+    # Canonical participant pair of a direct room (lower user id first). Unique
+    # among direct rooms, so opening a DM is a single indexed lookup.
+    dm_user_low = models.ForeignKey(
+        User, on_delete=models.SET_NULL, null=True, blank=True, related_name='+'
+    )
+    dm_user_high = models.ForeignKey(
+        User, on_delete=models.SET_NULL, null=True, blank=True, related_name='+'
+    )
     
     class Meta:
         db_table = 'chat_rooms'
+        constraints = [
+            models.UniqueConstraint(
+                fields=['dm_user_low', 'dm_user_high'],
+                condition=models.Q(room_type='direct'),
+                name='chat_rooms_direct_pair_uniq',
+            ),
+        ]
     
     def __str__(self):
         if self.room_type == 'direct':
@@ -32,11 +69,66 @@ class ChatRoom(models.Model):
                 return f"{members[0].full_name} & {members[1].full_name}"
         return self.name or f"Room {self.id}"
     
+    @staticmethod
+    def direct_pair(user_id, other_user_id):
+        """The (dm_user_low_id, dm_user_high_id) key of the DM between two users."""
+        return tuple(sorted((user_id, other_user_id)))
+
     @property
     def firebase_collection_name(self):
         """Returns the Firebase collection name for this chat room"""
         return f"chat_rooms_{self.id}"
 
+    def record_message(self, message, preview=''):
+        """
+        Update the room summary and the sender's read counter for a newly
+        created message. Call inside the transaction that created the message.
+        """
+        self.record_messages([message], preview)
+
+    def record_messages(self, messages, preview=''):
+        """
+        Batch form of record_message(): a constant number of UPDATEs however
+        many messages were created. ``preview`` belongs to the latest one.
+        """
+        if not messages:
+            return
+        now = timezone.now()
+        latest = max(messages, key=lambda message: (message.created_at, str(message.pk)))
+        ChatRoom.objects.filter(pk=self.pk).update(
+            message_count=models.F('message_count') + len(messages),
+            last_activity_at=now,
+            updated_at=now,
+        )
+        # Only move the summary forward so a slower concurrent write can't
+        # replace a newer last message with an older one.
+        ChatRoom.objects.filter(
+            models.Q(last_message_at__isnull=True) | models.Q(last_message_at__lte=latest.created_at),
+            pk=self.pk,
+        ).update(
+            last_message=latest,
+            last_message_firebase_id=latest.firebase_message_id,
+            last_message_type=latest.message_type,
+            last_message_sender_id=latest.sender_id,
+            last_message_preview=(preview or '')[:LAST_MESSAGE_PREVIEW_LENGTH],
+            last_message_at=latest.created_at,
+        )
+        # Unread counts are derived from message_count (see ChatRoomMember), so
+        # of the memberships only the senders' rows change: their read counters
+        # move past their own messages. The activity copies are rewritten only
+        # once they trail by ROOM_ACTIVITY_RESOLUTION, so a busy group costs at
+        # most one pass over its members per interval rather than per message.
+        sent = Counter(message.sender_id for message in messages)
+        stale = models.Q(last_activity_at__lt=now - timedelta(seconds=settings.ROOM_ACTIVITY_RESOLUTION))
+        ChatRoomMember.objects.filter(stale | models.Q(user_id__in=sent), room_id=self.pk).update(
+            read_message_count=models.F('read_message_count') + models.Case(
+                *[models.When(user_id=sender_id, then=count) for sender_id, count in sent.items()],
+                default=0,
+            ),
+            last_activity_at=models.Case(models.When(stale, then=now), default=models.F('last_activity_at')),
+            updated_at=now,
+        )
+
 
 class ChatRoomMember(models.Model):
     ROLES = (
@@ -49,14 +141,35 @@ class ChatRoomMember(models.Model):
     role = models.CharField(max_length=10, choices=ROLES, default='member')
     joined_at = models.DateTimeField(auto_now_add=True)
     last_read_at = models.DateTimeField(default=timezone.now)
+    # The room's message_count as of the member's last read, plus the messages
+    # they have sent since: unread_count is the difference
+    read_message_count = models.PositiveIntegerField(default=0)
+    # Copy of room.last_activity_at, kept by record_messages(), so a user's rooms
+    # list is one range scan of chat_members_activity_idx
+    last_activity_at = models.DateTimeField(default=timezone.now)
+    # Queryset .update() calls must set this explicitly; the changes feed relies on it
+    updated_at = models.DateTimeField(auto_now=True)
     
     class Meta:
         db_table = 'chat_room_members'
         unique_together = ('user', 'room')
+        indexes = [
+            # Serves rooms list pages: WHERE user_id = ? AND last_activity_at < ?
+            models.Index(fields=['user', '-last_activity_at', '-room'], name='chat_members_activity_idx'),
+        ]
     
     def __str__(self):
         return f"{self.user.full_name} in {self.room}"
 
+    @property
+    def unread_count(self):
+        return max(self.room.message_count - self.read_message_count, 0)
+
+
+def room_message_count():
+    """The message_count of a membership's room, for ChatRoomMember updates."""
+    return models.Subquery(ChatRoom.objects.filter(pk=models.OuterRef('room_id')).values('message_count'))
+
 
 class MessageMetadata(models.Model):
     """Stores message metadata in PostgreSQL while actual messages are in Firebase"""
@@ -72,13 +185,33 @@ class MessageMetadata(models.Model):
     room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE, related_name='messages')
     sender = models.ForeignKey(User, on_delete=models.CASCADE, related_name='sent_messages')
     message_type = models.CharField(max_length=10, choices=MESSAGE_TYPES, default='text')
-    created_at = models.DateTimeField(auto_now_add=True)
+    # Not auto_now_add: the write-behind worker stores the time a send was queued
+    created_at = models.DateTimeField(default=timezone.now, editable=False)
     
     class Meta:
         db_table = 'message_metadata'
         ordering = ['-created_at']
+        indexes = [
+            # Serves history pages: WHERE room_id = ? AND (created_at, id) < (?, ?)
+            models.Index(fields=['room', '-created_at', '-id'], name='message_room_created_idx'),
+        ]
     
     def __str__(self):
         return f"Message {self.firebase_message_id} in {self.room}"
 
 
+
+
+class ChatRoomRemoval(models.Model):
+    """Tombstone telling the changes feed that a user lost access to a room"""
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='room_removals')
+    # Plain UUID rather than a FK so the tombstone outlives a deleted room
+    room_id = models.UUIDField()
+    removed_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        db_table = 'chat_room_removals'
+        indexes = [models.Index(fields=['user', 'removed_at'])]
+
+    def __str__(self):
+        return f"{self.user_id} removed from {self.room_id}"
@@ -0,0 +1,272 @@
+"""
+Per-connection flow control of outbound websocket events.
+
+Backpressure
+------------
+A consumer's handlers run one at a time, so a client that reads slowly
+stalls its consumer on ``send`` and its events pile up in the channel layer
+until channels_redis drops them silently at capacity. Chat sockets instead
+put events on an OutboundQueue, bounded at WS_OUTBOUND_QUEUE_SIZE, and a
+writer task delivers them in order. While events wait:
+
+- a newer typing state or watermark update replaces (coalesces with) the
+  one still queued for the same room and user; a per-message receipt only
+  replaces an identical one still queued, since each marks its own message;
+- typing is shed once the queue is half full, and receipts once it is full;
+- a chat message or control event arriving at a full queue evicts the
+  oldest queued typing event, else the oldest receipt;
+- if the queue is full of chat messages, the client is persistently too
+  slow: its backlog is dropped, it is sent a ``resync`` event and the socket
+  is closed with RESYNC_CLOSE_CODE, telling the client to reconnect and
+  reload state over HTTP.
+
+Drops, coalescing and slow-client disconnects are counted per reason, per
+connection and process-wide in ``counters``; connections that lost events
+log their counts to flowchat.metrics on disconnect, and the process totals
+are logged there as they change, at most every WS_OUTBOUND_STATS_INTERVAL
+seconds. A delivery that fails closes the socket with DELIVERY_FAILED_CLOSE_CODE.
+
+Batching
+--------
+In a busy room every member's consumer sends one frame per chat message,
+typing indicator and receipt. With WS_BATCH_WINDOW set, chat sockets opened
+with ``?batch=1`` hand their events to an OutboundBatcher instead: the first
+event of a batch starts a WS_BATCH_WINDOW-second timer, events arriving
+meanwhile join it, and the batch goes out as a single array frame when the
+timer fires or once it holds WS_BATCH_MAX_EVENTS events. No event waits
+longer than the window, and a window with a single event sends it as a plain
+frame, so opted-in clients must accept both shapes.
+"""
+import asyncio
+import logging
+import time
+import urllib.parse
+from collections import Counter, deque
+
+from django.conf import settings
+
+from .receipts import merge_watermarks
+
+logger = logging.getLogger('flowchat.metrics')
+error_logger = logging.getLogger(__name__)
+
+# Close code for clients disconnected for falling behind; they should
+# reconnect and resync rather than back off
+RESYNC_CLOSE_CODE = 4008
+# Close code for sockets whose writer failed to send an event
+DELIVERY_FAILED_CLOSE_CODE = 1011
+
+# Lower is more important; events not listed (chat messages, subscription
+# replies, errors) are never dropped
+PRIORITY = {
+    'read_receipts': 1,
+    'read_receipt': 1,
+    'typing_indicator': 2,
+}
+
+# Process-wide totals of OutboundQueue.counters, and what report_totals() last logged
+counters = Counter()
+_last_report = {'at': None, 'totals': {}}
+
+
+def report_totals(now=None):
+    """
+    Log the process-wide totals to flowchat.metrics if they changed since the
+    last report and WS_OUTBOUND_STATS_INTERVAL seconds have passed; returns
+    whether they were logged.
+    """
+    now = time.monotonic() if now is None else now
+    if _last_report['at'] is not None and now - _last_report['at'] < settings.WS_OUTBOUND_STATS_INTERVAL:
+        return False
+    totals = dict(counters)
+    if totals == _last_report['totals']:
+        return False
+    _last_report.update(at=now, totals=totals)
+    logger.info("ws outbound totals %s", ' '.join(f'{reason}={n}' for reason, n in sorted(totals.items())))
+    return True
+
+
+def wants_batches(scope):
+    """Whether batching is enabled and the client asked for it with ``?batch=1``."""
+    if settings.WS_BATCH_WINDOW <= 0:
+        return False
+    params = urllib.parse.parse_qs(scope.get('query_string', b'').decode())
+    return params.get('batch', [''])[-1] in ('1', 'true')
+
+
+class OutboundBatcher:
+    """
+    Pending outbound events of one connection. ``send_batch`` is a coroutine
+    function that sends a list of events as one frame.
+    """
+
+    def __init__(self, send_batch, window=None, max_events=None):
+        self.send_batch = send_batch
+        self.window = window if window is not None else settings.WS_BATCH_WINDOW
+        self.max_events = max_events or settings.WS_BATCH_MAX_EVENTS
+        self.events = []
+        self._timer = None
+
+    async def add(self, event):
+        self.events.append(event)
+        if len(self.events) >= self.max_events:
+            await self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.ensure_future(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.window)
+        self._timer = None
+        await self.flush()
+
+    async def flush(self):
+        """Send the pending events now."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        events, self.events = self.events, []
+        if events:
+            await self.send_batch(events)
+
+    def discard(self):
+        """Drop the pending events (the socket is gone)."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self.events = []
+
+
+def _coalesce_key(payload):
+    event_type = payload.get('type')
+    if event_type == 'typing_indicator':
+        return (event_type, payload.get('room_id'), payload.get('user_id'))
+    if event_type == 'read_receipt':
+        # Legacy clients mark only the receipt's own message read
+        return (event_type, payload.get('room_id'), payload.get('user_id'), payload.get('firebase_message_id'))
+    if event_type == 'read_receipts':
+        return (event_type, payload.get('room_id'))
+    return None
+
+
+def _coalesce(queued, payload):
+    if payload.get('type') == 'read_receipts':
+        # Watermarks only move forward: the furthest one of each reader wins
+        return merge_watermarks(queued, payload)
+    return payload
+
+
+class _Entry:
+    __slots__ = ('priority', 'key', 'payload')
+
+    def __init__(self, priority, key, payload):
+        self.priority = priority
+        self.key = key
+        self.payload = payload
+
+
+class OutboundQueue:
+    """
+    Bounded outbound events of one connection. ``deliver`` is a coroutine
+    function sending one event to the client; ``close`` is one closing the
+    socket with a close code.
+    """
+
+    def __init__(self, deliver, close, capacity=None):
+        self.deliver = deliver
+        self.close = close
+        self.capacity = capacity or settings.WS_OUTBOUND_QUEUE_SIZE
+        self.entries = deque()
+        self.queued = {}  # coalesce key -> queued entry
+        self.counters = Counter()
+        self.closing = False
+        self._ready = asyncio.Event()
+        self._writer = asyncio.ensure_future(self._drain())
+
+    def count(self, reason):
+        self.counters[reason] += 1
+        counters[reason] += 1
+        report_totals()
+
+    def put(self, payload):
+        """Queue an event for delivery, applying the drop and coalesce policies."""
+        if self.closing:
+            return
+        event_type = payload.get('type')
+        priority = PRIORITY.get(event_type, 0)
+        key = _coalesce_key(payload)
+        queued = self.queued.get(key) if key else None
+        if queued is not None:
+            queued.payload = _coalesce(queued.payload, payload)
+            self.count(f'coalesced.{event_type}')
+            return
+
+        size = len(self.entries)
+        shed_at = self.capacity // 2 if priority == 2 else self.capacity
+        if priority and size >= shed_at:
+            self.count(f'dropped.{event_type}')
+            return
+        if size >= self.capacity and not self._evict():
+            self._overflow()
+            return
+
+        entry = _Entry(priority, key, payload)
+        self.entries.append(entry)
+        if key:
+            self.queued[key] = entry
+        self._ready.set()
+
+    def _evict(self):
+        for priority in sorted(set(PRIORITY.values()), reverse=True):
+            for entry in self.entries:
+                if entry.priority == priority:
+                    self._forget(entry)
+                    self.entries.remove(entry)
+                    self.count(f'dropped.{entry.payload.get("type")}')
+                    return True
+        return False
+
+    def _forget(self, entry):
+        if entry.key and self.queued.get(entry.key) is entry:
+            del self.queued[entry.key]
+
+    def _overflow(self):
+        self.count('disconnected.slow_client')
+        self.entries.clear()
+        self.queued.clear()
+        self.closing = True
+        self.entries.append(_Entry(0, None, {'type': 'resync', 'reason': 'slow_consumer'}))
+        self._ready.set()
+
+    async def _drain(self):
+        while True:
+            if not self.entries:
+                if self.closing:
+                    await self.close(RESYNC_CLOSE_CODE)
+                    return
+                self._ready.clear()
+                await self._ready.wait()
+                continue
+            entry = self.entries.popleft()
+            self._forget(entry)
+            try:
+                await self.deliver(entry.payload)
+            except Exception:
+                # Without this the writer would die silently, leaving the
+                # socket open with nothing sending to it
+                error_logger.exception("ws outbound delivery of %s failed", entry.payload.get('type'))
+                self.count('disconnected.delivery_failed')
+                self.closing = True
+                self.entries.clear()
+                self.queued.clear()
+                await self.close(DELIVERY_FAILED_CLOSE_CODE)
+                return
+
+    def discard(self, label=''):
+        """Stop delivering (the socket is gone) and log any losses."""
+        self._writer.cancel()
+        self.entries.clear()
+        self.queued.clear()
+        if any(reason.startswith(('dropped.', 'disconnected.')) for reason in self.counters):
+            counts = [f'{reason}={n}' for reason, n in sorted(self.counters.items())]
+            logger.info("ws outbound %s", ' '.join([label, *counts] if label else counts))
+        report_totals()
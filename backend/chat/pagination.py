@@ -0,0 +1,17 @@
+from rest_framework.pagination import CursorPagination
+
+
+class RoomCursorPagination(CursorPagination):
+    """
+    Keyset pagination for the rooms list, newest activity first.
+
+    Rooms are ordered by ``activity_at``, the user's membership copy of the
+    room's last activity (see ChatRoomListView.get_queryset). Pages are
+    fetched with ``WHERE user_id = <user> AND last_activity_at < <cursor>``
+    on chat_room_members, a range scan of chat_members_activity_idx, so page N
+    costs the same as page 1 and no COUNT(*) is issued. The id tie-breaker
+    keeps the order stable.
+    """
+    ordering = ('-activity_at', '-id')
+    page_size_query_param = 'page_size'
+    max_page_size = 100
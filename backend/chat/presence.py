@@ -0,0 +1,192 @@
+"""
+Connection-refcounted presence.
+
+With PRESENCE_TRACKER enabled, chat sockets no longer write the users row on
+connect and disconnect. Each socket instead holds a lease in Redis on its
+user's sorted set of connections (member: channel name, score: expiry),
+renewed by client heartbeats. Only the first connection opening and the last
+one closing or expiring count as presence changes; those are recorded in a
+hash, newest per user, and ``manage.py flush_presence`` applies them in
+batched UPDATEs every PRESENCE_FLUSH_INTERVAL seconds. A worker that dies
+without running disconnect() leaves leases that simply expire: the flush
+sweeps them and marks the user offline as of their last heartbeat.
+"""
+import logging
+import time
+from datetime import datetime, timezone as dt_timezone
+from functools import lru_cache
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from redis.exceptions import ResponseError
+
+from flowchat.redis_client import get_redis
+
+User = get_user_model()
+logger = logging.getLogger('flowchat.metrics')
+
+
+def prefix():
+    return settings.PRESENCE_PREFIX
+
+
+def active_key():
+    """user id -> latest lease expiry of any of their connections"""
+    return f'{prefix()}:active'
+
+
+def transitions_key():
+    """user id -> "<1|0>:<timestamp>", the newest unapplied change"""
+    return f'{prefix()}:transitions'
+
+
+def flushing_key():
+    """Transitions being applied; left in place if a flush dies half-way and retried"""
+    return f'{transitions_key()}:flushing'
+
+
+# Opens or renews a lease; the user comes online if it is their only live one
+_OPEN = """
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[2])
+local live = redis.call('ZCARD', KEYS[1])
+redis.call('ZADD', KEYS[1], ARGV[3], ARGV[1])
+redis.call('EXPIREAT', KEYS[1], math.ceil(tonumber(ARGV[3])))
+redis.call('ZADD', KEYS[2], 'GT', ARGV[3], ARGV[4])
+if live == 0 then
+  redis.call('HSET', KEYS[3], ARGV[4], '1:' .. ARGV[2])
+end
+return live
+"""
+
+# Drops a lease; the user goes offline if it was their last live one
+_CLOSE = """
+local removed = redis.call('ZREM', KEYS[1], ARGV[1])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[2])
+if removed == 1 and redis.call('ZCARD', KEYS[1]) == 0 then
+  redis.call('HSET', KEYS[3], ARGV[3], '0:' .. ARGV[2])
+  redis.call('ZREM', KEYS[2], ARGV[3])
+end
+return removed
+"""
+
+# Marks users whose every lease has expired offline as of their last heartbeat
+_SWEEP = """
+local swept = 0
+local users = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'WITHSCORES', 'LIMIT', 0, ARGV[2])
+for i = 1, #users, 2 do
+  local leases = ARGV[4] .. users[i]
+  redis.call('ZREMRANGEBYSCORE', leases, '-inf', ARGV[1])
+  local newest = redis.call('ZRANGE', leases, -1, -1, 'WITHSCORES')
+  if #newest == 0 then
+    local last_seen = tonumber(users[i + 1]) - tonumber(ARGV[3])
+    redis.call('HSET', KEYS[2], users[i], '0:' .. string.format('%.6f', last_seen))
+    redis.call('ZREM', KEYS[1], users[i])
+    swept = swept + 1
+  else
+    redis.call('ZADD', KEYS[1], newest[2], users[i])
+  end
+end
+return swept
+"""
+
+
+def is_enabled():
+    return settings.PRESENCE_TRACKER
+
+
+def leases_key(user_id):
+    return f'{prefix()}:leases:{user_id}'
+
+
+@lru_cache(maxsize=None)
+def _script(source):
+    return get_redis().register_script(source)
+
+
+def connection_opened(user_id, connection_id):
+    """Take (or renew) a lease for one connection; raises redis.RedisError."""
+    now = time.time()
+    _script(_OPEN)(
+        keys=[leases_key(user_id), active_key(), transitions_key()],
+        args=[connection_id, f'{now:.6f}', f'{now + settings.PRESENCE_LEASE_TTL:.6f}', user_id],
+    )
+
+
+# A heartbeat is a renewal; it also re-opens a lease that expired meanwhile
+heartbeat = connection_opened
+
+
+def connection_closed(user_id, connection_id):
+    """Release a connection's lease; raises redis.RedisError."""
+    _script(_CLOSE)(
+        keys=[leases_key(user_id), active_key(), transitions_key()],
+        args=[connection_id, f'{time.time():.6f}', user_id],
+    )
+
+
+def sweep_expired(client=None, limit=None):
+    """Record users whose leases all expired as offline; returns how many."""
+    return _script(_SWEEP)(
+        keys=[active_key(), transitions_key()],
+        args=[
+            f'{time.time():.6f}', limit or settings.PRESENCE_BATCH_SIZE,
+            settings.PRESENCE_LEASE_TTL, leases_key(''),
+        ],
+        client=client,
+    )
+
+
+def take_transitions(client):
+    """The changes to apply: those of an interrupted flush, else all recorded."""
+    if not client.exists(flushing_key()):
+        try:
+            client.rename(transitions_key(), flushing_key())
+        except ResponseError:
+            # Nothing recorded
+            return {}
+    transitions = {}
+    for user_id, change in client.hgetall(flushing_key()).items():
+        online, at = change.split(':', 1)
+        transitions[int(user_id)] = (online == '1', datetime.fromtimestamp(float(at), tz=dt_timezone.utc))
+    return transitions
+
+
+def apply_transitions(transitions):
+    """
+    Persist presence changes: ``transitions`` maps user id to (online, at).
+    Users coming online are set online in one UPDATE; users going offline get
+    their own last_seen in batched UPDATEs. Returns the number of rows written.
+    """
+    updated = 0
+    online_ids = [user_id for user_id, (online, _) in transitions.items() if online]
+    if online_ids:
+        # Already-online users are left alone so reconnects don't rewrite rows
+        updated += User.objects.filter(id__in=online_ids, is_online=False).update(is_online=True)
+
+    offline = [
+        User(id=user_id, is_online=False, last_seen=at)
+        for user_id, (online, at) in transitions.items() if not online
+    ]
+    updated += User.objects.bulk_update(
+        offline, ['is_online', 'last_seen'], batch_size=settings.PRESENCE_BATCH_SIZE
+    )
+    return updated
+
+
+def flush(client=None):
+    """Sweep expired leases and apply every recorded change; returns rows written."""
+    client = client or get_redis()
+    started = time.perf_counter()
+    swept = sweep_expired(client)
+    transitions = take_transitions(client)
+    if not transitions:
+        return 0
+    with transaction.atomic():
+        updated = apply_transitions(transitions)
+    client.delete(flushing_key())
+    logger.info(
+        "presence flush transitions=%d expired=%d updated=%d flush_ms=%.1f",
+        len(transitions), swept, updated, (time.perf_counter() - started) * 1000,
+    )
+    return updated
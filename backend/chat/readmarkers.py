@@ -0,0 +1,142 @@
+"""
+Buffered read markers.
+
+With READ_MARKER_BUFFER enabled, mark_messages_read stores the read time in the
+Redis hash at READ_MARKER_BUFFER_KEY, keyed by ``<user_id>:<room_id>``,
+keeping only the newest time per pair, and returns without touching
+PostgreSQL. ``manage.py flush_read_markers`` moves the hash aside every READ_MARKER_FLUSH_INTERVAL seconds and applies it
+with apply_read_markers(): one query to load the memberships and batched
+UPDATEs to write them.
+"""
+import logging
+import time
+import uuid
+from datetime import datetime, timezone as dt_timezone
+from functools import lru_cache
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, IntegerField, Subquery
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from redis.exceptions import ResponseError
+
+from flowchat.redis_client import get_redis
+from .inbox import bump_inbox_versions, notify_users
+from .models import ChatRoomMember, MessageMetadata, room_message_count
+
+logger = logging.getLogger('flowchat.metrics')
+
+
+def buffer_key():
+    return settings.READ_MARKER_BUFFER_KEY
+
+
+def flushing_key():
+    """Markers being applied; left in place if a flush dies half-way and retried"""
+    return f'{buffer_key()}:flushing'
+
+
+_KEEP_NEWEST = """
+local current = redis.call('HGET', KEYS[1], ARGV[1])
+if not current or tonumber(current) < tonumber(ARGV[2]) then
+  redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+end
+"""
+
+
+def is_enabled():
+    return settings.READ_MARKER_BUFFER
+
+
+@lru_cache(maxsize=None)
+def _keep_newest():
+    return get_redis().register_script(_KEEP_NEWEST)
+
+
+def buffer_read_marker(user_id, room_id):
+    """Record that the user has read the room up to now; raises redis.RedisError."""
+    _keep_newest()(keys=[buffer_key()], args=[f'{user_id}:{room_id}', f'{time.time():.6f}'])
+
+
+def take_markers(client):
+    """The markers to apply: those of an interrupted flush, else the whole buffer."""
+    if not client.exists(flushing_key()):
+        try:
+            client.rename(buffer_key(), flushing_key())
+        except ResponseError:
+            # Nothing buffered
+            return {}
+    markers = {}
+    for pair, read_at in client.hgetall(flushing_key()).items():
+        user_id, room_id = pair.split(':', 1)
+        markers[(int(user_id), uuid.UUID(room_id))] = datetime.fromtimestamp(float(read_at), tz=dt_timezone.utc)
+    return markers
+
+
+def _read_count_at(membership, read_at):
+    """
+    The membership's read counter once the marker lands: the room's
+    message_count less the messages from others after ``read_at``.
+    """
+    newer = (
+        MessageMetadata.objects.filter(room_id=membership.room_id, created_at__gt=read_at)
+        .exclude(sender_id=membership.user_id)
+        .order_by().values('room_id').annotate(total=Count('pk')).values('total')
+    )
+    return room_message_count() - Coalesce(Subquery(newer, output_field=IntegerField()), 0)
+
+
+def apply_read_markers(markers):
+    """
+    Move memberships' last_read_at forward to the given times and catch
+    their read counters up. ``markers`` maps (user_id, room_id) to a datetime;
+    markers older than the stored last_read_at and non-members are ignored.
+    Returns the number of memberships updated. Call inside a transaction.
+    """
+    if not markers:
+        return 0
+    memberships = ChatRoomMember.objects.filter(
+        user_id__in={user_id for user_id, _ in markers},
+        room_id__in={room_id for _, room_id in markers},
+    ).only('id', 'user_id', 'room_id', 'last_read_at')
+
+    now = timezone.now()
+    changed = []
+    rooms_by_user = {}
+    for membership in memberships:
+        read_at = markers.get((membership.user_id, membership.room_id))
+        if read_at is None or read_at <= membership.last_read_at:
+            continue
+        membership.last_read_at = read_at
+        # Not simply message_count: messages may have arrived between the read and the flush
+        membership.read_message_count = _read_count_at(membership, read_at)
+        membership.updated_at = now
+        changed.append(membership)
+        rooms_by_user.setdefault(membership.user_id, []).append(str(membership.room_id))
+
+    ChatRoomMember.objects.bulk_update(
+        changed, ['last_read_at', 'read_message_count', 'updated_at'],
+        batch_size=settings.READ_MARKER_BATCH_SIZE,
+    )
+    bump_inbox_versions(rooms_by_user.keys())
+    for user_id, room_ids in rooms_by_user.items():
+        notify_users([user_id], {'event': 'rooms_read', 'room_ids': room_ids})
+    return len(changed)
+
+
+def flush(client=None):
+    """Apply everything buffered so far; returns the number of memberships updated."""
+    client = client or get_redis()
+    started = time.perf_counter()
+    markers = take_markers(client)
+    if not markers:
+        return 0
+    with transaction.atomic():
+        updated = apply_read_markers(markers)
+    client.delete(flushing_key())
+    logger.info(
+        "read-marker flush markers=%d updated=%d flush_ms=%.1f",
+        len(markers), updated, (time.perf_counter() - started) * 1000,
+    )
+    return updated
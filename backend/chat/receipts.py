@@ -0,0 +1,101 @@
+"""
+Read-receipt watermark aggregation.
+
+Clients in watermark mode report "read up to message X" (``read_up_to``)
+instead of one ``read_receipt`` per message. ChatConsumer hands each report
+to the process-wide ``watermarks`` aggregator, which keeps only the furthest
+watermark per reader and, once per READ_RECEIPT_WINDOW seconds per room,
+broadcasts a single ``read_receipts`` event mapping reader ids to their
+watermark. Channel-layer traffic is then one event per room per window from
+each server process, however many messages and readers there are.
+
+Reports may carry the read message's ``timestamp`` (any number that orders
+messages, e.g. milliseconds since the epoch). Events then also map readers to
+it under ``timestamps``, and a report older than one already pending for the
+same reader, from another tab or server process, never replaces it. Reports
+without one are ordered by arrival.
+"""
+import asyncio
+import logging
+
+from django.conf import settings
+
+from .inbox import room_group_name
+
+logger = logging.getLogger(__name__)
+
+
+def is_behind(timestamp, current):
+    """Whether a watermark at ``timestamp`` is older than one at ``current``."""
+    return timestamp is not None and current is not None and timestamp < current
+
+
+def merge_watermarks(queued, payload):
+    """
+    The ``read_receipts`` payload combining two for the same room, keeping
+    each reader's furthest watermark.
+    """
+    receipts = dict(queued['receipts'])
+    timestamps = dict(queued.get('timestamps', {}))
+    for user_id, watermark in payload['receipts'].items():
+        timestamp = payload.get('timestamps', {}).get(user_id)
+        if is_behind(timestamp, timestamps.get(user_id)):
+            continue
+        receipts[user_id] = watermark
+        if timestamp is None:
+            timestamps.pop(user_id, None)
+        else:
+            timestamps[user_id] = timestamp
+    merged = {**payload, 'receipts': receipts}
+    if timestamps:
+        merged['timestamps'] = timestamps
+    return merged
+
+
+class WatermarkAggregator:
+
+    def __init__(self, window=None):
+        self._window = window
+        # room id -> {'receipts': {user id: firebase message id}, 'timestamps': {user id: timestamp}}
+        self.pending = {}
+        self._flushes = {}  # room id -> scheduled flush task
+
+    @property
+    def window(self):
+        return self._window if self._window is not None else settings.READ_RECEIPT_WINDOW
+
+    def add(self, channel_layer, room_id, user_id, firebase_message_id, timestamp=None):
+        """Record a reader's watermark; the room's next flush broadcasts it."""
+        room_id, user_id = str(room_id), str(user_id)
+        pending = self.pending.setdefault(room_id, {'receipts': {}, 'timestamps': {}})
+        timestamps = pending['timestamps']
+        if is_behind(timestamp, timestamps.get(user_id)):
+            return
+        pending['receipts'][user_id] = firebase_message_id
+        if timestamp is None:
+            timestamps.pop(user_id, None)
+        else:
+            timestamps[user_id] = timestamp
+        if room_id not in self._flushes:
+            self._flushes[room_id] = asyncio.ensure_future(self._flush_later(channel_layer, room_id))
+
+    async def _flush_later(self, channel_layer, room_id):
+        try:
+            await asyncio.sleep(self.window)
+        finally:
+            # Reports arriving from here on start the next window
+            self._flushes.pop(room_id, None)
+            pending = self.pending.pop(room_id, None)
+        if not pending:
+            return
+        event = {'type': 'read_receipts', 'room_id': room_id, 'receipts': pending['receipts']}
+        if pending['timestamps']:
+            event['timestamps'] = pending['timestamps']
+        try:
+            await channel_layer.group_send(room_group_name(room_id), event)
+        except Exception:
+            # Receipts are advisory; the next report from each reader repairs the gap
+            logger.warning("Failed to broadcast read receipts to room %s", room_id, exc_info=True)
+
+
+watermarks = WatermarkAggregator()
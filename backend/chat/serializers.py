@@ -1,24 +1,42 @@
 from rest_framework import serializers
 from django.contrib.auth import get_user_model
-from django.db.models import Count
+from django.db import transaction
+from django.db.models import Count, Q
+from .inbox import bump_inbox_versions, bump_room_inboxes, record_room_removals, room_event
+from .membership import invalidate_memberships, membership_role
 from .models import ChatRoom, ChatRoomMember, MessageMetadata
-from accounts.serializers import UserListSerializer
+from accounts.serializers import ContactSerializer, UserListSerializer
 
 User = get_user_model()
 
 
 class ChatRoomMemberSerializer(serializers.ModelSerializer):
-    user = UserListSerializer(read_only=True)
+    user = ContactSerializer(read_only=True)
     
     class Meta:
         model = ChatRoomMember
         fields = ('user', 'role', 'joined_at', 'last_read_at')
 
 
+class RoomLastMessageSerializer(serializers.Serializer):
+    """Renders the last-message summary columns kept on ChatRoom."""
+    id = serializers.UUIDField(source='last_message_id')
+    firebase_message_id = serializers.CharField(source='last_message_firebase_id')
+    room = serializers.UUIDField(source='id')
+    sender = ContactSerializer(source='last_message_sender', allow_null=True)
+    message_type = serializers.CharField(source='last_message_type')
+    preview = serializers.CharField(source='last_message_preview')
+    read_by = serializers.SerializerMethodField()
+    created_at = serializers.DateTimeField(source='last_message_at')
+
+    def get_read_by(self, obj):
+        return []
+
+
 class ChatRoomSerializer(serializers.ModelSerializer):
-    # Correct reverse relation name for the through model is 'chatroommember_set'
-    members = ChatRoomMemberSerializer(source='chatroommember_set', many=True, read_only=True)
-    created_by = UserListSerializer(read_only=True)
+    # Memberships come from the through model's 'chatroommember_set' (see get_members)
+    members = serializers.SerializerMethodField()
+    created_by = ContactSerializer(read_only=True)
     member_count = serializers.SerializerMethodField()
     last_message = serializers.SerializerMethodField()
     unread_count = serializers.SerializerMethodField()
@@ -29,6 +47,9 @@ class ChatRoomSerializer(serializers.ModelSerializer):
     remove_member_ids = serializers.ListField(
         child=serializers.IntegerField(), write_only=True, required=False
     )
+    # Set by update(); omitted from other responses
+    skipped_add_member_ids = serializers.ListField(child=serializers.IntegerField(), read_only=True)
+    skipped_remove_member_ids = serializers.ListField(child=serializers.IntegerField(), read_only=True)
     
     class Meta:
         model = ChatRoom
@@ -36,27 +57,40 @@ class ChatRoomSerializer(serializers.ModelSerializer):
             'id', 'name', 'room_type', 'description', 'avatar_url', 'created_by', 
             'members', 'member_count', 'last_message', 'unread_count',
             'created_at', 'updated_at', 'firebase_collection_name',
-            'add_member_ids', 'remove_member_ids'
+            'add_member_ids', 'remove_member_ids',
+            'skipped_add_member_ids', 'skipped_remove_member_ids'
         )
         read_only_fields = ('id', 'created_by', 'created_at', 'updated_at')
     
+    def get_members(self, obj):
+        memberships = obj.chatroommember_set.all()
+        if 'chatroommember_set' not in getattr(obj, '_prefetched_objects_cache', {}):
+            # Not prefetched by the view: fetch users in the same query, not one per member
+            memberships = memberships.select_related('user')
+        return ChatRoomMemberSerializer(memberships, many=True).data
+
+    # The rooms list annotates member_count_value and unread_count_value
+    # (see ChatRoomListView); other callers fall back to a query.
     def get_member_count(self, obj):
+        if hasattr(obj, 'member_count_value'):
+            return obj.member_count_value
         return obj.members.count()
     
     def get_last_message(self, obj):
-        last_message = obj.messages.first()
-        if last_message:
-            return MessageMetadataSerializer(last_message).data
+        if obj.last_message_id:
+            return RoomLastMessageSerializer(obj).data
         return None
     
     def get_unread_count(self, obj):
+        if hasattr(obj, 'unread_count_value'):
+            return obj.unread_count_value
         request = self.context.get('request')
         if request and request.user.is_authenticated:
             try:
-                member = obj.chatroommember_set.get(user=request.user)
-                return obj.messages.filter(created_at__gt=member.last_read_at).count()
+                membership = obj.chatroommember_set.get(user=request.user)
             except ChatRoomMember.DoesNotExist:
                 return 0
+            return max(obj.message_count - membership.read_message_count, 0)
 
     def update(self, instance, validated_data):
         request = self.context.get('request')
@@ -64,12 +98,11 @@ class ChatRoomSerializer(serializers.ModelSerializer):
             raise serializers.ValidationError('Authentication required')
 
         # Only admins can modify group data
-        try:
-            membership = ChatRoomMember.objects.get(user=request.user, room=instance)
-        except ChatRoomMember.DoesNotExist:
+        role = membership_role(request.user.id, instance.id)
+        if role is None:
             raise serializers.ValidationError('Not a member of this room')
 
-        if membership.role != 'admin':
+        if role != 'admin':
             raise serializers.ValidationError('Only admins can modify this room')
 
         # Basic fields
@@ -84,34 +117,67 @@ class ChatRoomSerializer(serializers.ModelSerializer):
             instance.avatar_url = avatar_url
 
         # Member management
-        add_ids = validated_data.pop('add_member_ids', [])
-        remove_ids = validated_data.pop('remove_member_ids', [])
+        add_ids = list(dict.fromkeys(validated_data.pop('add_member_ids', [])))
+        remove_ids = list(dict.fromkeys(validated_data.pop('remove_member_ids', [])))
 
-        # Add members
-        for uid in add_ids:
-            try:
-                u = User.objects.get(id=uid)
-            except User.DoesNotExist:
-                continue
-            ChatRoomMember.objects.get_or_create(user=u, room=instance, defaults={'role': 'member'})
+        with transaction.atomic():
+            added_ids = self._add_members(instance, add_ids)
+            removed_ids = self._remove_members(instance, remove_ids, request.user)
+            # Only the edited columns: the summary columns kept by record_message
+            # may have moved since the room was loaded
+            instance.save(update_fields=['name', 'description', 'avatar_url', 'updated_at'])
+            bump_room_inboxes([instance.id], room_event('room_updated', instance.id))
+            record_room_removals(instance.id, removed_ids)
 
-        # Remove members (prevent removing self if sole admin)
-        for uid in remove_ids:
-            try:
-                m = ChatRoomMember.objects.get(user_id=uid, room=instance)
-            except ChatRoomMember.DoesNotExist:
-                continue
-            # Prevent removing the last admin
-            if m.role == 'admin':
-                admin_count = ChatRoomMember.objects.filter(room=instance, role='admin').count()
-                if admin_count <= 1:
-                    # skip removing last admin
-                    continue
-            m.delete()
-
-        instance.save()
+        # Reported back so clients can tell which ids had no effect
+        instance.skipped_add_member_ids = [uid for uid in add_ids if uid not in added_ids]
+        instance.skipped_remove_member_ids = [uid for uid in remove_ids if uid not in removed_ids]
         return instance
 
+    def _add_members(self, room, user_ids):
+        """Add existing, not-yet-member users in one INSERT; returns the ids added."""
+        if not user_ids:
+            return set()
+        new_ids = set(
+            User.objects.filter(id__in=user_ids)
+            .exclude(chatroommember__room=room)
+            .values_list('id', flat=True)
+        )
+        # ignore_conflicts covers a concurrent add of the same user
+        ChatRoomMember.objects.bulk_create(
+            [
+                ChatRoomMember(
+                    user_id=uid, room=room, role='member',
+                    last_activity_at=room.last_activity_at, read_message_count=room.message_count,
+                )
+                for uid in user_ids if uid in new_ids
+            ],
+            ignore_conflicts=True,
+        )
+        invalidate_memberships(new_ids)
+        return new_ids
+
+    def _remove_members(self, room, user_ids, acting_user):
+        """Remove members in one DELETE, never the room's last admin; returns the ids removed."""
+        if not user_ids:
+            return []
+        # Lock the rows the admin check reads so concurrent removals can't both pass it
+        roles = dict(
+            ChatRoomMember.objects.select_for_update()
+            .filter(room=room)
+            .filter(Q(user_id__in=user_ids) | Q(role='admin'))
+            .values_list('user_id', 'role')
+        )
+        removable = [uid for uid in user_ids if uid in roles]
+        admin_ids = {uid for uid, role in roles.items() if role == 'admin'}
+        if admin_ids and admin_ids.issubset(removable):
+            # Removing every admin would orphan the room; the acting admin stays
+            removable.remove(acting_user.id)
+        if removable:
+            ChatRoomMember.objects.filter(room=room, user_id__in=removable).delete()
+            invalidate_memberships(removable)
+        return removable
+
 
 class ChatRoomCreateSerializer(serializers.ModelSerializer):
     member_ids = serializers.ListField(
@@ -119,40 +185,51 @@ class ChatRoomCreateSerializer(serializers.ModelSerializer):
         write_only=True,
         required=False
     )
+    # Requested ids that are not users (or are the creator)
+    skipped_member_ids = serializers.ListField(child=serializers.IntegerField(), read_only=True)
     
     class Meta:
         model = ChatRoom
-        fields = ('name', 'room_type', 'description', 'member_ids')
+        fields = ('name', 'room_type', 'description', 'member_ids', 'skipped_member_ids')
+
+    def validate_room_type(self, value):
+        # DMs need their pair key, which only POST /api/chat/direct/ sets
+        if value == 'direct':
+            raise serializers.ValidationError('Use /api/chat/direct/ to start a direct message')
+        return value
     
     def create(self, validated_data):
-        member_ids = validated_data.pop('member_ids', [])
+        member_ids = list(dict.fromkeys(validated_data.pop('member_ids', [])))
         request = self.context['request']
-        
-        # Create the chat room
-        chat_room = ChatRoom.objects.create(
-            created_by=request.user,
-            **validated_data
-        )
-        
-        # Add creator as admin
-        ChatRoomMember.objects.create(
-            user=request.user,
-            room=chat_room,
-            role='admin'
-        )
-        
-        # Add other members
-        for user_id in member_ids:
-            try:
-                user = User.objects.get(id=user_id)
-                ChatRoomMember.objects.create(
-                    user=user,
-                    room=chat_room,
-                    role='member'
-                )
-            except User.DoesNotExist:
-                continue
-        
+
+        with transaction.atomic():
+            # Create the chat room
+            chat_room = ChatRoom.objects.create(
+                created_by=request.user,
+                **validated_data
+            )
+
+            # Creator as admin plus every existing user among member_ids, in one INSERT
+            valid_ids = set(
+                User.objects.filter(id__in=member_ids)
+                .exclude(id=request.user.id)
+                .values_list('id', flat=True)
+            )
+            ChatRoomMember.objects.bulk_create(
+                [ChatRoomMember(
+                    user=request.user, room=chat_room, role='admin', last_activity_at=chat_room.last_activity_at
+                )]
+                + [
+                    ChatRoomMember(
+                        user_id=uid, room=chat_room, role='member', last_activity_at=chat_room.last_activity_at
+                    )
+                    for uid in member_ids if uid in valid_ids
+                ]
+            )
+            invalidate_memberships({request.user.id} | valid_ids)
+            bump_room_inboxes([chat_room.id], room_event('room_created', chat_room.id))
+
+        chat_room.skipped_member_ids = [uid for uid in member_ids if uid not in valid_ids]
         return chat_room
 
 
@@ -173,6 +250,30 @@ class MessageMetadataSerializer(serializers.ModelSerializer):
         return []
 
 
+class MessageMetadataBatchItemSerializer(serializers.Serializer):
+    """One record of a batch metadata upload (see create_message_metadata_batch)."""
+    room_id = serializers.UUIDField()
+    firebase_message_id = serializers.CharField(max_length=255)
+    message_type = serializers.ChoiceField(choices=MessageMetadata.MESSAGE_TYPES, default='text')
+    preview = serializers.CharField(required=False, allow_blank=True, default='')
+
+
+class MarkRoomsReadSerializer(serializers.Serializer):
+    """Body of mark_rooms_read: some rooms, or all of the user's rooms."""
+    room_ids = serializers.ListField(child=serializers.UUIDField(), required=False, max_length=500)
+    all = serializers.BooleanField(default=False)
+
+    def validate(self, attrs):
+        if not attrs['all'] and not attrs.get('room_ids'):
+            raise serializers.ValidationError('Provide room_ids or set all to true')
+        return attrs
+
+
+class ConnectTicketSerializer(serializers.Serializer):
+    """Body of issue_connect_ticket: the rooms the client is about to open sockets for."""
+    room_ids = serializers.ListField(child=serializers.UUIDField(), required=False, max_length=500)
+
+
 class DirectMessageCreateSerializer(serializers.Serializer):
     recipient_id = serializers.IntegerField()
     
@@ -181,37 +282,42 @@ class DirectMessageCreateSerializer(serializers.Serializer):
         if value == request.user.id:
             raise serializers.ValidationError("Cannot create chat with yourself")
         
-        try:
-            User.objects.get(id=value)
-        except User.DoesNotExist:
+        if not User.objects.filter(id=value).exists():
             raise serializers.ValidationError("Recipient does not exist")
         
         return value
     
     def create(self, validated_data):
         request = self.context['request']
-        recipient = User.objects.get(id=validated_data['recipient_id'])
-        
-        # Check if direct message room already exists
-        # Ensure both the current user AND the recipient are members of the room
-        existing_room = (
-            ChatRoom.objects.filter(room_type='direct')
-            .filter(members=request.user)
-            .filter(members=recipient)
-            .first()
-        )
-        
-        if existing_room:
-            return existing_room
-        
-        # Create new direct message room
-        chat_room = ChatRoom.objects.create(
-            room_type='direct',
-            created_by=request.user
-        )
-        
-        # Add both users as members
-        ChatRoomMember.objects.create(user=request.user, room=chat_room, role='member')
-        ChatRoomMember.objects.create(user=recipient, room=chat_room, role='member')
+        recipient_id = validated_data['recipient_id']
+        low, high = ChatRoom.direct_pair(request.user.id, recipient_id)
+
+        with transaction.atomic():
+            # The pair key is unique among direct rooms, so concurrent requests
+            # for the same two users resolve to one room
+            chat_room, created = ChatRoom.objects.get_or_create(
+                room_type='direct', dm_user_low_id=low, dm_user_high_id=high,
+                defaults={'created_by': request.user},
+            )
+            if created:
+                missing_ids = {request.user.id, recipient_id}
+            else:
+                # Either side may have left the DM; bring them back
+                missing_ids = {request.user.id, recipient_id} - set(
+                    chat_room.chatroommember_set.values_list('user_id', flat=True)
+                )
+            if missing_ids:
+                ChatRoomMember.objects.bulk_create(
+                    [
+                        ChatRoomMember(
+                            user_id=uid, room=chat_room, role='member', last_activity_at=chat_room.last_activity_at,
+                            read_message_count=chat_room.message_count,
+                        )
+                        for uid in missing_ids
+                    ],
+                    ignore_conflicts=True,
+                )
+                invalidate_memberships(missing_ids)
+                bump_inbox_versions(missing_ids, room_event('room_created', chat_room.id))
         
         return chat_room
@@ -0,0 +1,85 @@
+"""
+Bulk builders for scaled test data.
+
+Everything is inserted with bulk_create so the large fixtures (thousands of
+users or rooms) stay fast enough to build in setUpTestData.
+"""
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+
+from chat.models import ChatRoom, ChatRoomMember, MessageMetadata
+
+User = get_user_model()
+
+PASSWORD = 'test-password-123'
+_password_hash = None
+
+
+def make_users(count, prefix):
+    """Create ``count`` active users sharing one precomputed password hash."""
+    global _password_hash
+    if _password_hash is None:
+        _password_hash = make_password(PASSWORD)
+    return User.objects.bulk_create([
+        User(
+            email=f'{prefix}{i}@example.com',
+            username=f'{prefix}{i}',
+            first_name=prefix.title(),
+            last_name=str(i),
+            password=_password_hash,
+        )
+        for i in range(count)
+    ])
+
+
+def make_room(creator, members=(), name='', room_type='group', message_count=0):
+    """
+    Create a room with ``creator`` as admin plus ``members``, and optionally
+    ``message_count`` messages from the creator with the summary columns set.
+    """
+    room = ChatRoom.objects.create(name=name, room_type=room_type, created_by=creator)
+    if room_type == 'direct' and len(members) == 1:
+        room.dm_user_low_id, room.dm_user_high_id = ChatRoom.direct_pair(creator.pk, members[0].pk)
+        room.save(update_fields=['dm_user_low', 'dm_user_high'])
+    ChatRoomMember.objects.bulk_create(
+        [ChatRoomMember(user=creator, room=room, role='admin', last_activity_at=room.last_activity_at)]
+        + [
+            ChatRoomMember(user=user, room=room, last_activity_at=room.last_activity_at)
+            for user in members if user.pk != creator.pk
+        ]
+    )
+    add_messages(room, creator, message_count)
+    return room
+
+
+def add_messages(room, sender, count):
+    if not count:
+        return []
+    messages = MessageMetadata.objects.bulk_create([
+        MessageMetadata(firebase_message_id=f'{room.id}-{i}', room=room, sender=sender)
+        for i in range(count)
+    ])
+    latest = messages[-1]
+    ChatRoom.objects.filter(pk=room.pk).update(
+        last_message=latest,
+        last_message_firebase_id=latest.firebase_message_id,
+        last_message_type=latest.message_type,
+        last_message_sender=sender,
+        last_message_preview='hello',
+        last_message_at=latest.created_at,
+        message_count=count,
+        last_activity_at=latest.created_at,
+    )
+    ChatRoomMember.objects.filter(room=room).update(last_activity_at=latest.created_at)
+    # The sender has read their own messages
+    ChatRoomMember.objects.filter(room=room, user=sender).update(read_message_count=count)
+    return messages
+
+
+def make_inbox(user, room_count, prefix, partner_count=2, message_count=2):
+    """Put ``user`` in ``room_count`` small rooms, each with a few messages."""
+    partners = make_users(partner_count, prefix)
+    return [
+        make_room(partners[i % partner_count], [user], name=f'{prefix}-{i}', message_count=message_count)
+        for i in range(room_count)
+    ]
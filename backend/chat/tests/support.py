@@ -0,0 +1,10 @@
+import redis
+from django.conf import settings
+
+
+def redis_available():
+    """Whether a Redis server answers at REDIS_URL (tests that need one skip otherwise)."""
+    try:
+        return redis.Redis.from_url(settings.REDIS_URL, socket_connect_timeout=0.5).ping()
+    except redis.RedisError:
+        return False
@@ -0,0 +1,354 @@
+"""
+Websocket consumers, driven through channels' WebsocketCommunicator on the
+in-memory channel layer.
+"""
+from io import StringIO
+from unittest import mock
+
+import msgpack
+from asgiref.sync import async_to_sync
+from channels.layers import channel_layers
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.core.management import call_command
+from django.test import TransactionTestCase, override_settings
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from chat import inbox
+from chat.middleware import JWTAuthMiddlewareStack
+from chat.receipts import watermarks
+from chat.routing import websocket_urlpatterns
+from chat.tests.factories import make_room, make_users
+from chat.tickets import read_ticket
+from chat.wire import JSON_SUBPROTOCOL, MSGPACK_SUBPROTOCOL, MsgpackFrames
+from flowchat import jsoncodec
+
+IN_MEMORY_LAYER = {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}
+
+
+def as_user(user):
+    """The websocket router with ``user`` already authenticated, in place of JWTAuthMiddleware."""
+    router = URLRouter(websocket_urlpatterns)
+
+    async def application(scope, receive, send):
+        return await router({**scope, 'user': user}, receive, send)
+    return application
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYER, READ_RECEIPT_WINDOW=0.05)
+class ReadReceiptWatermarkTests(TransactionTestCase):
+    # database_sync_to_async closes connections between calls, which
+    # TestCase's wrapping transaction does not survive
+
+    def setUp(self):
+        self.sender, *self.readers = make_users(4, 'watermark')
+        self.room = make_room(self.sender, self.readers)
+        channel_layers.backends.clear()
+        self.addCleanup(channel_layers.backends.clear)
+
+    async def connect(self, user):
+        communicator = WebsocketCommunicator(as_user(user), f'/ws/chat/{self.room.id}/')
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    def test_watermarks_are_coalesced_into_one_event_per_room(self):
+        async def scenario():
+            sender = await self.connect(self.sender)
+            readers = [await self.connect(user) for user in self.readers]
+            for reader in readers:
+                for n in range(1, 6):
+                    await reader.send_json_to({'type': 'read_up_to', 'firebase_message_id': f'fm-{n}'})
+            # Malformed reports are ignored
+            await readers[0].send_json_to({'type': 'read_up_to', 'firebase_message_id': ['fm-9']})
+
+            event = await sender.receive_json_from(timeout=1)
+            self.assertTrue(await sender.receive_nothing(timeout=0.2))
+            for communicator in (sender, *readers):
+                await communicator.disconnect()
+            return event
+
+        event = async_to_sync(scenario)()
+        self.assertEqual(event, {
+            'type': 'read_receipts',
+            'room_id': str(self.room.id),
+            'receipts': {str(user.id): 'fm-5' for user in self.readers},
+        })
+        self.assertEqual(watermarks.pending, {})
+
+    def test_out_of_order_reports_keep_the_furthest_watermark(self):
+        async def scenario():
+            sender = await self.connect(self.sender)
+            first_tab, second_tab = await self.connect(self.readers[0]), await self.connect(self.readers[0])
+            await first_tab.send_json_to({'type': 'read_up_to', 'firebase_message_id': 'fm-5', 'timestamp': 5000})
+            # A tab that fell behind reports an older message last
+            await second_tab.send_json_to({'type': 'read_up_to', 'firebase_message_id': 'fm-3', 'timestamp': 3000})
+            event = await sender.receive_json_from(timeout=1)
+            for communicator in (sender, first_tab, second_tab):
+                await communicator.disconnect()
+            return event
+
+        event = async_to_sync(scenario)()
+        reader_id = str(self.readers[0].id)
+        self.assertEqual(
+            (event['receipts'], event['timestamps']), ({reader_id: 'fm-5'}, {reader_id: 5000})
+        )
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYER)
+class InboxNotificationTests(TransactionTestCase):
+
+    def setUp(self):
+        channel_layers.backends.clear()
+        self.addCleanup(channel_layers.backends.clear)
+
+    def test_all_recipients_are_notified_from_one_event_loop(self):
+        layer = channel_layers['default']
+        user_ids = range(1, 51)
+
+        async def join():
+            channels = {}
+            for user_id in user_ids:
+                channels[user_id] = await layer.new_channel()
+                await layer.group_add(inbox.user_group_name(user_id), channels[user_id])
+            return channels
+        channels = async_to_sync(join)()
+
+        with mock.patch.object(inbox, 'async_to_sync', wraps=async_to_sync) as bridge:
+            inbox.notify_users(user_ids, inbox.room_event('room_updated', 'r1'))
+        self.assertEqual(bridge.call_count, 1)
+
+        async def receive_all():
+            return [await layer.receive(channels[user_id]) for user_id in user_ids]
+        events = async_to_sync(receive_all)()
+        self.assertEqual(events[0], {'type': 'inbox_event', 'event': 'room_updated', 'room_id': 'r1'})
+        self.assertEqual(len(events), len(user_ids))
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYER)
+class ConnectTicketTests(TransactionTestCase):
+
+    def setUp(self):
+        self.user, self.other = make_users(2, 'ticket')
+        self.room = make_room(self.user, [self.other])
+        channel_layers.backends.clear()
+        self.addCleanup(channel_layers.backends.clear)
+
+    def issue(self, data=None):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        response = client.post('/api/chat/ws-ticket/', data or {}, format='json')
+        self.assertEqual(response.status_code, 200)
+        return response.data['ticket']
+
+    def connect(self, room, ticket, token=None):
+        query = f'ticket={ticket}' + (f'&token={token}' if token else '')
+
+        async def attempt():
+            communicator = WebsocketCommunicator(
+                JWTAuthMiddlewareStack(URLRouter(websocket_urlpatterns)), f'/ws/chat/{room.id}/?{query}'
+            )
+            connected, _ = await communicator.connect()
+            if connected:
+                await communicator.disconnect()
+            return connected
+        return async_to_sync(attempt)()
+
+    def test_ticket_is_verified_without_queries(self):
+        ticket = self.issue()
+        with self.assertNumQueries(0):
+            user = read_ticket(ticket)
+        self.assertEqual(
+            (user.id, user.full_name, user.rooms), (self.user.id, self.user.full_name, {str(self.room.id): 'admin'})
+        )
+        self.assertTrue(self.connect(self.room, ticket))
+
+    def test_rooms_outside_the_ticket_are_looked_up(self):
+        ticket = self.issue({'room_ids': []})
+        self.assertEqual(read_ticket(ticket).rooms, {})
+        self.assertTrue(self.connect(self.room, ticket))
+        self.assertFalse(self.connect(make_room(self.other), ticket))
+
+    def test_tampered_and_expired_tickets_are_rejected(self):
+        ticket = self.issue()
+        self.assertIsNone(read_ticket(ticket[:-1] + ('A' if ticket[-1] != 'A' else 'B')))
+        self.assertFalse(self.connect(self.room, 'forged'))
+        with override_settings(WS_TICKET_MAX_AGE=-1):
+            self.assertIsNone(read_ticket(ticket))
+
+    def test_rejected_tickets_fall_back_to_the_token(self):
+        ticket = self.issue()
+        token = AccessToken.for_user(self.user)
+        self.assertTrue(self.connect(self.room, 'forged', token))
+        with override_settings(WS_TICKET_MAX_AGE=-1):
+            self.assertFalse(self.connect(self.room, ticket))
+            self.assertTrue(self.connect(self.room, ticket, token))
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYER)
+class MultiplexChatConsumerTests(TransactionTestCase):
+
+    def setUp(self):
+        self.user, self.other, self.stranger = make_users(3, 'multiplex')
+        self.rooms = [make_room(self.user, [self.other]) for _ in range(2)]
+        self.private = make_room(self.stranger)
+        channel_layers.backends.clear()
+        self.addCleanup(channel_layers.backends.clear)
+
+    async def open(self, user):
+        communicator = WebsocketCommunicator(as_user(user), '/ws/chat/')
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    def test_one_socket_serves_many_rooms(self):
+        first, second = (str(room.id) for room in self.rooms)
+
+        async def scenario():
+            socket = await self.open(self.user)
+            peer = await self.open(self.other)
+            await socket.send_json_to({'type': 'subscribe', 'room_ids': [first, second, str(self.private.id), 'x']})
+            subscribed = await socket.receive_json_from()
+            await peer.send_json_to({'type': 'subscribe', 'room_ids': [first, second]})
+            await peer.receive_json_from()
+
+            await peer.send_json_to({'type': 'chat_message', 'room_id': second, 'message': 'hi'})
+            delivered = await socket.receive_json_from()
+            await peer.receive_json_from()  # the peer's own echo
+
+            await socket.send_json_to({'type': 'unsubscribe', 'room_ids': [second]})
+            unsubscribed = await socket.receive_json_from()
+            await peer.send_json_to({'type': 'chat_message', 'room_id': second, 'message': 'gone'})
+            await peer.receive_json_from()  # the peer's own echo
+            silent = await socket.receive_nothing(timeout=0.1)
+
+            await socket.send_json_to({'type': 'typing', 'room_id': second, 'is_typing': True})
+            refused = await socket.receive_json_from()
+            for communicator in (socket, peer):
+                await communicator.disconnect()
+            return subscribed, delivered, unsubscribed, silent, refused
+
+        subscribed, delivered, unsubscribed, silent, refused = async_to_sync(scenario)()
+        self.assertEqual(subscribed, {
+            'type': 'subscribed', 'room_ids': [first, second], 'rejected': [str(self.private.id)],
+        })
+        self.assertEqual(
+            (delivered['type'], delivered['room_id'], delivered['message']), ('chat_message', second, 'hi')
+        )
+        self.assertEqual(unsubscribed, {'type': 'unsubscribed', 'room_ids': [second]})
+        self.assertTrue(silent)
+        self.assertEqual(refused, {'error': 'Not subscribed to this room', 'room_id': second})
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYER)
+class FrameEncodingTests(TransactionTestCase):
+
+    def setUp(self):
+        self.user, self.other = make_users(2, 'frames')
+        self.room = make_room(self.user, [self.other])
+        channel_layers.backends.clear()
+        self.addCleanup(channel_layers.backends.clear)
+
+    async def open(self, user, subprotocols=None):
+        communicator = WebsocketCommunicator(
+            as_user(user), f'/ws/chat/{self.room.id}/', subprotocols=subprotocols
+        )
+        connected, subprotocol = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator, subprotocol
+
+    def test_msgpack_clients_get_short_binary_frames(self):
+        async def scenario():
+            mobile, accepted = await self.open(self.user, [MSGPACK_SUBPROTOCOL, JSON_SUBPROTOCOL])
+            browser, _ = await self.open(self.other)
+            await mobile.send_to(bytes_data=msgpack.packb({'t': 'chat_message', 'm': 'hi', 'f': 'fm-1'}))
+            binary = await mobile.receive_from()
+            text = await browser.receive_json_from()
+            await mobile.send_to(bytes_data=b'\xc1')
+            invalid = msgpack.unpackb(await mobile.receive_from())
+            for communicator in (mobile, browser):
+                await communicator.disconnect()
+            return accepted, binary, text, invalid
+
+        accepted, binary, text, invalid = async_to_sync(scenario)()
+        self.assertEqual(accepted, MSGPACK_SUBPROTOCOL)
+        self.assertIsInstance(binary, bytes)
+        self.assertEqual(msgpack.unpackb(binary), {
+            't': 'chat_message', 'r': str(self.room.id), 'm': 'hi', 'f': 'fm-1',
+            's': self.user.id, 'sn': self.user.full_name, 'ts': None,
+        })
+        # Clients without the subprotocol still get the full JSON event
+        self.assertEqual((text['firebase_message_id'], text['sender_name']), ('fm-1', self.user.full_name))
+        self.assertLess(len(binary), len(jsoncodec.dumps(text)) * 2 // 3)
+        self.assertEqual(invalid, {'e': 'Invalid MessagePack'})
+
+    def test_batches_round_trip(self):
+        frames = MsgpackFrames()
+        events = [{'type': 'typing_indicator', 'is_typing': True}, {'type': 'read_receipts', 'receipts': {}}]
+        self.assertEqual(frames.decode(frames.encode_batch(events)), events)
+
+    def test_json_subprotocol_is_accepted(self):
+        async def scenario():
+            communicator, accepted = await self.open(self.user, ['v10.stomp', JSON_SUBPROTOCOL])
+            await communicator.send_to(text_data='{')
+            reply = await communicator.receive_json_from()
+            await communicator.disconnect()
+            return accepted, reply
+
+        self.assertEqual(async_to_sync(scenario)(), (JSON_SUBPROTOCOL, {'error': 'Invalid JSON'}))
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYER, WS_BATCH_WINDOW=0.05, WS_BATCH_MAX_EVENTS=3)
+class OutboundBatchingTests(TransactionTestCase):
+
+    def setUp(self):
+        self.user, self.other = make_users(2, 'batching')
+        self.room = make_room(self.user, [self.other])
+        channel_layers.backends.clear()
+        self.addCleanup(channel_layers.backends.clear)
+
+    async def open(self, user, query=''):
+        communicator = WebsocketCommunicator(as_user(user), f'/ws/chat/{self.room.id}/{query}')
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    def test_events_are_sent_in_array_frames_to_clients_that_opt_in(self):
+        async def scenario():
+            batched = await self.open(self.user, '?batch=1')
+            plain = await self.open(self.other)
+            for n in range(4):
+                await plain.send_json_to({'type': 'chat_message', 'message': f'm{n}', 'firebase_message_id': f'fm-{n}'})
+            # A full batch goes out at once, the remainder when the window closes
+            full = await batched.receive_json_from(timeout=0.04)
+            rest = await batched.receive_json_from(timeout=1)
+            echoes = [(await plain.receive_json_from())['message'] for _ in range(4)]
+            for communicator in (batched, plain):
+                await communicator.disconnect()
+            return full, rest, echoes
+
+        full, rest, echoes = async_to_sync(scenario)()
+        self.assertEqual([event['message'] for event in full], ['m0', 'm1', 'm2'])
+        self.assertEqual((rest['type'], rest['message']), ('chat_message', 'm3'))
+        self.assertEqual(echoes, ['m0', 'm1', 'm2', 'm3'])
+
+
+class LoadTestCommandTests(TransactionTestCase):
+
+    def test_small_run_delivers_every_message(self):
+        out = StringIO()
+        call_command(
+            'ws_loadtest', connections=6, rooms=2, room_size='3', rate=50, duration=0.3, drain=0.2, stdout=out,
+        )
+        report = out.getvalue()
+        self.assertRegex(report, r'chat fan-out: (\d+)/\1 expected deliveries')
+        self.assertIn('chat latency ms: p50', report)
+
+    def test_mixed_room_sizes_expect_deliveries_per_room(self):
+        out = StringIO()
+        call_command(
+            'ws_loadtest', connections=10, rooms=4, room_size='2,8', rate=80, duration=0.3, drain=0.3,
+            chat_weight=1, typing_weight=0, receipt_weight=0, stdout=out,
+        )
+        self.assertRegex(out.getvalue(), r'chat fan-out: (\d+)/\1 expected deliveries')
@@ -0,0 +1,68 @@
+"""
+Cached membership checks (chat/membership.py), with a local-memory cache
+standing in for Redis.
+"""
+from django.core.cache import caches
+from django.test import override_settings
+from rest_framework.test import APITestCase
+
+from chat.membership import cache_key, is_member, membership_role
+from chat.tests.factories import make_room, make_users
+
+LOCAL_CACHES = {
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+    'memberships': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'memberships-test'},
+}
+
+
+@override_settings(MEMBERSHIP_CACHE=True, CACHES=LOCAL_CACHES)
+class MembershipCacheTests(APITestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin, cls.member, cls.outsider = make_users(3, 'cached')
+        cls.room = make_room(cls.admin, [cls.member])
+
+    def setUp(self):
+        caches['memberships'].clear()
+
+    def send(self, user, firebase_message_id):
+        self.client.force_authenticate(user)
+        return self.client.post(
+            f'/api/chat/rooms/{self.room.id}/messages/create/',
+            {'firebase_message_id': firebase_message_id}, format='json',
+        )
+
+    def update_room(self, data):
+        self.client.force_authenticate(self.admin)
+        return self.client.patch(f'/api/chat/rooms/{self.room.id}/', data, format='json')
+
+    def test_checks_are_served_from_the_cache(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(membership_role(self.admin.id, self.room.id), 'admin')
+        with self.assertNumQueries(0):
+            self.assertTrue(is_member(self.admin.id, str(self.room.id)))
+            self.assertFalse(is_member(self.admin.id, 'not-a-room'))
+
+    def test_removed_member_loses_access(self):
+        self.assertEqual(self.send(self.member, 'mc-1').status_code, 201)
+        self.update_room({'remove_member_ids': [self.member.id]})
+        self.assertEqual(self.send(self.member, 'mc-2').status_code, 404)
+
+    def test_added_member_gains_access(self):
+        self.assertEqual(self.send(self.outsider, 'mc-1').status_code, 404)
+        self.update_room({'add_member_ids': [self.outsider.id]})
+        self.assertEqual(self.send(self.outsider, 'mc-2').status_code, 201)
+
+    def test_leaving_invalidates_the_cache(self):
+        self.assertTrue(is_member(self.member.id, self.room.id))
+        self.client.force_authenticate(self.member)
+        self.assertEqual(self.client.post(f'/api/chat/rooms/{self.room.id}/leave/').status_code, 200)
+        self.assertIsNone(caches['memberships'].get(cache_key(self.member.id)))
+        self.assertEqual(self.client.post(f'/api/chat/rooms/{self.room.id}/leave/').status_code, 404)
+
+    def test_new_rooms_are_visible_immediately(self):
+        self.assertEqual(membership_role(self.outsider.id, self.room.id), None)
+        self.client.force_authenticate(self.admin)
+        response = self.client.post('/api/chat/direct/', {'recipient_id': self.outsider.id}, format='json')
+        self.assertTrue(is_member(self.outsider.id, response.data['id']))
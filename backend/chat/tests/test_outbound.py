@@ -0,0 +1,143 @@
+"""
+Outbound backpressure (chat/outbound.py), driven with a client that stops
+reading after the first event.
+"""
+import asyncio
+import time
+from collections import Counter
+from unittest import mock
+
+from asgiref.sync import async_to_sync
+from django.test import SimpleTestCase, override_settings
+
+from chat import outbound
+from chat.outbound import DELIVERY_FAILED_CLOSE_CODE, RESYNC_CLOSE_CODE, OutboundQueue
+
+
+def chat(n):
+    return {'type': 'chat_message', 'room_id': 'r', 'message': f'm{n}'}
+
+
+def typing(user_id, is_typing=True):
+    return {'type': 'typing_indicator', 'room_id': 'r', 'user_id': user_id, 'is_typing': is_typing}
+
+
+def receipt(user_id, firebase_message_id):
+    return {
+        'type': 'read_receipt', 'room_id': 'r', 'user_id': user_id, 'firebase_message_id': firebase_message_id,
+    }
+
+
+def receipts(**watermarks):
+    return {'type': 'read_receipts', 'room_id': 'r', 'receipts': watermarks}
+
+
+class OutboundQueueTests(SimpleTestCase):
+
+    def run_stalled(self, events, capacity=4):
+        """Put ``events`` while the client is stuck reading the first; returns what it got."""
+        async def scenario():
+            delivered, closed = [], []
+            reading = asyncio.Event()
+
+            async def deliver(payload):
+                delivered.append(payload)
+                await reading.wait()
+
+            async def close(code):
+                closed.append(code)
+
+            queue = OutboundQueue(deliver, close, capacity=capacity)
+            queue.put(chat(0))
+            await asyncio.sleep(0)
+            for event in events:
+                queue.put(event)
+            pending = [entry.payload for entry in queue.entries]
+            reading.set()
+            await asyncio.sleep(0.01)
+            queue.discard()
+            return queue, pending, delivered, closed
+        return async_to_sync(scenario)()
+
+    def test_low_priority_events_are_coalesced_then_shed(self):
+        queue, pending, delivered, closed = self.run_stalled([
+            typing(1), typing(1, False),
+            receipts(a='fm-1'), receipts(b='fm-2'),
+            chat(1),
+            typing(2),  # half full: shed
+            chat(2),
+            chat(3),  # full: evicts the typing event
+        ])
+        self.assertEqual(pending, [receipts(a='fm-1', b='fm-2'), chat(1), chat(2), chat(3)])
+        self.assertEqual(delivered, [chat(0), *pending])
+        self.assertEqual(closed, [])
+        self.assertEqual(queue.counters, {
+            'coalesced.typing_indicator': 1,
+            'coalesced.read_receipts': 1,
+            'dropped.typing_indicator': 2,
+        })
+
+    def test_watermarks_coalesce_to_the_furthest_one(self):
+        newer = {**receipts(a='fm-5', b='fm-2'), 'timestamps': {'a': 5, 'b': 2}}
+        older = {**receipts(a='fm-3', b='fm-4'), 'timestamps': {'a': 3, 'b': 4}}
+        queue, pending, delivered, closed = self.run_stalled([newer, older], capacity=8)
+        self.assertEqual(pending, [{**receipts(a='fm-5', b='fm-4'), 'timestamps': {'a': 5, 'b': 4}}])
+        self.assertEqual(queue.counters, {'coalesced.read_receipts': 1})
+
+    def test_per_message_receipts_only_coalesce_with_duplicates(self):
+        queue, pending, delivered, closed = self.run_stalled(
+            [receipt(1, 'fm-1'), receipt(1, 'fm-2'), receipt(1, 'fm-1')], capacity=8
+        )
+        self.assertEqual(pending, [receipt(1, 'fm-1'), receipt(1, 'fm-2')])
+        self.assertEqual(delivered, [chat(0), *pending])
+        self.assertEqual(queue.counters, {'coalesced.read_receipt': 1})
+
+    def test_client_full_of_chat_messages_is_told_to_resync(self):
+        queue, pending, delivered, closed = self.run_stalled([chat(n) for n in range(1, 7)])
+        self.assertEqual(pending, [{'type': 'resync', 'reason': 'slow_consumer'}])
+        self.assertEqual(delivered, [chat(0), *pending])
+        self.assertEqual(closed, [RESYNC_CLOSE_CODE])
+        self.assertEqual(queue.counters, {'disconnected.slow_client': 1})
+
+    @override_settings(WS_OUTBOUND_STATS_INTERVAL=60)
+    def test_process_totals_are_logged_at_most_once_per_interval(self):
+        with mock.patch.object(outbound, 'counters', Counter()), \
+                mock.patch.dict(outbound._last_report, at=None, totals={}):
+            with self.assertLogs('flowchat.metrics') as logs:
+                self.run_stalled([typing(1), typing(1, False)])
+                self.run_stalled([typing(1), typing(1, False)])
+                self.assertFalse(outbound.report_totals())
+                self.assertTrue(outbound.report_totals(now=time.monotonic() + 61))
+        self.assertEqual(
+            [line for line in logs.output if 'totals' in line],
+            [
+                'INFO:flowchat.metrics:ws outbound totals coalesced.typing_indicator=1',
+                'INFO:flowchat.metrics:ws outbound totals coalesced.typing_indicator=2',
+            ],
+        )
+
+    def test_failed_delivery_closes_the_socket(self):
+        async def scenario():
+            delivered, closed = [], []
+
+            async def deliver(payload):
+                if payload['message'] == 'm1':
+                    raise ConnectionResetError('gone')
+                delivered.append(payload)
+
+            async def close(code):
+                closed.append(code)
+
+            queue = OutboundQueue(deliver, close)
+            for n in range(3):
+                queue.put(chat(n))
+            await asyncio.sleep(0.01)
+            queue.put(chat(3))
+            await asyncio.sleep(0.01)
+            return queue, delivered, closed
+
+        with self.assertLogs('chat.outbound', 'ERROR'):
+            queue, delivered, closed = async_to_sync(scenario)()
+        self.assertEqual((delivered, closed), ([chat(0)], [DELIVERY_FAILED_CLOSE_CODE]))
+        self.assertTrue(queue._writer.done())
+        self.assertEqual(queue.counters, {'disconnected.delivery_failed': 1})
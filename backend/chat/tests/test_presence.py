@@ -0,0 +1,90 @@
+"""
+Connection-refcounted presence (chat/presence.py).
+
+The lease tests need a Redis server at REDIS_URL and are skipped without one;
+applying transitions to PostgreSQL is tested everywhere.
+"""
+from datetime import timedelta
+from unittest import skipUnless
+
+from django.contrib.auth import get_user_model
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from chat import presence
+from chat.tests.factories import make_users
+from chat.tests.support import redis_available
+from flowchat.redis_client import get_redis
+
+User = get_user_model()
+
+
+class ApplyTransitionsTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.arriving, cls.present, cls.leaving = make_users(3, 'presence')
+        User.objects.filter(id__in=[cls.present.id, cls.leaving.id]).update(is_online=True)
+
+    def test_changes_are_written_in_batches(self):
+        left_at = timezone.now() - timedelta(minutes=1)
+        now = timezone.now()
+        with self.assertNumQueries(2):
+            updated = presence.apply_transitions({
+                self.arriving.id: (True, now),
+                self.present.id: (True, now),
+                self.leaving.id: (False, left_at),
+            })
+        # The user who was already online is not rewritten
+        self.assertEqual(updated, 2)
+        states = {user.id: (user.is_online, user.last_seen) for user in User.objects.all()}
+        self.assertTrue(states[self.arriving.id][0])
+        self.assertEqual(states[self.leaving.id], (False, left_at))
+
+
+@override_settings(PRESENCE_PREFIX='flowchat-test:presence')
+@skipUnless(redis_available(), 'needs a Redis server at REDIS_URL')
+class PresenceTrackerTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = make_users(1, 'leased')[0]
+
+    def setUp(self):
+        self.clear()
+        self.addCleanup(self.clear)
+
+    def clear(self):
+        client = get_redis()
+        keys = list(client.scan_iter(f'{presence.prefix()}:*'))
+        if keys:
+            client.delete(*keys)
+
+    def transitions(self):
+        return get_redis().hgetall(presence.transitions_key())
+
+    def test_only_the_first_and_last_connection_change_presence(self):
+        presence.connection_opened(self.user.id, 'tab-1')
+        presence.connection_opened(self.user.id, 'tab-2')
+        presence.heartbeat(self.user.id, 'tab-1')
+        self.assertEqual(presence.flush(), 1)
+        self.assertTrue(User.objects.get(pk=self.user.pk).is_online)
+
+        presence.connection_closed(self.user.id, 'tab-1')
+        self.assertEqual(self.transitions(), {})
+        presence.connection_closed(self.user.id, 'tab-2')
+        presence.flush()
+        self.assertFalse(User.objects.get(pk=self.user.pk).is_online)
+
+    def test_expired_leases_go_offline_as_of_the_last_heartbeat(self):
+        User.objects.filter(pk=self.user.pk).update(is_online=True)
+        with override_settings(PRESENCE_LEASE_TTL=-1):
+            # A connection whose worker died: its lease is already past due
+            presence.connection_opened(self.user.id, 'crashed')
+        get_redis().delete(presence.transitions_key())
+
+        presence.flush()
+        user = User.objects.get(pk=self.user.pk)
+        self.assertFalse(user.is_online)
+        self.assertLess(abs((timezone.now() - user.last_seen).total_seconds()), 5)
+        self.assertEqual(get_redis().zcard(presence.active_key()), 0)
@@ -0,0 +1,505 @@
+"""
+Query budgets for the chat endpoints.
+
+Each endpoint is exercised against scaled fixtures (users in 1, 50 and 500
+rooms; groups of 2, 100 and 5,000 members). The number of SQL statements
+must stay within a fixed budget *and* be identical across scales, so an
+N+1 regression in a view or serializer fails here long before production.
+Budgets include the query JWT authentication makes to load the user.
+"""
+from datetime import timedelta
+from unittest import mock, skipUnless
+
+from django.conf import settings
+from django.db import connection
+from django.test import override_settings
+from django.utils import timezone
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APITestCase
+from rest_framework_simplejwt.tokens import AccessToken
+
+from chat.models import ChatRoom, ChatRoomMember, MessageMetadata
+from chat.serializers import ChatRoomSerializer
+from chat import inbox, readmarkers
+from chat.tests.factories import make_inbox, make_room, make_users
+from chat.tests.support import redis_available
+from chat.views import ChatRoomChangesView
+from flowchat.redis_client import get_redis
+
+INBOX_SIZES = (1, 50, 500)
+GROUP_SIZES = (2, 100, 5000)
+
+
+class QueryBudgetTestCase(APITestCase):
+
+    def authenticate(self, user):
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(user)}')
+
+    def count_queries(self, user, method, path, data=None, **extra):
+        self.authenticate(user)
+        with CaptureQueriesContext(connection) as ctx:
+            response = getattr(self.client, method)(path, data, format='json', **extra)
+        self.assertLess(response.status_code, 400, response.content[:500])
+        return len(ctx.captured_queries), response
+
+    def assertConstantBudget(self, budget, counts):
+        """``counts`` maps a scale label to the queries it took."""
+        for label, count in counts.items():
+            self.assertLessEqual(count, budget, f'{label}: {count} queries, budget is {budget}')
+        self.assertEqual(
+            len(set(counts.values())), 1, f'query count depends on data size: {counts}'
+        )
+
+
+class RoomListBudgetTests(QueryBudgetTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = make_users(len(INBOX_SIZES), 'reader')
+        for user, size in zip(cls.users, INBOX_SIZES):
+            make_inbox(user, size, prefix=f'partner{size}x')
+
+    def measure(self, path, data=None, **extra):
+        return {
+            f'{size} rooms': self.count_queries(user, 'get', path, data, **extra)[0]
+            for user, size in zip(self.users, INBOX_SIZES)
+        }
+
+    def test_room_list_page_numbers(self):
+        # auth, COUNT, rooms, memberships with users
+        self.assertConstantBudget(4, self.measure('/api/chat/rooms/'))
+
+    def test_room_list_cursor(self):
+        # auth, rooms, memberships with users -- no COUNT
+        self.assertConstantBudget(3, self.measure('/api/chat/rooms/', {'pagination': 'cursor'}))
+
+    def test_room_list_follows_member_activity(self):
+        user = self.users[1]
+        _, response = self.count_queries(user, 'get', '/api/chat/rooms/', {'pagination': 'cursor'})
+        oldest = user.chat_rooms.get(id=response.data['results'][-1]['id'])
+        oldest.record_message(MessageMetadata.objects.create(
+            firebase_message_id='bump-oldest', room=oldest, sender=oldest.created_by
+        ))
+        _, response = self.count_queries(user, 'get', '/api/chat/rooms/', {'pagination': 'cursor'})
+        self.assertEqual(response.data['results'][0]['id'], str(oldest.id))
+
+    def test_room_list_leaves_presence_out_of_the_cached_payload(self):
+        # Presence does not bump inbox versions, so it must not be in what they cache
+        user = self.users[1]
+        _, response = self.count_queries(user, 'get', '/api/chat/rooms/')
+        room = response.data['results'][0]
+        self.assertNotIn('is_online', room['created_by'])
+        self.assertNotIn('is_online', room['members'][0]['user'])
+        self.assertNotIn('last_seen', room['last_message']['sender'] or {})
+
+    def test_room_changes_full(self):
+        # auth, rooms, memberships with users
+        self.assertConstantBudget(3, self.measure('/api/chat/rooms/changes/'))
+
+    @mock.patch.object(ChatRoomChangesView, 'SYNC_OVERLAP', timedelta(0))
+    def test_room_changes_since_cursor(self):
+        counts = {}
+        for user, size in zip(self.users, INBOX_SIZES):
+            _, response = self.count_queries(user, 'get', '/api/chat/rooms/changes/')
+            # One room gets a new message after the cursor was issued
+            room = user.chat_rooms.first()
+            room.record_message(MessageMetadata.objects.create(
+                firebase_message_id=f'changed-{size}', room=room, sender=room.created_by
+            ))
+            counts[f'{size} rooms'], response = self.count_queries(
+                user, 'get', '/api/chat/rooms/changes/', {'since': response.data['cursor']}
+            )
+            self.assertEqual([r['id'] for r in response.data['rooms']], [str(room.id)])
+        # auth, changed memberships, rooms, memberships with users, tombstones
+        self.assertConstantBudget(5, counts)
+
+
+@override_settings(INBOX_VERSION_PREFIX='flowchat-test:inbox')
+@skipUnless(redis_available(), 'needs a Redis server at REDIS_URL')
+class InboxVersionTests(QueryBudgetTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = make_users(len(INBOX_SIZES), 'reader')
+        for user, size in zip(cls.users, INBOX_SIZES):
+            make_inbox(user, size, prefix=f'partner{size}x')
+
+    def setUp(self):
+        self.clear()
+        self.addCleanup(self.clear)
+
+    def clear(self):
+        client = get_redis()
+        keys = list(client.scan_iter(f'{settings.INBOX_VERSION_PREFIX}:*'))
+        if keys:
+            client.delete(*keys)
+
+    def test_room_list_not_modified(self):
+        counts = {}
+        for user, size in zip(self.users, INBOX_SIZES):
+            _, response = self.count_queries(user, 'get', '/api/chat/rooms/')
+            counts[f'{size} rooms'], response = self.count_queries(
+                user, 'get', '/api/chat/rooms/', HTTP_IF_NONE_MATCH=response['ETag']
+            )
+            self.assertEqual(response.status_code, 304)
+        # auth only
+        self.assertConstantBudget(1, counts)
+
+    def test_new_message_changes_the_etag(self):
+        user = self.users[1]
+        _, response = self.count_queries(user, 'get', '/api/chat/rooms/')
+        etag = response['ETag']
+        room = user.chat_rooms.first()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.count_queries(
+                room.created_by, 'post', f'/api/chat/rooms/{room.id}/messages/create/', {'firebase_message_id': 'etag-1'}
+            )
+        _, response = self.count_queries(user, 'get', '/api/chat/rooms/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_lost_counter_restarts_above_issued_versions(self):
+        user = self.users[0]
+        before = inbox.inbox_version(user.id)
+        get_redis().delete(inbox.version_key(user.id))
+        self.assertGreater(int(inbox.inbox_version(user.id)), int(before))
+
+
+@override_settings(REDIS_URL='redis://127.0.0.1:1/0')
+class InboxVersionFallbackTests(QueryBudgetTestCase):
+
+    def setUp(self):
+        get_redis.cache_clear()
+        self.addCleanup(get_redis.cache_clear)
+
+    def test_room_list_is_served_without_an_etag(self):
+        user = make_users(1, 'offline')[0]
+        make_inbox(user, 2, prefix='offlinepartner')
+        with self.assertLogs('chat.inbox', level='WARNING'):
+            _, response = self.count_queries(user, 'get', '/api/chat/rooms/')
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('ETag', response)
+        self.assertEqual(response.data['count'], 2)
+
+    def test_failed_bumps_do_not_fail_the_write(self):
+        user = make_users(1, 'offline')[0]
+        room = make_inbox(user, 1, prefix='offlinepartner')[0]
+        with self.assertLogs('chat.inbox', level='ERROR'), self.captureOnCommitCallbacks(execute=True):
+            _, response = self.count_queries(
+                user, 'post', f'/api/chat/rooms/{room.id}/messages/create/', {'firebase_message_id': 'offline-1'}
+            )
+        self.assertEqual(response.status_code, 201)
+
+
+class GroupSizeBudgetTests(QueryBudgetTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = make_users(1, 'admin')[0]
+        cls.groups = {}
+        cls.members = {}
+        for size in GROUP_SIZES:
+            members = make_users(size - 1, f'member{size}x')
+            cls.groups[size] = make_room(cls.admin, members, name=f'group {size}', message_count=30)
+            cls.members[size] = members
+
+    def measure(self, method, path_template, data=None, user=None):
+        counts = {}
+        for size, room in self.groups.items():
+            actor = user(size) if user else self.admin
+            counts[f'{size} members'], _ = self.count_queries(
+                actor, method, path_template.format(room=room.id), data
+            )
+        return counts
+
+    def test_room_list_with_large_groups(self):
+        counts = {}
+        for size in GROUP_SIZES:
+            # A member of only this group, so each request renders one group
+            counts[f'{size} members'], _ = self.count_queries(
+                self.members[size][0], 'get', '/api/chat/rooms/', {'pagination': 'cursor'}
+            )
+        self.assertConstantBudget(3, counts)
+
+    def test_room_detail(self):
+        # auth, room, memberships with users, member count, own membership
+        self.assertConstantBudget(5, self.measure('get', '/api/chat/rooms/{room}/'))
+
+    def test_room_rename(self):
+        # includes the SAVEPOINT/RELEASE of the serializer's atomic block
+        self.assertConstantBudget(
+            10, self.measure('patch', '/api/chat/rooms/{room}/', {'name': 'renamed'})
+        )
+
+    def test_create_message_metadata(self):
+        counts = {}
+        for size, room in self.groups.items():
+            counts[f'{size} members'], _ = self.count_queries(
+                self.admin, 'post', f'/api/chat/rooms/{room.id}/messages/create/',
+                {'firebase_message_id': f'budget-{size}', 'preview': 'hi'},
+            )
+        self.assertConstantBudget(9, counts)
+        self.assertEqual(
+            ChatRoomMember.objects.get(room=self.groups[5000], user=self.members[5000][0]).unread_count,
+            31,
+        )
+
+    def post_to_largest_group(self, firebase_message_id):
+        room = self.groups[5000]
+        started = timezone.now()
+        self.count_queries(
+            self.admin, 'post', f'/api/chat/rooms/{room.id}/messages/create/',
+            {'firebase_message_id': firebase_message_id},
+        )
+        return ChatRoomMember.objects.filter(room=room, updated_at__gte=started).count()
+
+    @override_settings(ROOM_ACTIVITY_RESOLUTION=60)
+    def test_message_to_large_group_writes_the_sender_membership(self):
+        # Activity copies within ROOM_ACTIVITY_RESOLUTION are left alone, and
+        # unread counts follow from the room's message_count
+        ChatRoomMember.objects.filter(room=self.groups[5000]).update(last_activity_at=timezone.now())
+        self.assertEqual(self.post_to_largest_group('write-cost-1'), 1)
+        member = ChatRoomMember.objects.get(room=self.groups[5000], user=self.members[5000][0])
+        sender = ChatRoomMember.objects.get(room=self.groups[5000], user=self.admin)
+        self.assertEqual((member.unread_count, sender.unread_count), (31, 0))
+
+    @override_settings(ROOM_ACTIVITY_RESOLUTION=60)
+    def test_stale_activity_copies_are_rewritten_once_per_interval(self):
+        ChatRoomMember.objects.filter(room=self.groups[5000]).update(
+            last_activity_at=timezone.now() - timedelta(minutes=5)
+        )
+        self.assertEqual(self.post_to_largest_group('write-cost-1'), 5000)
+        self.assertEqual(self.post_to_largest_group('write-cost-2'), 1)
+        room = ChatRoom.objects.get(pk=self.groups[5000].pk)
+        self.assertLess(
+            ChatRoomMember.objects.get(room=room, user=self.members[5000][0]).last_activity_at,
+            room.last_activity_at,
+        )
+
+    def test_mark_messages_read(self):
+        self.assertConstantBudget(
+            4, self.measure('post', '/api/chat/rooms/{room}/read/', user=lambda size: self.members[size][0])
+        )
+
+    def test_message_history(self):
+        counts = self.measure('get', '/api/chat/rooms/{room}/messages/', {'page_size': 10})
+        self.assertConstantBudget(3, counts)
+        anchor = MessageMetadata.objects.filter(room=self.groups[100]).order_by('-created_at', '-id')[5]
+        count, response = self.count_queries(
+            self.admin, 'get', f'/api/chat/rooms/{self.groups[100].id}/messages/',
+            {'before': str(anchor.id), 'page_size': 10},
+        )
+        self.assertLessEqual(count, 4)
+        self.assertEqual(len(response.data['results']), 10)
+
+    def test_leave_room(self):
+        self.assertConstantBudget(
+            8, self.measure('post', '/api/chat/rooms/{room}/leave/', user=lambda size: self.members[size][-1])
+        )
+
+
+class MembershipBudgetTests(QueryBudgetTestCase):
+    """Creating groups and adding/removing members costs the same for 1 or 2,000 ids."""
+
+    BATCH_SIZES = (1, 100, 2000)
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = make_users(1, 'owner')[0]
+        cls.candidates = make_users(max(cls.BATCH_SIZES), 'candidate')
+
+    def ids(self, size):
+        return [user.id for user in self.candidates[:size]]
+
+    def test_create_group(self):
+        counts = {}
+        for size in self.BATCH_SIZES:
+            counts[f'{size} members'], response = self.count_queries(
+                self.admin, 'post', '/api/chat/rooms/create/',
+                {'name': f'group {size}', 'room_type': 'group', 'member_ids': self.ids(size) + [0, self.admin.id]},
+            )
+            self.assertEqual(response.data['skipped_member_ids'], [0, self.admin.id])
+        self.assertConstantBudget(7, counts)
+        self.assertEqual(ChatRoomMember.objects.filter(room__name='group 2000').count(), 2001)
+
+    def test_add_and_remove_members(self):
+        add_counts, remove_counts = {}, {}
+        for size in self.BATCH_SIZES:
+            room = make_room(self.admin, name=f'managed {size}')
+            add_counts[f'{size} members'], response = self.count_queries(
+                self.admin, 'patch', f'/api/chat/rooms/{room.id}/',
+                {'add_member_ids': self.ids(size) + [0, self.admin.id]},
+            )
+            # unknown ids and existing members are skipped
+            self.assertEqual(response.data['skipped_add_member_ids'], [0, self.admin.id])
+            self.assertEqual(room.members.count(), size + 1)
+
+            remove_counts[f'{size} members'], response = self.count_queries(
+                self.admin, 'patch', f'/api/chat/rooms/{room.id}/',
+                {'remove_member_ids': self.ids(size) + [self.admin.id]},
+            )
+            # the only admin is never removed
+            self.assertEqual(response.data['skipped_remove_member_ids'], [self.admin.id])
+            self.assertEqual(list(room.members.all()), [self.admin])
+        self.assertConstantBudget(12, add_counts)
+        self.assertConstantBudget(13, remove_counts)
+
+    def test_room_update_keeps_concurrent_message_summary(self):
+        room = make_room(self.admin, name='busy')
+        add_members = ChatRoomSerializer._add_members
+
+        def add_members_during_a_send(serializer, instance, user_ids):
+            # A message lands after the view loaded ``instance``
+            room.record_message(MessageMetadata.objects.create(
+                firebase_message_id='concurrent', room=room, sender=self.admin
+            ), preview='hi')
+            return add_members(serializer, instance, user_ids)
+
+        with mock.patch.object(ChatRoomSerializer, '_add_members', add_members_during_a_send):
+            self.count_queries(self.admin, 'patch', f'/api/chat/rooms/{room.id}/', {'name': 'renamed'})
+        room.refresh_from_db()
+        self.assertEqual(room.name, 'renamed')
+        self.assertEqual(room.message_count, 1)
+        self.assertEqual(room.last_message_firebase_id, 'concurrent')
+
+
+class DirectMessageBudgetTests(QueryBudgetTestCase):
+    """Opening a DM is one indexed lookup however many DMs exist."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = make_users(len(INBOX_SIZES), 'opener')
+        cls.recipient = make_users(1, 'recipient')[0]
+        for user, size in zip(cls.users, INBOX_SIZES):
+            for partner in make_users(size, f'dm{size}x'):
+                make_room(user, [partner], room_type='direct')
+
+    def open_dm(self, user, recipient):
+        return self.count_queries(user, 'post', '/api/chat/direct/', {'recipient_id': recipient.id})
+
+    def test_open_existing_direct_message(self):
+        counts = {}
+        for user, size in zip(self.users, INBOX_SIZES):
+            _, created = self.open_dm(user, self.recipient)
+            counts[f'{size} DMs'], response = self.open_dm(self.recipient, user)
+            self.assertEqual(response.data['id'], created.data['id'])
+        self.assertConstantBudget(10, counts)
+
+    def test_direct_rooms_are_only_created_through_the_pair_key(self):
+        self.authenticate(self.users[0])
+        response = self.client.post(
+            '/api/chat/rooms/create/',
+            {'name': 'dm', 'room_type': 'direct', 'member_ids': [self.recipient.id]}, format='json',
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('room_type', response.data)
+
+    def test_reopen_after_leaving(self):
+        user = self.users[0]
+        _, created = self.open_dm(user, self.recipient)
+        self.count_queries(self.recipient, 'post', f'/api/chat/rooms/{created.data["id"]}/leave/')
+        _, reopened = self.open_dm(user, self.recipient)
+        self.assertEqual(reopened.data['id'], created.data['id'])
+        self.assertEqual(
+            sorted(m['user']['id'] for m in reopened.data['members']), sorted([user.id, self.recipient.id])
+        )
+
+
+class MessageBatchBudgetTests(QueryBudgetTestCase):
+    """A metadata batch costs the same for 1 or 500 messages into the same rooms."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.sender = make_users(1, 'sender')[0]
+        cls.rooms = [make_room(cls.sender, make_users(20, f'batch{i}x')) for i in range(2)]
+
+    def batch(self, size, prefix):
+        return [
+            {'room_id': str(self.rooms[i % 2].id), 'firebase_message_id': f'{prefix}-{i}', 'preview': f'm{i}'}
+            for i in range(size)
+        ]
+
+    def test_batch_budget(self):
+        counts = {}
+        for size in (2, 50, 500):
+            counts[f'{size} messages'], response = self.count_queries(
+                self.sender, 'post', '/api/chat/messages/batch/', {'messages': self.batch(size, f'b{size}')}
+            )
+            self.assertEqual(response.data['created'], size)
+        # auth, memberships, savepoint pair, upsert, read-back, rooms,
+        # then per room: 3 summary/unread updates and the members to bump
+        self.assertConstantBudget(15, counts)
+        room = ChatRoom.objects.get(pk=self.rooms[0].pk)
+        self.assertEqual(room.message_count, 1 + 25 + 250)
+        self.assertEqual(room.last_message_preview, 'm498')
+        self.assertEqual(ChatRoomMember.objects.get(room=room, user__username='batch0x0').unread_count, 276)
+
+    def test_per_item_status(self):
+        outsider_room = make_room(make_users(1, 'outsider')[0])
+        MessageMetadata.objects.create(firebase_message_id='taken', room=outsider_room, sender=outsider_room.created_by)
+        messages = self.batch(2, 'status') + [
+            {'room_id': str(self.rooms[0].id), 'firebase_message_id': 'status-0'},
+            {'room_id': str(outsider_room.id), 'firebase_message_id': 'elsewhere'},
+            {'room_id': str(self.rooms[0].id), 'firebase_message_id': 'taken'},
+            {'room_id': 'not-a-uuid', 'firebase_message_id': 'broken'},
+        ]
+        _, response = self.count_queries(self.sender, 'post', '/api/chat/messages/batch/', {'messages': messages})
+        self.assertEqual(
+            [result['status'] for result in response.data['results']],
+            ['created', 'created', 'duplicate', 'forbidden', 'conflict', 'invalid'],
+        )
+        # Resending the queue is idempotent
+        _, response = self.count_queries(self.sender, 'post', '/api/chat/messages/batch/', {'messages': messages[:2]})
+        self.assertEqual([result['status'] for result in response.data['results']], ['exists', 'exists'])
+        self.assertEqual(response.data['created'], 0)
+        self.assertEqual(ChatRoom.objects.get(pk=self.rooms[0].pk).message_count, 1)
+
+    def test_single_create_is_idempotent(self):
+        path = f'/api/chat/rooms/{self.rooms[0].id}/messages/create/'
+        _, first = self.count_queries(self.sender, 'post', path, {'firebase_message_id': 'retry-1'})
+        _, retry = self.count_queries(self.sender, 'post', path, {'firebase_message_id': 'retry-1'})
+        self.assertEqual((first.status_code, retry.status_code), (201, 200))
+        self.assertEqual(retry.data['id'], first.data['id'])
+        self.assertEqual(ChatRoom.objects.get(pk=self.rooms[0].pk).message_count, 1)
+
+    def test_single_create_accepts_form_bodies(self):
+        self.authenticate(self.sender)
+        response = self.client.post(
+            f'/api/chat/rooms/{self.rooms[0].id}/messages/create/',
+            {'firebase_message_id': 'form-1', 'message_type': 'image', 'preview': 'photo'},
+            format='multipart',
+        )
+        self.assertEqual(response.status_code, 201, response.content[:500])
+        self.assertEqual(response.data['firebase_message_id'], 'form-1')
+        self.assertEqual(response.data['message_type'], 'image')
+
+
+class ReadMarkerBudgetTests(QueryBudgetTestCase):
+    """Applying buffered read markers and bulk mark-read cost the same for 1 or 500 rooms."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = make_users(len(INBOX_SIZES), 'marker')
+        cls.inboxes = {
+            size: make_inbox(user, size, prefix=f'marked{size}x')
+            for user, size in zip(cls.users, INBOX_SIZES)
+        }
+
+    def test_apply_read_markers(self):
+        counts = {}
+        for user, size in zip(self.users, INBOX_SIZES):
+            read_at = timezone.now()
+            markers = {(user.id, room.id): read_at for room in self.inboxes[size]}
+            with CaptureQueriesContext(connection) as ctx:
+                self.assertEqual(readmarkers.apply_read_markers(markers), size)
+            counts[f'{size} rooms'] = len(ctx.captured_queries)
+        # memberships, one batched UPDATE
+        self.assertConstantBudget(2, counts)
+
+    def test_mark_all_rooms_read(self):
+        counts = {}
+        for user, size in zip(self.users, INBOX_SIZES):
+            counts[f'{size} rooms'], response = self.count_queries(user, 'post', '/api/chat/rooms/read/', {'all': True})
+            self.assertEqual(response.data['updated'], size)
+        # auth, savepoint pair, UPDATE
+        self.assertConstantBudget(4, counts)
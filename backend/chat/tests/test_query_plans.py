@@ -0,0 +1,134 @@
+"""
+EXPLAIN plans of the hot chat queries.
+
+The SQL an endpoint actually runs is captured and re-planned with sequential
+scans disabled: if a query can still only be answered with a ``Seq Scan`` on
+one of the large tables, the index it relies on has been lost (or the query
+no longer matches it) and the test fails. Set FLOWCHAT_EXPLAIN_DIR to keep
+the plans as build artifacts.
+"""
+import os
+import urllib.parse
+from unittest import skipUnless
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APITestCase
+from rest_framework_simplejwt.tokens import AccessToken
+
+from chat.tests.factories import make_inbox, make_room, make_users
+
+HOT_TABLES = ('chat_rooms', 'chat_room_members', 'message_metadata')
+
+
+@skipUnless(connection.vendor == 'postgresql', 'query plans are checked on PostgreSQL only')
+class HotQueryPlanTests(APITestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = make_users(1, 'admin')[0]
+        cls.members = make_users(200, 'member')
+        cls.room = make_room(cls.admin, cls.members, name='busy', message_count=200)
+        make_inbox(cls.admin, 50, prefix='partner')
+        for member in cls.members[:100]:
+            make_room(cls.admin, [member], room_type='direct')
+        with connection.cursor() as cursor:
+            # users too: history pages join it, and without statistics left
+            # behind by earlier test classes can make it look like one row
+            for table in HOT_TABLES + ('users',):
+                cursor.execute(f'ANALYZE {table}')
+
+    def capture(self, method, path, data=None, user=None):
+        self.client.credentials(
+            HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(user or self.admin)}'
+        )
+        with CaptureQueriesContext(connection) as ctx:
+            response = getattr(self.client, method)(path, data, format='json')
+        self.assertLess(response.status_code, 400, response.content[:500])
+        return [query['sql'] for query in ctx.captured_queries], response
+
+    def find(self, queries, *fragments):
+        matches = [sql for sql in queries if all(fragment in sql for fragment in fragments)]
+        self.assertTrue(matches, f'no captured query contains {fragments}')
+        return matches[0]
+
+    def explain(self, name, sql):
+        with connection.cursor() as cursor:
+            cursor.execute('SET LOCAL enable_seqscan = off')
+            cursor.execute(f'EXPLAIN {sql}')
+            plan = '\n'.join(row[0] for row in cursor.fetchall())
+        plan_dir = os.environ.get('FLOWCHAT_EXPLAIN_DIR')
+        if plan_dir:
+            os.makedirs(plan_dir, exist_ok=True)
+            with open(os.path.join(plan_dir, f'{name}.txt'), 'w') as fh:
+                fh.write(f'{sql}\n\n{plan}\n')
+        return plan
+
+    def assertIndexedPlan(self, name, sql, index=None, index_cond=None):
+        plan = self.explain(name, sql)
+        for table in HOT_TABLES:
+            self.assertNotIn(f'Seq Scan on {table}', plan, f'{name} lost its index:\n{plan}')
+        if index:
+            self.assertIn(index, plan, f'{name} no longer uses {index}:\n{plan}')
+        if index_cond:
+            conditions = [line for line in plan.splitlines() if 'Index Cond' in line]
+            self.assertTrue(
+                any(index_cond in line for line in conditions),
+                f'{name} no longer has {index_cond!r} in an index condition:\n{plan}',
+            )
+
+    def test_room_list_cursor_page(self):
+        page_query = ('FROM "chat_rooms"', '"chat_room_members"."last_activity_at" AS "activity_at"', 'LIMIT 21')
+        queries, response = self.capture('get', '/api/chat/rooms/', {'pagination': 'cursor', 'page_size': 20})
+        sql = self.find(queries, *page_query)
+        self.assertIndexedPlan('room_list_first_page', sql, index='chat_members_activity_idx')
+
+        cursor = response.data['next'].split('cursor=')[1].split('&')[0]
+        queries, _ = self.capture('get', '/api/chat/rooms/', {'cursor': urllib.parse.unquote(cursor), 'page_size': 20})
+        sql = self.find(queries, *page_query)
+        self.assertIndexedPlan(
+            'room_list_next_page', sql,
+            index='chat_members_activity_idx', index_cond='last_activity_at <',
+        )
+
+    def test_room_list_memberships_prefetch(self):
+        queries, _ = self.capture('get', '/api/chat/rooms/', {'pagination': 'cursor'})
+        sql = self.find(queries, 'FROM "chat_room_members"', '"chat_room_members"."room_id" IN')
+        self.assertIndexedPlan('room_list_memberships_prefetch', sql)
+
+    def test_message_history_page(self):
+        path = f'/api/chat/rooms/{self.room.id}/messages/'
+        page_query = ('FROM "message_metadata"', 'ORDER BY "message_metadata"."created_at" DESC', 'LIMIT 21')
+        queries, response = self.capture('get', path, {'page_size': 20})
+        sql = self.find(queries, *page_query)
+        self.assertIndexedPlan('message_history_first_page', sql, index='message_room_created_idx')
+
+        queries, _ = self.capture('get', path, {'page_size': 20, 'before': response.data['before']})
+        sql = self.find(queries, *page_query)
+        self.assertIndexedPlan(
+            'message_history_before_page', sql,
+            index='message_room_created_idx', index_cond='created_at <=',
+        )
+
+    def test_member_counters_update(self):
+        queries, _ = self.capture(
+            'post', f'/api/chat/rooms/{self.room.id}/messages/create/', {'firebase_message_id': 'plan-1'}
+        )
+        sql = self.find(queries, 'UPDATE "chat_room_members"', '"read_message_count"')
+        self.assertIndexedPlan('member_counters_update', sql)
+
+    def test_mark_read(self):
+        queries, _ = self.capture('post', f'/api/chat/rooms/{self.room.id}/read/', user=self.members[0])
+        sql = self.find(queries, 'UPDATE "chat_room_members"', '"last_read_at"')
+        self.assertIndexedPlan('mark_read', sql)
+
+    def test_changes_feed_memberships(self):
+        _, response = self.capture('get', '/api/chat/rooms/changes/')
+        queries, _ = self.capture('get', '/api/chat/rooms/changes/', {'since': response.data['cursor']})
+        sql = self.find(queries, 'FROM "chat_room_members"', '"updated_at" >=')
+        self.assertIndexedPlan('changes_feed_memberships', sql)
+
+    def test_direct_message_lookup(self):
+        queries, _ = self.capture('post', '/api/chat/direct/', {'recipient_id': self.members[0].id})
+        sql = self.find(queries, 'FROM "chat_rooms"', '"dm_user_low_id" =')
+        self.assertIndexedPlan('direct_message_lookup', sql, index='chat_rooms_direct_pair_uniq')
@@ -0,0 +1,101 @@
+"""
+Buffered read markers (chat/readmarkers.py) and the bulk mark-read endpoint.
+
+The buffer round trip needs a Redis server at REDIS_URL and is skipped
+without one.
+"""
+from datetime import timedelta
+from unittest import skipUnless
+
+from django.test import override_settings
+from django.utils import timezone
+from rest_framework.test import APITestCase
+
+from chat import readmarkers
+from chat.models import ChatRoomMember, MessageMetadata
+from chat.tests.factories import make_room, make_users
+from chat.tests.support import redis_available
+from flowchat.redis_client import get_redis
+
+
+class ReadMarkerTestCase(APITestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.sender = make_users(1, 'writer')[0]
+        cls.reader = make_users(1, 'reader')[0]
+        cls.rooms = [make_room(cls.sender, [cls.reader], message_count=3) for _ in range(3)]
+
+    def membership(self, room):
+        return ChatRoomMember.objects.get(room=room, user=self.reader)
+
+
+class ApplyReadMarkersTests(ReadMarkerTestCase):
+
+    def test_unread_is_recounted_from_the_marker(self):
+        room = self.rooms[0]
+        messages = list(MessageMetadata.objects.filter(room=room).order_by('created_at'))
+        # Read up to the second message; the third arrived before the flush
+        marker = messages[1].created_at
+        MessageMetadata.objects.filter(pk=messages[2].pk).update(created_at=marker + timedelta(seconds=1))
+        ChatRoomMember.objects.filter(room=room, user=self.reader).update(last_read_at=marker - timedelta(days=1))
+
+        self.assertEqual(readmarkers.apply_read_markers({(self.reader.id, room.id): marker}), 1)
+        membership = self.membership(room)
+        self.assertEqual((membership.last_read_at, membership.unread_count), (marker, 1))
+
+    def test_stale_markers_and_non_members_are_ignored(self):
+        room = self.rooms[0]
+        stranger = make_users(1, 'stranger')[0]
+        past = self.membership(room).last_read_at - timedelta(minutes=5)
+        updated = readmarkers.apply_read_markers({
+            (self.reader.id, room.id): past,
+            (stranger.id, room.id): timezone.now(),
+        })
+        self.assertEqual(updated, 0)
+        self.assertEqual(self.membership(room).unread_count, 3)
+
+
+class MarkRoomsReadTests(ReadMarkerTestCase):
+
+    def setUp(self):
+        self.client.force_authenticate(self.reader)
+
+    def test_selected_rooms(self):
+        response = self.client.post(
+            '/api/chat/rooms/read/', {'room_ids': [str(self.rooms[0].id), str(self.rooms[1].id)]}, format='json'
+        )
+        self.assertEqual(response.data['updated'], 2)
+        self.assertEqual([self.membership(room).unread_count for room in self.rooms], [0, 0, 3])
+
+    def test_all_rooms_skips_those_already_read(self):
+        self.client.post('/api/chat/rooms/read/', {'room_ids': [str(self.rooms[0].id)]}, format='json')
+        response = self.client.post('/api/chat/rooms/read/', {'all': True}, format='json')
+        self.assertEqual(response.data['updated'], 2)
+        self.assertEqual([self.membership(room).unread_count for room in self.rooms], [0, 0, 0])
+
+    def test_requires_rooms_or_all(self):
+        self.assertEqual(self.client.post('/api/chat/rooms/read/', {}, format='json').status_code, 400)
+
+
+@override_settings(READ_MARKER_BUFFER=True, READ_MARKER_BUFFER_KEY='flowchat-test:read-markers')
+@skipUnless(redis_available(), 'needs a Redis server at REDIS_URL')
+class ReadMarkerBufferTests(ReadMarkerTestCase):
+
+    def setUp(self):
+        get_redis().delete(readmarkers.buffer_key(), readmarkers.flushing_key())
+        self.client.force_authenticate(self.reader)
+
+    def tearDown(self):
+        get_redis().delete(readmarkers.buffer_key(), readmarkers.flushing_key())
+
+    def test_markers_coalesce_until_flushed(self):
+        room = self.rooms[0]
+        for _ in range(5):
+            self.assertEqual(self.client.post(f'/api/chat/rooms/{room.id}/read/').status_code, 200)
+        self.assertEqual(get_redis().hlen(readmarkers.buffer_key()), 1)
+        self.assertEqual(self.membership(room).unread_count, 3)
+
+        self.assertEqual(readmarkers.flush(), 1)
+        self.assertEqual(self.membership(room).unread_count, 0)
+        self.assertFalse(get_redis().exists(readmarkers.buffer_key(), readmarkers.flushing_key()))
@@ -0,0 +1,41 @@
+"""
+Room removal tombstones (ChatRoomRemoval) and their pruning.
+"""
+from datetime import timedelta
+from io import StringIO
+
+from django.core.management import call_command
+from django.utils import timezone
+from rest_framework.test import APITestCase
+
+from chat.inbox import record_room_removals
+from chat.models import ChatRoomRemoval
+from chat.tests.factories import make_room, make_users
+from chat.views import ChatRoomChangesView
+
+
+class PruneRoomRemovalsTests(APITestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin, cls.user = make_users(2, 'removed')
+        cls.rooms = [make_room(cls.admin, name=f'left {n}') for n in range(2)]
+
+    def test_tombstones_past_the_sync_retention_are_deleted(self):
+        for room in self.rooms:
+            record_room_removals(room.id, [self.user.id])
+        expired = timezone.now() - ChatRoomChangesView.SYNC_RETENTION - timedelta(minutes=1)
+        ChatRoomRemoval.objects.filter(room_id=self.rooms[0].id).update(removed_at=expired)
+
+        self.client.force_authenticate(self.user)
+        cursor = self.client.get('/api/chat/rooms/changes/').data['cursor']
+
+        out = StringIO()
+        call_command('prune_room_removals', stdout=out)
+        self.assertIn('Deleted 1 room removals', out.getvalue())
+        self.assertEqual(
+            list(ChatRoomRemoval.objects.values_list('room_id', flat=True)), [self.rooms[1].id]
+        )
+        # Recent removals are still reported to clients with a live cursor
+        response = self.client.get('/api/chat/rooms/changes/', {'since': cursor})
+        self.assertEqual(response.data['removed'], [self.rooms[1].id])
@@ -0,0 +1,65 @@
+"""
+Typing-indicator throttling (chat/typing_indicators.py), driven directly
+with a recording broadcast and shortened intervals.
+"""
+import asyncio
+import time
+
+from asgiref.sync import async_to_sync
+from django.test import SimpleTestCase, override_settings
+
+from chat.typing_indicators import TypingThrottle, is_stale
+
+
+@override_settings(TYPING_REFRESH_INTERVAL=0.2, TYPING_STOP_DELAY=0.05, TYPING_TIMEOUT=0.3)
+class TypingThrottleTests(SimpleTestCase):
+
+    def run_with_throttle(self, scenario):
+        sent = []
+
+        async def broadcast(room_id, is_typing):
+            sent.append((room_id, is_typing))
+
+        async def run():
+            throttle = TypingThrottle(broadcast)
+            await scenario(throttle)
+            await throttle.stop_all()
+
+        async_to_sync(run)()
+        return sent
+
+    def test_keystrokes_are_collapsed(self):
+        async def scenario(throttle):
+            for _ in range(20):
+                await throttle.update('room', True)
+                await throttle.update('room', False)  # flapping between keystrokes
+            await asyncio.sleep(0.1)
+
+        self.assertEqual(self.run_with_throttle(scenario), [('room', True), ('room', False)])
+
+    def test_long_typing_is_refreshed(self):
+        async def scenario(throttle):
+            for _ in range(5):
+                await throttle.update('room', True)
+                await asyncio.sleep(0.06)
+
+        self.assertEqual(self.run_with_throttle(scenario), [('room', True), ('room', True), ('room', False)])
+
+    def test_abandoned_typing_expires(self):
+        async def scenario(throttle):
+            await throttle.update('room', True)
+            await throttle.update('other', True)
+            await throttle.stop('other')
+            await asyncio.sleep(0.4)
+            self.assertEqual(throttle.rooms, {})
+
+        self.assertEqual(
+            self.run_with_throttle(scenario),
+            [('room', True), ('other', True), ('other', False), ('room', False)],
+        )
+
+    def test_late_starts_are_stale_but_stops_are_not(self):
+        late = time.time() - 1
+        self.assertTrue(is_stale({'is_typing': True, 'sent_at': late}))
+        self.assertFalse(is_stale({'is_typing': False, 'sent_at': late}))
+        self.assertFalse(is_stale({'is_typing': True, 'sent_at': time.time()}))
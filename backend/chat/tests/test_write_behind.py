@@ -0,0 +1,101 @@
+"""
+Write-behind queue for message metadata (chat/writebehind.py).
+
+The queue tests need a Redis server at REDIS_URL and are skipped without one;
+the fallback tests run everywhere.
+"""
+from io import StringIO
+from unittest import skipUnless
+
+from django.core.management import call_command
+from django.test import override_settings
+from rest_framework.test import APITestCase
+
+from chat import writebehind
+from chat.models import ChatRoom, ChatRoomMember, MessageMetadata
+from chat.tests.factories import make_room, make_users
+from chat.tests.support import redis_available
+from flowchat.redis_client import get_redis
+
+
+class WriteBehindTestCase(APITestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.sender = make_users(1, 'queued')[0]
+        cls.reader = make_users(1, 'reader')[0]
+        cls.room = make_room(cls.sender, [cls.reader])
+
+    def send(self, firebase_message_id, **extra):
+        self.client.force_authenticate(self.sender)
+        return self.client.post(
+            f'/api/chat/rooms/{self.room.id}/messages/create/',
+            {'firebase_message_id': firebase_message_id, 'preview': 'hello', **extra},
+            format='json',
+        )
+
+
+@override_settings(MESSAGE_WRITE_BEHIND=True, MESSAGE_WRITE_BEHIND_STREAM='flowchat-test:message-metadata')
+@skipUnless(redis_available(), 'needs a Redis server at REDIS_URL')
+class WriteBehindQueueTests(WriteBehindTestCase):
+
+    def setUp(self):
+        get_redis().delete(writebehind.stream_name(), writebehind.stats_key())
+
+    def tearDown(self):
+        get_redis().delete(writebehind.stream_name(), writebehind.stats_key())
+
+    def test_send_is_acknowledged_before_the_write(self):
+        response = self.send('wb-1')
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.data['status'], 'queued')
+        self.assertFalse(MessageMetadata.objects.filter(firebase_message_id='wb-1').exists())
+
+        call_command('drain_message_queue', '--once', stdout=StringIO())
+
+        message = MessageMetadata.objects.get(firebase_message_id='wb-1')
+        room = ChatRoom.objects.get(pk=self.room.pk)
+        self.assertEqual((room.message_count, room.last_message_id, room.last_message_preview), (1, message.id, 'hello'))
+        self.assertEqual(ChatRoomMember.objects.get(room=room, user=self.reader).unread_count, 1)
+        stats = writebehind.queue_stats()
+        self.assertEqual((stats['depth'], stats['pending'], stats['last_created']), (0, 0, '1'))
+
+    def test_retries_are_written_once_in_queue_order(self):
+        for firebase_message_id in ('wb-a', 'wb-b', 'wb-a'):
+            self.send(firebase_message_id)
+        call_command('drain_message_queue', '--once', stdout=StringIO())
+
+        messages = list(MessageMetadata.objects.filter(room=self.room).order_by('created_at'))
+        self.assertEqual([m.firebase_message_id for m in messages], ['wb-a', 'wb-b'])
+        self.assertEqual(ChatRoom.objects.get(pk=self.room.pk).message_count, 2)
+
+    def test_deleted_room_does_not_block_the_queue(self):
+        doomed = make_room(self.sender, [self.reader])
+        writebehind.enqueue_message(doomed.id, self.sender.id, 'wb-gone')
+        doomed.delete()
+        self.send('wb-kept')
+        call_command('drain_message_queue', '--once', stdout=StringIO())
+
+        self.assertEqual(
+            list(MessageMetadata.objects.values_list('firebase_message_id', flat=True)), ['wb-kept']
+        )
+        self.assertEqual(get_redis().xlen(writebehind.stream_name()), 0)
+
+
+@override_settings(MESSAGE_WRITE_BEHIND=True, REDIS_URL='redis://127.0.0.1:1/0')
+class WriteBehindFallbackTests(WriteBehindTestCase):
+
+    def setUp(self):
+        get_redis.cache_clear()
+        self.addCleanup(get_redis.cache_clear)
+
+    def test_unreachable_queue_falls_back_to_a_direct_write(self):
+        with self.assertLogs('chat.views', level='WARNING'):
+            response = self.send('wb-direct')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(ChatRoom.objects.get(pk=self.room.pk).message_count, 1)
+
+    def test_invalid_entries_are_rejected_before_queueing(self):
+        response = self.send('wb-bad', message_type='hologram')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('message_type', response.data)
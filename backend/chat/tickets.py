@@ -0,0 +1,46 @@
+"""
+Short-lived WebSocket connect tickets.
+
+POST /api/chat/ws-ticket/ signs the caller's id, display name and room
+memberships into a ticket valid for WS_TICKET_MAX_AGE seconds. Sockets opened
+with ``?ticket=<ticket>`` are authenticated by JWTAuthMiddleware from the
+signature alone and get a TicketUser instead of a User row, so a reconnect
+storm does not turn into one user lookup plus one membership lookup per socket.
+"""
+from django.conf import settings
+from django.core import signing
+
+SALT = 'flowchat.chat.ws-ticket'
+
+
+class TicketUser:
+    """
+    Authenticated user as vouched for by a connect ticket; carries only what
+    the consumers need. ``rooms`` maps room id to role as of ticket issue.
+    """
+    is_authenticated = True
+    is_anonymous = False
+
+    def __init__(self, user_id, full_name, rooms):
+        self.id = self.pk = user_id
+        self.full_name = full_name
+        self.rooms = rooms
+
+    def __repr__(self):
+        return f'<TicketUser {self.id}>'
+
+
+def issue_ticket(user, rooms):
+    """Sign a ticket for ``user`` vouching for ``rooms`` ({room_id: role})."""
+    payload = {'u': user.id, 'n': user.full_name, 'r': {str(room_id): role for room_id, role in rooms.items()}}
+    return signing.dumps(payload, salt=SALT, compress=True)
+
+
+def read_ticket(ticket):
+    """The TicketUser for a valid, unexpired ticket, else None."""
+    try:
+        payload = signing.loads(ticket, salt=SALT, max_age=settings.WS_TICKET_MAX_AGE)
+    except signing.BadSignature:
+        # Includes SignatureExpired
+        return None
+    return TicketUser(payload['u'], payload['n'], payload['r'])
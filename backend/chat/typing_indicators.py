@@ -0,0 +1,101 @@
+"""
+Per-connection typing-indicator throttling.
+
+Clients report typing on keystrokes; broadcasting each report would put
+every keystroke of every member through the channel layer and through every
+other member's consumer. TypingThrottle sits between a consumer and its room
+groups and broadcasts only state changes, per room:
+
+- a start is broadcast once, then at most every TYPING_REFRESH_INTERVAL
+  seconds while the user keeps typing;
+- a stop is held for TYPING_STOP_DELAY seconds and dropped if typing resumes
+  meanwhile, so start/stop flapping between keystrokes never leaves the
+  server;
+- typing that is not refreshed for TYPING_TIMEOUT seconds is stopped by the
+  server, so a client that vanishes mid-sentence doesn't stay "typing".
+
+Broadcasts carry ``sent_at`` and ``expires_in``. Channel layers have no
+message priorities, so typing is made cheap to shed instead: recipients drop
+starts that reach them more than TYPING_REFRESH_INTERVAL seconds late (stuck
+behind chat traffic; a fresher one is on its way), and clients expire typing
+state after ``expires_in`` on their own.
+"""
+import asyncio
+import time
+
+from django.conf import settings
+
+
+def is_stale(event):
+    """Whether a typing event arrived too late to be worth delivering."""
+    sent_at = event.get('sent_at')
+    return (
+        bool(event.get('is_typing')) and sent_at is not None
+        and time.time() - sent_at > settings.TYPING_REFRESH_INTERVAL
+    )
+
+
+class _RoomTyping:
+    __slots__ = ('broadcast_at', 'timeout', 'pending_stop')
+
+    def __init__(self):
+        self.broadcast_at = None
+        self.timeout = None
+        self.pending_stop = None
+
+
+class TypingThrottle:
+    """
+    Typing state of one connection. ``broadcast`` is a coroutine function
+    ``(room_id, is_typing)`` that sends the event to the room.
+    """
+
+    def __init__(self, broadcast):
+        self.broadcast = broadcast
+        self.rooms = {}
+
+    async def update(self, room_id, is_typing):
+        if is_typing:
+            await self._start(room_id)
+        else:
+            self._request_stop(room_id)
+
+    async def _start(self, room_id):
+        state = self.rooms.setdefault(room_id, _RoomTyping())
+        if state.pending_stop:
+            # Resumed before the stop went out: the stop is never sent
+            state.pending_stop.cancel()
+            state.pending_stop = None
+        if state.timeout:
+            state.timeout.cancel()
+        state.timeout = asyncio.ensure_future(self._stop_later(room_id, settings.TYPING_TIMEOUT))
+
+        now = time.monotonic()
+        if state.broadcast_at is None or now - state.broadcast_at >= settings.TYPING_REFRESH_INTERVAL:
+            state.broadcast_at = now
+            await self.broadcast(room_id, True)
+
+    def _request_stop(self, room_id):
+        state = self.rooms.get(room_id)
+        if state is None or state.pending_stop:
+            return
+        state.pending_stop = asyncio.ensure_future(self._stop_later(room_id, settings.TYPING_STOP_DELAY))
+
+    async def _stop_later(self, room_id, delay):
+        await asyncio.sleep(delay)
+        await self.stop(room_id)
+
+    async def stop(self, room_id):
+        """Stop typing in the room now, if the user was typing there."""
+        state = self.rooms.pop(room_id, None)
+        if state is None:
+            return
+        current = asyncio.current_task()
+        for task in (state.timeout, state.pending_stop):
+            if task and task is not current:
+                task.cancel()
+        await self.broadcast(room_id, False)
+
+    async def stop_all(self):
+        for room_id in list(self.rooms):
+            await self.stop(room_id)
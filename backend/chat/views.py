@@ -1,24 +1,173 @@
 from rest_framework import generics, status, permissions
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.response import Response
-from django.db.models import Q, Count
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError, transaction
+from django.db.models import Q, Count, F, IntegerField, OuterRef, Prefetch, Subquery
+from django.db.models.functions import Greatest
+from django.utils import timezone
+from datetime import datetime, timedelta, timezone as dt_timezone
 from django.shortcuts import get_object_or_404
-from .models import ChatRoom, ChatRoomMember, MessageMetadata
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from .inbox import (
+    bump_inbox_versions, bump_room_inboxes, inbox_etag, message_event, record_room_removals, room_event,
+)
+from .ingest import store_messages
+from .membership import invalidate_memberships, is_member, member_room_ids, user_memberships
+from .models import ChatRoom, ChatRoomMember, ChatRoomRemoval, MessageMetadata, room_message_count
+from .pagination import RoomCursorPagination
+from . import readmarkers, writebehind
+from .tickets import issue_ticket
 from .serializers import (
     ChatRoomSerializer, ChatRoomCreateSerializer, MessageMetadataSerializer,
-    DirectMessageCreateSerializer
+    MessageMetadataBatchItemSerializer, MarkRoomsReadSerializer, DirectMessageCreateSerializer,
+    ConnectTicketSerializer,
 )
+from flowchat.metrics import track
+from redis.exceptions import RedisError
 import cloudinary.uploader
+import logging
+
+logger = logging.getLogger(__name__)
 
 
 class ChatRoomListView(generics.ListAPIView):
+    """
+    Rooms of the current user, most recently active first.
+
+    Pass ``?pagination=cursor`` (or a ``cursor`` from a previous page) to use
+    keyset pagination instead of the default page numbers.
+    """
     serializer_class = ChatRoomSerializer
     permission_classes = [permissions.IsAuthenticated]
+
+    @property
+    def paginator(self):
+        if not hasattr(self, '_paginator'):
+            params = self.request.query_params
+            if self.pagination_class is not None and (
+                params.get('pagination') == 'cursor' or 'cursor' in params
+            ):
+                self._paginator = RoomCursorPagination()
+            else:
+                self._paginator = super().paginator
+        return self._paginator
     
     def get_queryset(self):
-        return ChatRoom.objects.filter(
-            members=self.request.user
-        ).prefetch_related('members', 'messages').order_by('-updated_at')
+        # Everything shown in the list is read from precomputed columns (see
+        # ChatRoom.record_message); member count is a single indexed subquery.
+        # Rooms are ordered by the user's membership copy of the activity time,
+        # which chat_members_activity_idx serves in order.
+        member_count = (
+            ChatRoomMember.objects.filter(room=OuterRef('pk'))
+            .order_by().values('room').annotate(total=Count('pk')).values('total')
+        )
+        return (
+            ChatRoom.objects.filter(chatroommember__user=self.request.user)
+            .annotate(
+                unread_count_value=Greatest(F('message_count') - F('chatroommember__read_message_count'), 0),
+                activity_at=F('chatroommember__last_activity_at'),
+                member_count_value=Subquery(member_count, output_field=IntegerField()),
+            )
+            .select_related('created_by', 'last_message_sender')
+            .prefetch_related(
+                Prefetch(
+                    'chatroommember_set',
+                    queryset=ChatRoomMember.objects.select_related('user'),
+                )
+            )
+            .order_by('-activity_at', '-id')
+        )
+
+    def list(self, request, *args, **kwargs):
+        # The inbox version comes from Redis, so an unchanged inbox gets a bare
+        # 304 without a query beyond authentication.
+        etag = inbox_etag(request.user, request.get_full_path())
+        response = get_conditional_response(request, etag=etag) if etag else None
+        if response is None:
+            # ListModelMixin.list, with the serializer's share timed on its own
+            page = self.paginate_queryset(self.filter_queryset(self.get_queryset()))
+            with track('serialize'):
+                data = self.get_serializer(page, many=True).data
+            response = self.get_paginated_response(data)
+        if etag:
+            response['ETag'] = etag
+        patch_cache_control(response, private=True, no_cache=True)
+        patch_vary_headers(response, ('Authorization',))
+        return response
+
+
+class ChatRoomChangesView(ChatRoomListView):
+    """
+    Delta sync for the rooms list.
+
+    GET /rooms/changes/?since=<cursor> returns the rooms created or updated
+    since the cursor, the ids of rooms the user left or was removed from and
+    the current unread count of every membership that changed. Without a
+    cursor (or with one older than SYNC_RETENTION) the full list is returned
+    with ``reset: true``. Clients store the returned ``cursor`` for the next call.
+    """
+    pagination_class = None
+
+    # Cursors are rewound by this much so rows committed by transactions that
+    # started before the previous sync are not missed; clients upsert by id.
+    SYNC_OVERLAP = timedelta(seconds=5)
+    # Tombstones older than this are not relied upon
+    SYNC_RETENTION = timedelta(days=30)
+
+    @staticmethod
+    def encode_cursor(moment):
+        return str(int(moment.timestamp() * 1_000_000))
+
+    @staticmethod
+    def decode_cursor(cursor):
+        return datetime.fromtimestamp(int(cursor) / 1_000_000, tz=dt_timezone.utc)
+
+    def list(self, request, *args, **kwargs):
+        now = timezone.now()
+        since = None
+        cursor = request.query_params.get('since')
+        if cursor:
+            try:
+                since = self.decode_cursor(cursor)
+            except (ValueError, OverflowError, OSError):
+                return Response({'error': 'Invalid cursor'}, status=status.HTTP_400_BAD_REQUEST)
+        reset = since is None or since < now - self.SYNC_RETENTION
+
+        rooms = self.get_queryset()
+        unread = {}
+        removed = []
+        if not reset:
+            changed = ChatRoomMember.objects.filter(user=request.user).filter(
+                Q(updated_at__gte=since) | Q(joined_at__gte=since) | Q(room__updated_at__gte=since)
+            ).annotate(
+                unread_value=Greatest(F('room__message_count') - F('read_message_count'), 0),
+            ).values_list('room_id', 'unread_value', 'joined_at', 'room__updated_at')
+            changed_room_ids = []
+            for room_id, unread_count, joined_at, room_updated_at in changed:
+                unread[str(room_id)] = unread_count
+                if joined_at >= since or room_updated_at >= since:
+                    changed_room_ids.append(room_id)
+            rooms = rooms.filter(id__in=changed_room_ids) if changed_room_ids else rooms.none()
+            removed = list(
+                ChatRoomRemoval.objects.filter(user=request.user, removed_at__gte=since)
+                .exclude(room_id__in=ChatRoomMember.objects.filter(user=request.user).values('room_id'))
+                .values_list('room_id', flat=True).distinct()
+            )
+
+        rooms = list(rooms)
+        with track('serialize'):
+            room_data = self.get_serializer(rooms, many=True).data
+        if reset:
+            unread = {room['id']: room['unread_count'] for room in room_data}
+        return Response({
+            'cursor': self.encode_cursor(now - self.SYNC_OVERLAP),
+            'reset': reset,
+            'rooms': room_data,
+            'removed': removed,
+            'unread': unread,
+        })
 
 
 class ChatRoomCreateView(generics.CreateAPIView):
@@ -36,7 +185,16 @@ class ChatRoomDetailView(generics.RetrieveUpdateDestroyAPIView):
     permission_classes = [permissions.IsAuthenticated]
     
     def get_queryset(self):
-        return ChatRoom.objects.filter(members=self.request.user)
+        return ChatRoom.objects.filter(members=self.request.user).select_related(
+            'created_by', 'last_message_sender'
+        )
+
+    def perform_destroy(self, instance):
+        with transaction.atomic():
+            member_ids = list(instance.chatroommember_set.values_list('user_id', flat=True))
+            record_room_removals(instance.id, member_ids)
+            instance.delete()
+            invalidate_memberships(member_ids)
 
 
 class DirectMessageCreateView(generics.CreateAPIView):
@@ -53,10 +211,9 @@ class DirectMessageCreateView(generics.CreateAPIView):
         serializer.is_valid(raise_exception=True)
         chat_room = serializer.save()
         
-        return Response(
-            ChatRoomSerializer(chat_room, context={'request': request}).data,
-            status=status.HTTP_201_CREATED
-        )
+        with track('serialize'):
+            data = ChatRoomSerializer(chat_room, context={'request': request}).data
+        return Response(data, status=status.HTTP_201_CREATED)
 
 
 
@@ -64,51 +221,303 @@ class DirectMessageCreateView(generics.CreateAPIView):
 @api_view(['POST'])
 @permission_classes([permissions.IsAuthenticated])
 def mark_messages_read(request, room_id):
-    try:
-        room = ChatRoom.objects.get(id=room_id, members=request.user)
-        member = ChatRoomMember.objects.get(user=request.user, room=room)
-        
-        # Update last read timestamp
-        from django.utils import timezone
-        member.last_read_at = timezone.now()
-        member.save()
-        
-        return Response(
-            {'message': 'Messages marked as read'},
-            status=status.HTTP_200_OK
+    if readmarkers.is_enabled():
+        # Coalesced in Redis and applied by flush_read_markers; non-members'
+        # markers are dropped there, so no membership lookup here
+        try:
+            with track('redis'):
+                readmarkers.buffer_read_marker(request.user.id, room_id)
+        except RedisError:
+            logger.warning("Read-marker buffer unavailable, writing read marker directly", exc_info=True)
+        else:
+            return Response({'message': 'Messages marked as read'}, status=status.HTTP_200_OK)
+
+    # Update last read timestamp and catch the read counter up in one statement
+    with transaction.atomic():
+        now = timezone.now()
+        updated = ChatRoomMember.objects.filter(user=request.user, room_id=room_id).update(
+            last_read_at=now, read_message_count=room_message_count(), updated_at=now
         )
-    except (ChatRoom.DoesNotExist, ChatRoomMember.DoesNotExist):
+        if updated:
+            bump_inbox_versions([request.user.id], room_event('room_read', room_id))
+    if not updated:
         return Response(
             {'error': 'Room or membership not found'},
             status=status.HTTP_404_NOT_FOUND
         )
+    
+    return Response(
+        {'message': 'Messages marked as read'},
+        status=status.HTTP_200_OK
+    )
+
 
+@api_view(['POST'])
+@permission_classes([permissions.IsAuthenticated])
+def mark_rooms_read(request):
+    """
+    Mark many rooms read in one UPDATE.
 
+    Body: {"room_ids": [...]} or {"all": true}. Rooms with nothing unread are
+    left untouched so they don't show up in the changes feed.
+    """
+    serializer = MarkRoomsReadSerializer(data=request.data)
+    serializer.is_valid(raise_exception=True)
+    memberships = ChatRoomMember.objects.filter(user=request.user, read_message_count__lt=F('room__message_count'))
+    if serializer.validated_data['all']:
+        event = {'event': 'rooms_read', 'all': True}
+    else:
+        room_ids = serializer.validated_data['room_ids']
+        memberships = memberships.filter(room_id__in=room_ids)
+        event = {'event': 'rooms_read', 'room_ids': [str(room_id) for room_id in room_ids]}
+
+    with transaction.atomic():
+        now = timezone.now()
+        updated = memberships.update(last_read_at=now, read_message_count=room_message_count(), updated_at=now)
+        if updated:
+            bump_inbox_versions([request.user.id], event)
+    return Response({'updated': updated}, status=status.HTTP_200_OK)
 
 
 @api_view(['POST'])
 @permission_classes([permissions.IsAuthenticated])
-def create_message_metadata(request, room_id):
-    try:
-        room = ChatRoom.objects.get(id=room_id, members=request.user)
-        
-        message_metadata = MessageMetadata.objects.create(
-            firebase_message_id=request.data.get('firebase_message_id'),
-            room=room,
-            sender=request.user,
-            message_type=request.data.get('message_type', 'text')
-        )
-        
+def issue_connect_ticket(request):
+    """
+    Short-lived ticket for opening WebSockets (``?ticket=``) without a
+    database query at connect time.
+
+    Body (optional): {"room_ids": [...]} to vouch for just those rooms;
+    otherwise the ticket covers the user's rooms, up to WS_TICKET_MAX_ROOMS.
+    Sockets for rooms a ticket does not cover still connect after a
+    membership lookup.
+    """
+    serializer = ConnectTicketSerializer(data=request.data)
+    serializer.is_valid(raise_exception=True)
+    rooms = user_memberships(request.user.id)
+    room_ids = serializer.validated_data.get('room_ids')
+    if room_ids is not None:
+        wanted = {str(room_id) for room_id in room_ids}
+        rooms = {room_id: role for room_id, role in rooms.items() if room_id in wanted}
+    rooms = dict(list(rooms.items())[:settings.WS_TICKET_MAX_ROOMS])
+    return Response({
+        'ticket': issue_ticket(request.user, rooms),
+        'expires_in': settings.WS_TICKET_MAX_AGE,
+    })
+
+
+@api_view(['GET'])
+@permission_classes([permissions.IsAuthenticated])
+def list_message_metadata(request, room_id):
+    """
+    Message metadata history for a room, newest first, keyset-paginated.
+
+    Query params:
+    - before: message id; return messages older than it (scroll back)
+    - after: message id; return messages newer than it (catch up)
+    - page_size: default 50, max 200
+    Pages are index range scans on message_room_created_idx, however deep.
+    """
+    if not is_member(request.user.id, room_id):
         return Response(
-            MessageMetadataSerializer(message_metadata).data,
-            status=status.HTTP_201_CREATED
+            {'error': 'Room not found or access denied'},
+            status=status.HTTP_404_NOT_FOUND
         )
-    except ChatRoom.DoesNotExist:
+
+    try:
+        page_size = min(int(request.query_params.get('page_size', 50)), 200)
+    except ValueError:
+        return Response({'error': 'page_size must be an integer'}, status=status.HTTP_400_BAD_REQUEST)
+    page_size = max(page_size, 1)
+
+    before = request.query_params.get('before')
+    after = request.query_params.get('after')
+    anchor_id = before or after
+    messages = MessageMetadata.objects.filter(room_id=room_id).select_related('sender')
+    if anchor_id:
+        try:
+            anchor = MessageMetadata.objects.only('created_at').get(id=anchor_id, room_id=room_id)
+        except (MessageMetadata.DoesNotExist, ValueError, ValidationError):
+            return Response({'error': 'Unknown message cursor'}, status=status.HTTP_400_BAD_REQUEST)
+        # (created_at, id) keyset comparison, written with a plain range on
+        # created_at first so PostgreSQL can use it as the index condition
+        if before:
+            messages = messages.filter(created_at__lte=anchor.created_at).filter(
+                Q(created_at__lt=anchor.created_at) | Q(id__lt=anchor.id)
+            )
+        else:
+            messages = messages.filter(created_at__gte=anchor.created_at).filter(
+                Q(created_at__gt=anchor.created_at) | Q(id__gt=anchor.id)
+            )
+
+    if after and not before:
+        page = list(messages.order_by('created_at', 'id')[:page_size + 1])
+        has_more = len(page) > page_size
+        page = page[:page_size][::-1]
+    else:
+        page = list(messages.order_by('-created_at', '-id')[:page_size + 1])
+        has_more = len(page) > page_size
+        page = page[:page_size]
+
+    with track('serialize'):
+        results = MessageMetadataSerializer(page, many=True).data
+    return Response({
+        'results': results,
+        'has_more': has_more,
+        # Cursors for the neighbouring pages
+        'before': str(page[-1].id) if page else None,
+        'after': str(page[0].id) if page else None,
+    })
+
+
+@api_view(['POST'])
+@permission_classes([permissions.IsAuthenticated])
+def create_message_metadata(request, room_id):
+    # Form and multipart bodies arrive as a QueryDict, whose items are lists
+    data = request.data.dict() if hasattr(request.data, 'dict') else dict(request.data)
+    item = MessageMetadataBatchItemSerializer(data={**data, 'room_id': room_id})
+    if not item.is_valid():
+        return Response(item.errors, status=status.HTTP_400_BAD_REQUEST)
+    firebase_message_id = item.validated_data['firebase_message_id']
+    message_type = item.validated_data['message_type']
+    preview = item.validated_data['preview']
+    room_id = item.validated_data['room_id']
+    if not is_member(request.user.id, room_id):
         return Response(
             {'error': 'Room not found or access denied'},
             status=status.HTTP_404_NOT_FOUND
         )
 
+    if writebehind.is_enabled():
+        # Acknowledge once queued; drain_message_queue writes it shortly after
+        try:
+            with track('redis'):
+                writebehind.enqueue_message(room_id, request.user.id, firebase_message_id, message_type, preview)
+        except RedisError:
+            logger.warning("Write-behind queue unavailable, writing message metadata directly", exc_info=True)
+        else:
+            return Response(
+                {
+                    'firebase_message_id': firebase_message_id,
+                    'room': str(room_id),
+                    'message_type': message_type,
+                    'status': 'queued',
+                },
+                status=status.HTTP_202_ACCEPTED
+            )
+
+    try:
+        with transaction.atomic():
+            message_metadata = MessageMetadata.objects.create(
+                firebase_message_id=firebase_message_id,
+                room_id=room_id,
+                sender=request.user,
+                message_type=message_type
+            )
+            # record_message only needs the room's key; membership was already checked
+            ChatRoom(pk=room_id).record_message(message_metadata, preview=preview)
+            bump_room_inboxes([room_id], message_event(message_metadata, preview))
+    except IntegrityError:
+        # A retried send: replay the original result instead of failing
+        existing = MessageMetadata.objects.filter(firebase_message_id=firebase_message_id).first()
+        if existing is None or existing.sender_id != request.user.id or existing.room_id != room_id:
+            return Response(
+                {'error': 'firebase_message_id is already used by another message'},
+                status=status.HTTP_409_CONFLICT
+            )
+        existing.sender = request.user
+        return Response(MessageMetadataSerializer(existing).data, status=status.HTTP_200_OK)
+    
+    return Response(
+        MessageMetadataSerializer(message_metadata).data,
+        status=status.HTTP_201_CREATED
+    )
+
+
+MAX_METADATA_BATCH = 500
+
+
+@api_view(['POST'])
+@permission_classes([permissions.IsAuthenticated])
+def create_message_metadata_batch(request):
+    """
+    Record many message metadata entries, for any rooms, in one request.
+
+    Body: {"messages": [{room_id, firebase_message_id, message_type?, preview?}, ...]}
+    Entries are upserted on firebase_message_id, so resending a queue is safe.
+    Each result carries the entry's firebase_message_id and a status:
+    - created: recorded now
+    - exists: already recorded by an earlier attempt (same sender and room)
+    - conflict: firebase_message_id belongs to another message
+    - duplicate: repeats an earlier entry of this batch
+    - forbidden: not a member of the room
+    - invalid: failed validation; see "errors"
+    """
+    items = request.data.get('messages') if isinstance(request.data, dict) else None
+    if not isinstance(items, list) or not items:
+        return Response({'error': 'messages must be a non-empty list'}, status=status.HTTP_400_BAD_REQUEST)
+    if len(items) > MAX_METADATA_BATCH:
+        return Response(
+            {'error': f'At most {MAX_METADATA_BATCH} messages per batch'},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+
+    results = [None] * len(items)
+    valid = {}  # firebase_message_id -> (index, validated data)
+    for index, item in enumerate(items):
+        serializer = MessageMetadataBatchItemSerializer(data=item)
+        if not serializer.is_valid():
+            firebase_id = item.get('firebase_message_id') if isinstance(item, dict) else None
+            results[index] = {'firebase_message_id': firebase_id, 'status': 'invalid', 'errors': serializer.errors}
+            continue
+        data = serializer.validated_data
+        if data['firebase_message_id'] in valid:
+            results[index] = {'firebase_message_id': data['firebase_message_id'], 'status': 'duplicate'}
+            continue
+        valid[data['firebase_message_id']] = (index, data)
+
+    # Membership is checked once per room, not once per entry
+    room_ids = {data['room_id'] for _, data in valid.values()}
+    allowed_room_ids = member_room_ids(request.user.id, room_ids)
+    pending = []
+    for firebase_id, (index, data) in valid.items():
+        if data['room_id'] not in allowed_room_ids:
+            results[index] = {'firebase_message_id': firebase_id, 'status': 'forbidden'}
+            continue
+        message = MessageMetadata(
+            firebase_message_id=firebase_id,
+            room_id=data['room_id'],
+            sender=request.user,
+            message_type=data['message_type'],
+        )
+        pending.append((index, data, message))
+
+    if pending:
+        with transaction.atomic():
+            stored = store_messages(
+                [message for _, _, message in pending],
+                {message.firebase_message_id: data['preview'] for _, data, message in pending},
+            )
+        for index, _, message in pending:
+            existing, created = stored[message.firebase_message_id]
+            if created:
+                state = 'created'
+            elif existing.sender_id == request.user.id and existing.room_id == message.room_id:
+                state = 'exists'
+            else:
+                results[index] = {'firebase_message_id': message.firebase_message_id, 'status': 'conflict'}
+                continue
+            existing.sender = request.user
+            results[index] = {
+                'firebase_message_id': message.firebase_message_id,
+                'status': state,
+                'message': MessageMetadataSerializer(existing).data,
+            }
+
+    return Response({
+        'results': results,
+        'created': sum(1 for result in results if result['status'] == 'created'),
+    })
+
 
 # --- Cloudinary upload endpoints ---
 
@@ -123,11 +532,12 @@ def upload_chat_image(request):
         return Response({'detail': 'No file provided'}, status=status.HTTP_400_BAD_REQUEST)
 
     try:
-        result = cloudinary.uploader.upload(
-            file_obj,
-            folder=f"chat_images/{room_id}",
-            resource_type="image",
-        )
+        with track('cloudinary'):
+            result = cloudinary.uploader.upload(
+                file_obj,
+                folder=f"chat_images/{room_id}",
+                resource_type="image",
+            )
         return Response(
             {
                 'url': result.get('secure_url') or result.get('url'),
@@ -149,11 +559,12 @@ def upload_chat_file(request):
         return Response({'detail': 'No file provided'}, status=status.HTTP_400_BAD_REQUEST)
 
     try:
-        result = cloudinary.uploader.upload(
-            file_obj,
-            folder=f"chat_files/{room_id}",
-            resource_type="auto",
-        )
+        with track('cloudinary'):
+            result = cloudinary.uploader.upload(
+                file_obj,
+                folder=f"chat_files/{room_id}",
+                resource_type="auto",
+            )
         return Response(
             {
                 'url': result.get('secure_url') or result.get('url'),
@@ -174,11 +585,12 @@ def upload_profile_picture(request):
         return Response({'detail': 'No file provided'}, status=status.HTTP_400_BAD_REQUEST)
 
     try:
-        result = cloudinary.uploader.upload(
-            file_obj,
-            folder=f"profile_pictures/{request.user.id}",
-            resource_type="image",
-        )
+        with track('cloudinary'):
+            result = cloudinary.uploader.upload(
+                file_obj,
+                folder=f"profile_pictures/{request.user.id}",
+                resource_type="image",
+            )
         return Response(
             {
                 'url': result.get('secure_url') or result.get('url'),
@@ -200,17 +612,16 @@ def upload_group_avatar(request):
         return Response({'detail': 'file and room_id are required'}, status=status.HTTP_400_BAD_REQUEST)
 
     # Ensure the user is a member of the room
-    try:
-        room = ChatRoom.objects.get(id=room_id, members=request.user)
-    except ChatRoom.DoesNotExist:
+    if not is_member(request.user.id, room_id):
         return Response({'detail': 'Room not found or access denied'}, status=status.HTTP_404_NOT_FOUND)
 
     try:
-        result = cloudinary.uploader.upload(
-            file_obj,
-            folder=f"group_avatars/{room.id}",
-            resource_type="image",
-        )
+        with track('cloudinary'):
+            result = cloudinary.uploader.upload(
+                file_obj,
+                folder=f"group_avatars/{room_id}",
+                resource_type="image",
+            )
         return Response(
             {
                 'url': result.get('secure_url') or result.get('url'),
@@ -231,18 +642,28 @@ def leave_room(request, room_id):
     For direct messages, this effectively hides the room from the user's list.
     For group chats, this removes the user from the member list.
     """
-    try:
-        room = ChatRoom.objects.get(id=room_id, members=request.user)
-        
-        # Remove the user from the room
-        ChatRoomMember.objects.filter(room=room, user=request.user).delete()
-        
+    if not is_member(request.user.id, room_id):
         return Response(
-            {'message': 'Successfully left the room'},
-            status=status.HTTP_200_OK
+            {'error': 'Room not found or access denied'},
+            status=status.HTTP_404_NOT_FOUND
         )
-    except ChatRoom.DoesNotExist:
+
+    # Remove the user from the room; remaining members see a new member count
+    with transaction.atomic():
+        left, _ = ChatRoomMember.objects.filter(room_id=room_id, user=request.user).delete()
+        if left:
+            ChatRoom.objects.filter(pk=room_id).update(updated_at=timezone.now())
+            bump_room_inboxes([room_id], room_event('room_updated', room_id))
+            record_room_removals(room_id, [request.user.id])
+        invalidate_memberships([request.user.id])
+
+    if not left:
+        # Already gone; the cached membership was stale
         return Response(
             {'error': 'Room not found or access denied'},
             status=status.HTTP_404_NOT_FOUND
         )
+    return Response(
+        {'message': 'Successfully left the room'},
+        status=status.HTTP_200_OK
+    )
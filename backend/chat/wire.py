@@ -0,0 +1,104 @@
+"""
+WebSocket frame encodings.
+
+Clients choose one at connect time through the WebSocket subprotocol:
+
+- ``flowchat.msgpack.v1``: binary MessagePack frames whose top-level keys are
+  replaced by the short codes in FIELD_CODES (``firebase_message_id`` goes on
+  the wire as ``f``). Keys without a code are sent as they are.
+- ``flowchat.json.v1``, or no subprotocol at all: JSON text frames, exactly
+  what older clients already speak.
+
+Batched events (see chat.outbound) are sent as one array of events in the
+same encoding. Text frames are read as JSON on every connection, so a client may fall back
+to JSON for a frame without renegotiating. Payloads are channel-layer events
+and so already limited to MessagePack-serializable types.
+"""
+from flowchat import jsoncodec
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover - comes with channels-redis
+    msgpack = None
+
+MSGPACK_SUBPROTOCOL = 'flowchat.msgpack.v1'
+JSON_SUBPROTOCOL = 'flowchat.json.v1'
+
+# Append only: codes are part of the wire format of deployed clients
+FIELD_CODES = {
+    'type': 't',
+    'room_id': 'r',
+    'room_ids': 'rs',
+    'rejected': 'rj',
+    'message': 'm',
+    'message_type': 'mt',
+    'firebase_message_id': 'f',
+    'sender_id': 's',
+    'sender_name': 'sn',
+    'user_id': 'u',
+    'user_name': 'un',
+    'timestamp': 'ts',
+    'is_typing': 'it',
+    'expires_in': 'x',
+    'receipts': 'rc',
+    'preview': 'p',
+    'persist': 'ps',
+    'event': 'ev',
+    'error': 'e',
+}
+FIELD_NAMES = {code: name for name, code in FIELD_CODES.items()}
+
+
+def _shorten(payload):
+    return {FIELD_CODES.get(key, key): value for key, value in payload.items()}
+
+
+def _expand(payload):
+    return {FIELD_NAMES.get(key, key): value for key, value in payload.items()}
+
+
+class JSONFrames:
+    binary = False
+    error = 'Invalid JSON'
+
+    def encode(self, payload):
+        return jsoncodec.dumps_str(payload)
+
+    def encode_batch(self, payloads):
+        return jsoncodec.dumps_str(payloads)
+
+    def decode(self, data):
+        return jsoncodec.loads(data)
+
+
+class MsgpackFrames(JSONFrames):
+    binary = True
+    error = 'Invalid MessagePack'
+
+    def encode(self, payload):
+        return msgpack.packb(_shorten(payload))
+
+    def encode_batch(self, payloads):
+        return msgpack.packb([_shorten(payload) for payload in payloads])
+
+    def decode(self, data):
+        try:
+            event = msgpack.unpackb(data, strict_map_key=False)
+        except (ValueError, msgpack.UnpackException) as exc:
+            raise ValueError(str(exc)) from exc
+        if isinstance(event, list):
+            return [_expand(item) if isinstance(item, dict) else item for item in event]
+        return _expand(event) if isinstance(event, dict) else event
+
+
+def negotiate(subprotocols):
+    """
+    The frame encoding for a client offering ``subprotocols`` (in its order
+    of preference), and the subprotocol to accept the connection with.
+    """
+    for subprotocol in subprotocols or ():
+        if subprotocol == MSGPACK_SUBPROTOCOL and msgpack is not None:
+            return MsgpackFrames(), subprotocol
+        if subprotocol == JSON_SUBPROTOCOL:
+            return JSONFrames(), subprotocol
+    return JSONFrames(), None
@@ -0,0 +1,174 @@
+"""
+Write-behind queue for message metadata.
+
+With MESSAGE_WRITE_BEHIND enabled, create_message_metadata and ChatConsumer
+acknowledge a send once it is appended to a Redis stream instead of waiting
+for PostgreSQL. ``manage.py drain_message_queue`` reads the stream through a
+consumer group and writes it with store_messages() in large batches, no later
+than MESSAGE_WRITE_BEHIND_MAX_STALENESS seconds after an entry was queued.
+
+Entries are acknowledged and deleted only after their batch commits. Entries
+a crashed worker read but never acknowledged are claimed by the next worker
+and retried; the upsert on firebase_message_id makes retries harmless.
+Durability is that of the Redis deployment (enable AOF persistence).
+"""
+import logging
+import time
+import uuid
+from datetime import datetime, timezone as dt_timezone
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import DataError, IntegrityError, transaction
+from redis.exceptions import ResponseError
+
+from flowchat.redis_client import get_redis
+from .ingest import store_messages
+from .models import LAST_MESSAGE_PREVIEW_LENGTH, ChatRoom, MessageMetadata
+
+User = get_user_model()
+logger = logging.getLogger('flowchat.metrics')
+
+GROUP = 'metadata-writers'
+
+
+def stream_name():
+    return settings.MESSAGE_WRITE_BEHIND_STREAM
+
+
+def stats_key():
+    return f'{stream_name()}:stats'
+
+
+def is_enabled():
+    return settings.MESSAGE_WRITE_BEHIND
+
+
+def enqueue_message(room_id, sender_id, firebase_message_id, message_type='text', preview=''):
+    """Queue one send; raises redis.RedisError when Redis is unavailable."""
+    get_redis().xadd(stream_name(), {
+        'room_id': str(room_id),
+        'sender_id': str(sender_id),
+        'firebase_message_id': firebase_message_id,
+        'message_type': message_type or 'text',
+        'preview': (preview or '')[:LAST_MESSAGE_PREVIEW_LENGTH],
+        'queued_at': f'{time.time():.6f}',
+    })
+
+
+def ensure_group(client):
+    try:
+        client.xgroup_create(stream_name(), GROUP, id='0', mkstream=True)
+    except ResponseError as exc:
+        if 'BUSYGROUP' not in str(exc):
+            raise
+
+
+def read_entries(client, consumer, count, block_ms, claim_idle_ms):
+    """
+    Entries for this worker: first any left unacknowledged by a dead worker
+    for longer than ``claim_idle_ms``, then new ones (waiting up to ``block_ms``).
+    """
+    _, claimed, *_ = client.xautoclaim(
+        stream_name(), GROUP, consumer, min_idle_time=claim_idle_ms, start_id='0-0', count=count
+    )
+    if claimed:
+        return claimed
+    response = client.xreadgroup(GROUP, consumer, {stream_name(): '>'}, count=count, block=block_ms)
+    return response[0][1] if response else []
+
+
+def oldest_queued_at(entries):
+    return min(float(fields['queued_at']) for _, fields in entries)
+
+
+def flush(client, entries):
+    """Write a batch of stream entries to PostgreSQL, then acknowledge them."""
+    started = time.perf_counter()
+    messages, previews = [], {}
+    seen = set()
+    for _, fields in entries:
+        firebase_id = fields['firebase_message_id']
+        if firebase_id in seen:
+            continue
+        seen.add(firebase_id)
+        messages.append(MessageMetadata(
+            firebase_message_id=firebase_id,
+            room_id=uuid.UUID(fields['room_id']),
+            sender_id=int(fields['sender_id']),
+            message_type=fields['message_type'],
+            created_at=datetime.fromtimestamp(float(fields['queued_at']), tz=dt_timezone.utc),
+        ))
+        previews[firebase_id] = fields['preview']
+
+    # Rooms or users deleted while their sends were queued would fail the
+    # whole INSERT; drop those entries instead
+    room_ids = set(ChatRoom.objects.filter(
+        id__in={message.room_id for message in messages}
+    ).values_list('id', flat=True))
+    sender_ids = set(User.objects.filter(
+        id__in={message.sender_id for message in messages}
+    ).values_list('id', flat=True))
+    writable = [
+        message for message in messages
+        if message.room_id in room_ids and message.sender_id in sender_ids
+    ]
+    if len(writable) < len(messages):
+        logger.warning("write-behind dropped %d entries for deleted rooms or users", len(messages) - len(writable))
+
+    results = {}
+    if writable:
+        try:
+            with transaction.atomic():
+                results = store_messages(writable, previews)
+        except (DataError, IntegrityError):
+            # One bad entry must not block the queue: write the batch entry by
+            # entry and drop what still fails. Connection errors propagate, so
+            # nothing is acknowledged and the entries are retried.
+            logger.exception("write-behind batch failed, writing %d entries one by one", len(writable))
+            for message in writable:
+                try:
+                    with transaction.atomic():
+                        results.update(store_messages([message], previews))
+                except (DataError, IntegrityError):
+                    logger.exception("write-behind dropped entry %s", message.firebase_message_id)
+    created = sum(1 for _, was_created in results.values() if was_created)
+
+    ids = [entry_id for entry_id, _ in entries]
+    client.xack(stream_name(), GROUP, *ids)
+    client.xdel(stream_name(), *ids)
+
+    stats = {
+        'last_flush_at': f'{time.time():.3f}',
+        'last_batch_size': len(entries),
+        'last_created': created,
+        'last_flush_ms': round((time.perf_counter() - started) * 1000, 1),
+        'last_staleness_ms': round((time.time() - oldest_queued_at(entries)) * 1000, 1),
+        'depth': client.xlen(stream_name()),
+    }
+    client.hset(stats_key(), mapping=stats)
+    client.hincrby(stats_key(), 'total_written', created)
+    too_stale = stats['last_staleness_ms'] > settings.MESSAGE_WRITE_BEHIND_MAX_STALENESS * 1000
+    logger.log(
+        logging.WARNING if too_stale else logging.INFO,
+        "write-behind flush batch=%d created=%d flush_ms=%.1f staleness_ms=%.1f depth=%d",
+        stats['last_batch_size'], created, stats['last_flush_ms'], stats['last_staleness_ms'], stats['depth'],
+        extra={'write_behind': stats},
+    )
+    return stats
+
+
+def queue_stats(client=None):
+    """Current depth, unacknowledged entries, oldest entry age and the last flush."""
+    client = client or get_redis()
+    stats = client.hgetall(stats_key())
+    stats['depth'] = client.xlen(stream_name())
+    try:
+        stats['pending'] = client.xpending(stream_name(), GROUP)['pending']
+    except ResponseError:
+        stats['pending'] = 0
+    oldest = client.xrange(stream_name(), count=1)
+    stats['oldest_age_ms'] = (
+        round((time.time() - float(oldest[0][1]['queued_at'])) * 1000, 1) if oldest else 0
+    )
+    return stats
@@ -0,0 +1,86 @@
+"""
+Fast JSON encoding and decoding.
+
+Uses orjson when it is installed and the standard library otherwise, with the
+same output either way: UUIDs as strings, datetimes in ISO 8601 with "Z" for
+UTC, and everything else DRF's JSONEncoder knows (lazy strings, decimals,
+querysets, ...) handled by that encoder. Values orjson refuses, such as
+integers wider than 64 bits, are encoded by the standard library instead.
+
+FastJSONRenderer and FastJSONParser plug the codec into DRF; the websocket
+consumers use dumps_str() and loads() directly.
+"""
+import json
+
+from rest_framework import parsers, renderers
+from rest_framework.exceptions import ParseError
+from rest_framework.utils.encoders import JSONEncoder
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - optional speedup
+    orjson = None
+
+# orjson.JSONDecodeError subclasses it
+JSONDecodeError = json.JSONDecodeError
+
+_default = JSONEncoder().default
+
+
+def _stdlib_dumps(obj, indent):
+    return json.dumps(
+        obj, cls=JSONEncoder, ensure_ascii=False, allow_nan=False,
+        indent=2 if indent else None, separators=None if indent else (',', ':'),
+    ).encode()
+
+
+def dumps(obj, indent=False):
+    """Encode to UTF-8 JSON bytes; ``indent`` pretty-prints with two spaces."""
+    if orjson is not None:
+        options = orjson.OPT_UTC_Z | orjson.OPT_NON_STR_KEYS
+        if indent:
+            options |= orjson.OPT_INDENT_2
+        try:
+            return orjson.dumps(obj, default=_default, option=options)
+        except orjson.JSONEncodeError:
+            pass
+    return _stdlib_dumps(obj, indent)
+
+
+def dumps_str(obj):
+    """Encode to a JSON string (websocket text frames)."""
+    return dumps(obj).decode()
+
+
+def loads(data):
+    """Decode JSON from str or bytes; raises JSONDecodeError."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+class FastJSONRenderer(renderers.JSONRenderer):
+    """Drop-in JSONRenderer using the fast codec."""
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        indent = self.get_indent(accepted_media_type, renderer_context or {})
+        ret = dumps(data, indent=bool(indent))
+        # Like JSONRenderer: escape the two characters that are valid JSON
+        # but end a line in JavaScript
+        return ret.replace(b'\xe2\x80\xa8', b'\\u2028').replace(b'\xe2\x80\xa9', b'\\u2029')
+
+
+class FastJSONParser(parsers.JSONParser):
+    """Drop-in JSONParser using the fast codec for UTF-8 bodies."""
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        parser_context = parser_context or {}
+        encoding = parser_context.get('encoding', 'utf-8')
+        if encoding.lower().replace('_', '-') not in ('utf-8', 'utf8'):
+            return super().parse(stream, media_type, parser_context)
+        try:
+            return loads(stream.read())
+        except ValueError as exc:
+            raise ParseError('JSON parse error - %s' % str(exc))
@@ -0,0 +1,162 @@
+"""
+Opt-in per-request performance instrumentation.
+
+When REQUEST_METRICS_ENABLED is set, RequestMetricsMiddleware records for
+every HTTP request the number and total time of SQL queries (through
+``connection.execute_wrapper``), the time DRF spends rendering the response
+data to JSON (``render``) and the time spent in steps wrapped with
+``track()``: outbound calls (Cloudinary, Firebase Admin, email, Redis) and
+serializer representation (``serialize``). The numbers are returned as
+``Server-Timing`` headers and logged as one line on the
+``flowchat.metrics`` logger; requests above REQUEST_METRICS_MAX_QUERIES or
+REQUEST_METRICS_SLOW_MS are logged as warnings.
+
+``render`` only covers encoding: building the data with ``serializer.data``
+happens inside the view. The list endpoints (rooms list and changes,
+message history) and room creation time it with ``track('serialize')`` once
+their rows are loaded, so the span holds no SQL beyond what the serializers
+themselves run. Elsewhere serializer time is only part of ``total``.
+"""
+import contextvars
+import logging
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+
+logger = logging.getLogger('flowchat.metrics')
+
+_current = contextvars.ContextVar('flowchat_request_metrics', default=None)
+
+
+def _elapsed_ms(start):
+    return (time.perf_counter() - start) * 1000
+
+
+class RequestMetrics:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.total_ms = 0.0
+        self.db_queries = 0
+        self.db_ms = 0.0
+        self.render_ms = 0.0
+        self.external = {}  # name -> [calls, ms]
+
+    def db_wrapper(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.db_queries += 1
+            self.db_ms += _elapsed_ms(start)
+
+    def record_external(self, name, ms):
+        calls = self.external.setdefault(name, [0, 0.0])
+        calls[0] += 1
+        calls[1] += ms
+
+    def finish(self):
+        self.total_ms = _elapsed_ms(self.started)
+
+    def server_timing(self):
+        parts = [
+            f'db;dur={self.db_ms:.1f};desc="{self.db_queries} queries"',
+            f'render;dur={self.render_ms:.1f}',
+        ]
+        for name, (calls, ms) in sorted(self.external.items()):
+            parts.append(f'{name};dur={ms:.1f};desc="{calls} calls"')
+        parts.append(f'total;dur={self.total_ms:.1f}')
+        return ', '.join(parts)
+
+    def as_dict(self):
+        return {
+            'total_ms': round(self.total_ms, 1),
+            'db_queries': self.db_queries,
+            'db_ms': round(self.db_ms, 1),
+            'render_ms': round(self.render_ms, 1),
+            'external': {
+                name: {'calls': calls, 'ms': round(ms, 1)}
+                for name, (calls, ms) in self.external.items()
+            },
+        }
+
+
+@contextmanager
+def track(name):
+    """Time a step (e.g. ``with track('cloudinary'): ...``) of the current request."""
+    metrics = _current.get()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if metrics is not None:
+            metrics.record_external(name, _elapsed_ms(start))
+
+
+class RequestMetricsMiddleware:
+    """Collects RequestMetrics for each request; disabled unless REQUEST_METRICS_ENABLED."""
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'REQUEST_METRICS_ENABLED', False):
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+        self.max_queries = settings.REQUEST_METRICS_MAX_QUERIES
+        self.slow_ms = settings.REQUEST_METRICS_SLOW_MS
+
+    def __call__(self, request):
+        metrics = RequestMetrics()
+        request._metrics = metrics
+        token = _current.set(metrics)
+        try:
+            with connection.execute_wrapper(metrics.db_wrapper):
+                response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        metrics.finish()
+
+        response['Server-Timing'] = metrics.server_timing()
+        origin = request.headers.get('Origin')
+        if origin and origin in getattr(settings, 'CORS_ALLOWED_ORIGINS', ()):
+            # Lets the browser expose Server-Timing to the cross-origin frontend
+            response['Timing-Allow-Origin'] = origin
+        self.log(request, response, metrics)
+        return response
+
+    def process_template_response(self, request, response):
+        # DRF responses are rendered after the view returns; time that step
+        metrics = getattr(request, '_metrics', None)
+        if metrics is not None:
+            start = time.perf_counter()
+
+            def rendered(response):
+                metrics.render_ms += _elapsed_ms(start)
+
+            response.add_post_render_callback(rendered)
+        return response
+
+    def log(self, request, response, metrics):
+        flags = []
+        if metrics.db_queries > self.max_queries:
+            flags.append('too_many_queries')
+        if metrics.total_ms > self.slow_ms:
+            flags.append('slow')
+        external = ' '.join(
+            f'{name}_ms={ms:.1f}' for name, (calls, ms) in sorted(metrics.external.items())
+        )
+        logger.log(
+            logging.WARNING if flags else logging.INFO,
+            "%s %s status=%s total_ms=%.1f db_queries=%d db_ms=%.1f render_ms=%.1f %s flags=%s",
+            request.method, request.path, response.status_code, metrics.total_ms,
+            metrics.db_queries, metrics.db_ms, metrics.render_ms, external, ','.join(flags) or '-',
+            extra={
+                'request_metrics': {
+                    'method': request.method,
+                    'path': request.path,
+                    'status': response.status_code,
+                    'flags': flags,
+                    **metrics.as_dict(),
+                }
+            },
+        )
@@ -0,0 +1,15 @@
+"""
+Shared synchronous Redis client for application data (queues, counters).
+
+The channel layer keeps its own connections; this one is for code that talks
+to Redis directly. Connections come from one pool per process.
+"""
+from functools import lru_cache
+
+import redis
+from django.conf import settings
+
+
+@lru_cache(maxsize=None)
+def get_redis():
+    return redis.Redis.from_url(settings.REDIS_URL, decode_responses=True)
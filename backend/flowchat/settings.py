@@ -57,6 +57,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # No-op unless REQUEST_METRICS_ENABLED (see flowchat/metrics.py)
+    'flowchat.metrics.RequestMetricsMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
@@ -145,6 +147,16 @@ REST_FRAMEWORK = {
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.IsAuthenticated',
     ],
+    # orjson-backed drop-ins for DRF's JSONRenderer/JSONParser (flowchat/jsoncodec.py)
+    'DEFAULT_RENDERER_CLASSES': [
+        'flowchat.jsoncodec.FastJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
+    'DEFAULT_PARSER_CLASSES': [
+        'flowchat.jsoncodec.FastJSONParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    ],
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
     'PAGE_SIZE': 20,
     'DEFAULT_FILTER_BACKENDS': [
@@ -188,16 +200,102 @@ if RENDER_HOST:
     if _render_origin not in CSRF_TRUSTED_ORIGINS:
         CSRF_TRUSTED_ORIGINS.append(_render_origin)
 
+REDIS_URL = config('REDIS_URL', default='redis://localhost:6379')
+
 # Channels configuration
 CHANNEL_LAYERS = {
     'default': {
         'BACKEND': 'channels_redis.core.RedisChannelLayer',
         'CONFIG': {
-            "hosts": [config('REDIS_URL', default='redis://localhost:6379')],
+            "hosts": [REDIS_URL],
         },
     },
 }
 
+# Message metadata write-behind (chat/writebehind.py): sends are acknowledged
+# once queued on a Redis stream and written by `manage.py drain_message_queue`
+# in batches of up to BATCH_SIZE, at most MAX_STALENESS seconds after queueing.
+MESSAGE_WRITE_BEHIND = config('MESSAGE_WRITE_BEHIND', default=False, cast=bool)
+MESSAGE_WRITE_BEHIND_STREAM = config('MESSAGE_WRITE_BEHIND_STREAM', default='flowchat:message-metadata')
+MESSAGE_WRITE_BEHIND_BATCH_SIZE = config('MESSAGE_WRITE_BEHIND_BATCH_SIZE', default=500, cast=int)
+MESSAGE_WRITE_BEHIND_MAX_STALENESS = config('MESSAGE_WRITE_BEHIND_MAX_STALENESS', default=2.0, cast=float)
+
+# Read-marker buffering (chat/readmarkers.py): mark-read calls only touch
+# the Redis hash at BUFFER_KEY; `manage.py flush_read_markers` applies them
+# every FLUSH_INTERVAL seconds in UPDATEs of up to BATCH_SIZE rows.
+READ_MARKER_BUFFER = config('READ_MARKER_BUFFER', default=False, cast=bool)
+READ_MARKER_FLUSH_INTERVAL = config('READ_MARKER_FLUSH_INTERVAL', default=2.0, cast=float)
+READ_MARKER_BATCH_SIZE = config('READ_MARKER_BATCH_SIZE', default=500, cast=int)
+READ_MARKER_BUFFER_KEY = config('READ_MARKER_BUFFER_KEY', default='flowchat:read-markers')
+
+# Read-receipt watermarks (chat/receipts.py): "read up to" reports are
+# coalesced per room and broadcast once every WINDOW seconds.
+READ_RECEIPT_WINDOW = config('READ_RECEIPT_WINDOW', default=0.5, cast=float)
+
+# Membership cache (chat/membership.py): per-user {room_id: role} entries in
+# Redis, shared by every web and websocket process, invalidated on membership
+# writes and expired after TIMEOUT seconds as a backstop.
+MEMBERSHIP_CACHE = config('MEMBERSHIP_CACHE', default=False, cast=bool)
+MEMBERSHIP_CACHE_TIMEOUT = config('MEMBERSHIP_CACHE_TIMEOUT', default=300, cast=int)
+
+# Inbox versions (chat/inbox.py): per-user Redis counters behind the rooms
+# list ETag, stored under PREFIX:<user id>.
+INBOX_VERSION_PREFIX = config('INBOX_VERSION_PREFIX', default='flowchat:inbox')
+
+# Rooms list ordering (ChatRoom.record_messages): members' copies of a room's
+# activity time are rewritten at most once per this many seconds, so ordering
+# among rooms active within one interval may lag by up to that much.
+ROOM_ACTIVITY_RESOLUTION = config('ROOM_ACTIVITY_RESOLUTION', default=1.0, cast=float)
+
+# Presence tracking (chat/presence.py): chat sockets hold LEASE_TTL-second
+# leases in Redis, under PREFIX, renewed by client heartbeats; `manage.py
+# flush_presence` persists online/offline changes every FLUSH_INTERVAL seconds
+# in UPDATEs of up to BATCH_SIZE rows.
+PRESENCE_TRACKER = config('PRESENCE_TRACKER', default=False, cast=bool)
+PRESENCE_LEASE_TTL = config('PRESENCE_LEASE_TTL', default=90, cast=int)
+PRESENCE_FLUSH_INTERVAL = config('PRESENCE_FLUSH_INTERVAL', default=5.0, cast=float)
+PRESENCE_BATCH_SIZE = config('PRESENCE_BATCH_SIZE', default=500, cast=int)
+PRESENCE_PREFIX = config('PRESENCE_PREFIX', default='flowchat:presence')
+
+# Typing indicators (chat/typing_indicators.py): a user's typing start is
+# re-broadcast at most every REFRESH_INTERVAL seconds, stops are held for
+# STOP_DELAY seconds to absorb flapping, and typing not refreshed for TIMEOUT
+# seconds is stopped by the server.
+TYPING_REFRESH_INTERVAL = config('TYPING_REFRESH_INTERVAL', default=3.0, cast=float)
+TYPING_STOP_DELAY = config('TYPING_STOP_DELAY', default=1.0, cast=float)
+TYPING_TIMEOUT = config('TYPING_TIMEOUT', default=6.0, cast=float)
+
+# WebSocket connect tickets (chat/tickets.py): seconds a ticket stays valid,
+# and the most room memberships one ticket vouches for.
+WS_TICKET_MAX_AGE = config('WS_TICKET_MAX_AGE', default=30, cast=int)
+WS_TICKET_MAX_ROOMS = config('WS_TICKET_MAX_ROOMS', default=100, cast=int)
+
+# Outbound backpressure (chat/outbound.py): events waiting to be written to
+# one chat socket; low-priority ones are coalesced or shed as it fills, and
+# a client that falls QUEUE_SIZE chat events behind is disconnected. The
+# process-wide drop and coalesce totals are logged to flowchat.metrics at
+# most every STATS_INTERVAL seconds.
+WS_OUTBOUND_QUEUE_SIZE = config('WS_OUTBOUND_QUEUE_SIZE', default=1000, cast=int)
+WS_OUTBOUND_STATS_INTERVAL = config('WS_OUTBOUND_STATS_INTERVAL', default=60.0, cast=float)
+
+# Outbound batching (chat/outbound.py): chat sockets opened with ?batch=1
+# collect events for up to WINDOW seconds (0 disables batching) or MAX_EVENTS
+# events and send them as one array frame.
+WS_BATCH_WINDOW = config('WS_BATCH_WINDOW', default=0.0, cast=float)
+WS_BATCH_MAX_EVENTS = config('WS_BATCH_MAX_EVENTS', default=50, cast=int)
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'memberships': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': REDIS_URL,
+        'KEY_PREFIX': 'flowchat',
+        'TIMEOUT': MEMBERSHIP_CACHE_TIMEOUT,
+    },
+}
+
 # Firebase configuration
 FIREBASE_CONFIG = {
     'type': config('FIREBASE_TYPE', default='service_account'),
@@ -248,3 +346,21 @@ else:
 
 # Custom user model
 AUTH_USER_MODEL = 'accounts.User'
+
+# Per-request SQL/timing instrumentation: Server-Timing headers plus one log
+# line per request on the flowchat.metrics logger; requests above either
+# threshold are logged as warnings.
+REQUEST_METRICS_ENABLED = config('REQUEST_METRICS_ENABLED', default=False, cast=bool)
+REQUEST_METRICS_MAX_QUERIES = config('REQUEST_METRICS_MAX_QUERIES', default=30, cast=int)
+REQUEST_METRICS_SLOW_MS = config('REQUEST_METRICS_SLOW_MS', default=500, cast=int)
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        'flowchat.metrics': {'handlers': ['console'], 'level': 'INFO', 'propagate': False},
+    },
+}
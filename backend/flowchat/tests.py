@@ -0,0 +1,104 @@
+import uuid
+from datetime import datetime, timedelta, timezone as dt_timezone
+from decimal import Decimal
+from unittest import mock
+
+from django.test import SimpleTestCase, override_settings
+from django.utils.translation import gettext_lazy
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APITestCase
+
+from chat.tests.factories import make_room, make_users
+from flowchat import jsoncodec
+from flowchat.metrics import track
+
+
+@override_settings(REQUEST_METRICS_ENABLED=True, REQUEST_METRICS_MAX_QUERIES=3, REQUEST_METRICS_SLOW_MS=60000)
+class RequestMetricsMiddlewareTests(APITestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = make_users(1, 'metrics')[0]
+        make_room(cls.user, make_users(3, 'peer'), message_count=2)
+
+    def test_server_timing_header(self):
+        self.client.force_authenticate(self.user)
+        response = self.client.get('/api/chat/rooms/')
+        timing = response['Server-Timing']
+        self.assertRegex(timing, r'db;dur=[\d.]+;desc="3 queries"')
+        self.assertIn('render;dur=', timing)
+        # serializer work is timed apart from JSON rendering, after the rows are loaded
+        self.assertIn('serialize;dur=', timing)
+        self.assertIn('total;dur=', timing)
+
+    def test_threshold_is_flagged(self):
+        self.client.force_authenticate(self.user)
+        with self.assertLogs('flowchat.metrics', level='INFO') as logs:
+            self.client.get('/api/chat/rooms/')
+        self.assertEqual(logs.records[0].levelname, 'INFO')
+        self.assertEqual(logs.records[0].request_metrics['db_queries'], 3)
+
+        with override_settings(REQUEST_METRICS_MAX_QUERIES=2):
+            self.client.handler.load_middleware()
+            with self.assertLogs('flowchat.metrics', level='WARNING') as logs:
+                self.client.get('/api/chat/rooms/')
+        self.assertEqual(logs.records[0].request_metrics['flags'], ['too_many_queries'])
+
+    def test_outbound_calls_are_tracked(self):
+        from flowchat import metrics
+
+        metrics_obj = metrics.RequestMetrics()
+        token = metrics._current.set(metrics_obj)
+        try:
+            with track('cloudinary'):
+                pass
+            with track('cloudinary'):
+                pass
+        finally:
+            metrics._current.reset(token)
+        self.assertEqual(metrics_obj.external['cloudinary'][0], 2)
+        self.assertIn('cloudinary;dur=', metrics_obj.server_timing())
+
+    @override_settings(REQUEST_METRICS_ENABLED=False)
+    def test_disabled_by_default(self):
+        self.client.force_authenticate(self.user)
+        self.assertNotIn('Server-Timing', self.client.get('/api/chat/rooms/'))
+
+
+class JSONCodecTests(SimpleTestCase):
+    payload = {
+        'id': uuid.UUID('12345678-1234-5678-1234-567812345678'),
+        'at': datetime(2024, 5, 1, 12, 30, 15, 123456, tzinfo=dt_timezone.utc),
+        'local': datetime(2024, 5, 1, 14, 30, tzinfo=dt_timezone(timedelta(hours=2))),
+        'label': gettext_lazy('Chat'),
+        'price': Decimal('1.50'),
+        'errors': {0: ['This field is required.']},
+        'text': 'line\u2028break ✨',
+    }
+
+    def test_renders_like_drf(self):
+        expected = JSONRenderer().render(self.payload)
+        self.assertEqual(jsoncodec.FastJSONRenderer().render(self.payload), expected)
+        with mock.patch.object(jsoncodec, 'orjson', None):
+            self.assertEqual(jsoncodec.FastJSONRenderer().render(self.payload), expected)
+
+    def test_values_orjson_refuses_fall_back(self):
+        self.assertEqual(jsoncodec.dumps({'big': 2 ** 70}), b'{"big":1180591620717411303424}')
+
+    def test_round_trip_and_errors(self):
+        body = jsoncodec.dumps_str({'room_id': 'r', 'n': [1, 2.5, None, True]})
+        self.assertEqual(jsoncodec.loads(body), {'room_id': 'r', 'n': [1, 2.5, None, True]})
+        with self.assertRaises(jsoncodec.JSONDecodeError):
+            jsoncodec.loads('{"unterminated": ')
+
+
+class FastJSONParserTests(APITestCase):
+
+    def test_requests_are_parsed_and_bad_json_rejected(self):
+        user = make_users(1, 'parser')[0]
+        self.client.force_authenticate(user)
+        response = self.client.post('/api/chat/rooms/read/', '{"all": true}', content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        response = self.client.post('/api/chat/rooms/read/', '{"all": tru', content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('JSON parse error', response.json()['detail'])
@@ -89,6 +89,7 @@ const ChatWindow = ({ isDark: isDarkProp, mobileSearchTerm = '', mobileClearTick
   const [readMap, setReadMap] = useState({});
   const readUnsubsRef = useRef({});
   const markReadTimerRef = useRef(null);
+  const messagesRef = useRef([]);
   // Header extras
   const [showContactInfo, setShowContactInfo] = useState(false);
   const [loadingPeerProfile, setLoadingPeerProfile] = useState(false);
@@ -560,8 +561,13 @@ const ChatWindow = ({ isDark: isDarkProp, mobileSearchTerm = '', mobileClearTick
         const recent = messages.slice(-50).filter(m => String(m.sender_id) !== String(user.id));
         await Promise.all(recent.map(async (m) => {
           try { await markMessageAsRead(activeRoom.id, m.id, user.id); } catch (_) {}
-          try { websocketService.sendReadReceipt(m.id); } catch (_) {}
         }));
+        // One watermark for the newest incoming message covers everything before it
+        const newest = recent[recent.length - 1];
+        if (newest) {
+          // Firestore Timestamp; null while the server time is still pending
+          try { websocketService.sendReadUpTo(newest.id, newest.timestamp?.toMillis?.()); } catch (_) {}
+        }
         // Also tell backend to clear unread count for this room
         try { await markMessagesAsRead(activeRoom.id); } catch (_) {}
       } catch (_) {
@@ -597,6 +603,43 @@ const ChatWindow = ({ isDark: isDarkProp, mobileSearchTerm = '', mobileClearTick
     };
   }, [user?.id]);
 
+  useEffect(() => {
+    messagesRef.current = messages || [];
+  }, [messages]);
+
+  // Watermark receipts: { user_id: last read message id } per room, coalesced server-side
+  useEffect(() => {
+    const handler = (evt) => {
+      try {
+        const { receipts } = evt || {};
+        if (!receipts) return;
+        const list = messagesRef.current;
+        const indexById = new Map(list.map((m, i) => [m.id, i]));
+        setReadMap((prev) => {
+          let next = prev;
+          Object.entries(receipts).forEach(([uid, watermark]) => {
+            if (String(uid) === String(user?.id)) return;
+            const upTo = indexById.get(watermark);
+            if (upTo === undefined) return;
+            // Everything up to the watermark counts as read by this participant
+            for (let i = 0; i <= upTo; i++) {
+              const id = list[i].id;
+              const existing = next[id] || [];
+              if (existing.includes(uid)) continue;
+              if (next === prev) next = { ...prev };
+              next[id] = [...existing, uid];
+            }
+          });
+          return next;
+        });
+      } catch (_) {}
+    };
+    websocketService.on('read_receipts', handler);
+    return () => {
+      try { websocketService.off('read_receipts', handler); } catch (_) {}
+    };
+  }, [user?.id]);
+
   // Subscribe to peer online status for direct chats (RTDB presence)
   useEffect(() => {
     if (!activeRoom || activeRoom.room_type !== 'direct') return;
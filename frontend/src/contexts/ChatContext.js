@@ -1,7 +1,7 @@
 import React, { createContext, useContext, useReducer, useEffect, useCallback, useRef } from 'react';
 import { authAPI, chatAPI } from '../services/api';
 import { subscribeToMessages, sendMessage, getLastMessage } from '../firebase/firestore';
-import websocketService from '../services/websocket';
+import websocketService, { inboxSocket } from '../services/websocket';
 import { useAuth } from './AuthContext';
 
 const ChatContext = createContext();
@@ -68,6 +68,8 @@ export function ChatProvider({ children }) {
   const [state, dispatch] = useReducer(chatReducer, initialState);
   const { user, isAuthenticated } = useAuth();
   const messageUnsubscribeRef = useRef(null);
+  // user_id -> { user_id, user_name, timer } for people typing in the active room
+  const typingRef = useRef(new Map());
 
   // Load rooms with Firestore last message preview
   const loadRooms = useCallback(async () => {
@@ -102,12 +104,14 @@ export function ChatProvider({ children }) {
     }
   }, [dispatch]);
 
-  // WebSocket connection for active room
+  // Join the active room on the shared chat socket; returns a function that leaves it
   const connectToRoom = useCallback((roomId) => {
     const token = localStorage.getItem('access_token');
-    websocketService.connect(roomId, token);
+    websocketService.joinRoom(roomId, token);
 
-    websocketService.on('chat_message', (data) => {
+    const onChatMessage = (data) => {
+      // The socket is shared by every joined room
+      if (data?.room_id && data.room_id !== roomId) return;
       dispatch({ type: 'ADD_MESSAGE', payload: data });
       // If the message belongs to the currently open room and is incoming,
       // mark as read immediately to keep unread badge accurate.
@@ -117,11 +121,53 @@ export function ChatProvider({ children }) {
         }
       } catch (_) {}
       loadRooms();
-    });
+    };
+
+    const publishTyping = () => {
+      const typing = [...typingRef.current.values()].map(({ user_id, user_name }) => ({ user_id, user_name }));
+      dispatch({ type: 'SET_TYPING_USERS', payload: typing });
+    };
+    const clearTyping = (userId) => {
+      const entry = typingRef.current.get(userId);
+      if (!entry) return false;
+      clearTimeout(entry.timer);
+      typingRef.current.delete(userId);
+      return true;
+    };
+
+    const onTyping = (data) => {
+      if (data?.room_id && data.room_id !== roomId) return;
+      const userId = String(data.user_id);
+      clearTyping(userId);
+      if (data.is_typing) {
+        // The server stops typing itself, but drop it locally too if the stop never arrives
+        const timer = setTimeout(() => {
+          if (clearTyping(userId)) publishTyping();
+        }, (data.expires_in || 6) * 1000);
+        typingRef.current.set(userId, { user_id: data.user_id, user_name: data.user_name, timer });
+      }
+      publishTyping();
+    };
+
+    // The server dropped events for this socket: reload the rooms list and
+    // forget typing state that may never be stopped
+    const onResync = () => {
+      [...typingRef.current.keys()].forEach(clearTyping);
+      publishTyping();
+      loadRooms();
+    };
 
-    websocketService.on('typing_indicator', (data) => {
-      dispatch({ type: 'SET_TYPING_USERS', payload: data });
-    });
+    websocketService.on('chat_message', onChatMessage);
+    websocketService.on('typing_indicator', onTyping);
+    websocketService.on('resync', onResync);
+    return () => {
+      websocketService.off('chat_message', onChatMessage);
+      websocketService.off('typing_indicator', onTyping);
+      websocketService.off('resync', onResync);
+      websocketService.leaveRoom(roomId);
+      [...typingRef.current.keys()].forEach(clearTyping);
+      publishTyping();
+    };
   }, [dispatch, loadRooms, state.activeRoom?.id, user?.id]);
 
   // Firestore subscription for messages in active room
@@ -139,26 +185,51 @@ export function ChatProvider({ children }) {
 
   // (Removed Firestore presence: app now uses RTDB presence exclusively)
 
-  // Periodically refresh rooms and on window focus to reflect new activity
+  // Refresh rooms when the server pushes an inbox update; fall back to polling
+  // (and refreshing on window focus) only while the notification socket is down
   useEffect(() => {
     if (!isAuthenticated) return;
 
-    const onFocus = () => loadRooms();
+    let refreshTimer = null;
+    const scheduleRefresh = () => {
+      if (refreshTimer) return;
+      refreshTimer = setTimeout(() => {
+        refreshTimer = null;
+        loadRooms();
+      }, 300);
+    };
+
+    inboxSocket.connect(null, localStorage.getItem('access_token'));
+    inboxSocket.on('inbox_update', scheduleRefresh);
+    inboxSocket.on('connected', scheduleRefresh);
+
+    const onFocus = () => {
+      if (!inboxSocket.isConnected()) loadRooms();
+    };
     window.addEventListener('focus', onFocus);
 
     const intervalId = setInterval(() => {
-      loadRooms();
+      if (!inboxSocket.isConnected()) loadRooms();
     }, 10000);
 
     return () => {
       window.removeEventListener('focus', onFocus);
       clearInterval(intervalId);
+      if (refreshTimer) clearTimeout(refreshTimer);
+      inboxSocket.disconnect();
     };
   }, [isAuthenticated, loadRooms]);
 
+  // The chat socket outlives room switches; close it on logout
+  useEffect(() => {
+    if (!isAuthenticated) return;
+    return () => websocketService.disconnect();
+  }, [isAuthenticated]);
+
   useEffect(() => {
+    let leaveRoom = null;
     if (state.activeRoom) {
-      connectToRoom(state.activeRoom.id);
+      leaveRoom = connectToRoom(state.activeRoom.id);
       subscribeToRoomMessages(state.activeRoom.id, state.messagesLimit);
     }
 
@@ -167,7 +238,7 @@ export function ChatProvider({ children }) {
         messageUnsubscribeRef.current();
         messageUnsubscribeRef.current = null;
       }
-      websocketService.disconnect();
+      if (leaveRoom) leaveRoom();
     };
   }, [state.activeRoom, state.messagesLimit, connectToRoom, subscribeToRoomMessages]);
 
@@ -347,6 +418,7 @@ export function ChatProvider({ children }) {
       await chatAPI.createMessageMetadata(state.activeRoom.id, {
         firebase_message_id: firebaseMessageId,
         message_type: messageType,
+        preview: messageText || fileData?.name || '',
       });
 
       // Send via WebSocket for real-time updates
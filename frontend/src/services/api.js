@@ -76,7 +76,8 @@ export const authAPI = {
 
 // Chat API
 export const chatAPI = {
-  getRooms: () => api.get('/chat/rooms/'),
+  getRooms: () => api.get('/chat/rooms/', { params: { pagination: 'cursor' } }),
+  getRoomChanges: (since) => api.get('/chat/rooms/changes/', { params: since ? { since } : {} }),
   createRoom: (roomData) => api.post('/chat/rooms/create/', roomData),
   getRoomDetails: (roomId) => api.get(`/chat/rooms/${roomId}/`),
   updateRoom: (roomId, roomData) => api.patch(`/chat/rooms/${roomId}/`, roomData),
@@ -84,7 +85,14 @@ export const chatAPI = {
   leaveRoom: (roomId) => api.post(`/chat/rooms/${roomId}/leave/`),
   createDirectMessage: (recipientId) => api.post('/chat/direct/', { recipient_id: recipientId }),
   markMessagesRead: (roomId) => api.post(`/chat/rooms/${roomId}/read/`),
+  // Pass room ids, or nothing to mark every room read
+  markRoomsRead: (roomIds) => api.post('/chat/rooms/read/', roomIds ? { room_ids: roomIds } : { all: true }),
+  getMessageMetadata: (roomId, params) => api.get(`/chat/rooms/${roomId}/messages/`, { params }),
   createMessageMetadata: (roomId, messageData) => api.post(`/chat/rooms/${roomId}/messages/create/`, messageData),
+  // messages: [{ room_id, firebase_message_id, message_type, preview }]; safe to resend
+  createMessageMetadataBatch: (messages) => api.post('/chat/messages/batch/', { messages }),
+  // Short-lived WebSocket ticket; room ids limit it to the rooms about to be opened
+  getConnectTicket: (roomIds) => api.post('/chat/ws-ticket/', roomIds ? { room_ids: roomIds } : {}),
 };
 
 
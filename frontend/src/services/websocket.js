@@ -1,28 +1,54 @@
+import { chatAPI } from './api';
+import { JSON_SUBPROTOCOL, MSGPACK_SUBPROTOCOL, decodeFrame, encodeFrame } from './wire';
+
+// Close code of sockets the server dropped for reading too slowly (backend/chat/outbound.py)
+const RESYNC_CLOSE_CODE = 4008;
+
 class WebSocketService {
-  constructor() {
+  constructor(pathFor = (roomId) => `/ws/chat/${roomId}/`, subprotocols = []) {
+    this.pathFor = pathFor;
+    // Offered in order of preference; the server answers with the one it speaks
+    this.subprotocols = subprotocols;
+    // Accept several events per frame (the server batches only when WS_BATCH_WINDOW is set)
+    this.batched = false;
     this.socket = null;
     this.reconnectAttempts = 0;
     this.maxReconnectAttempts = 5;
     this.reconnectInterval = 3000;
     this.listeners = new Map();
+    this.connectSeq = 0;
   }
 
-  connect(roomId, token) {
-    const wsUrl = `${process.env.REACT_APP_WS_URL || 'ws://localhost:8000'}/ws/chat/${roomId}/?token=${token}`;
+  async connect(roomId, token) {
+    const attempt = ++this.connectSeq;
+    // Prefer a short-lived connect ticket: the server checks it without a DB query
+    let auth = `token=${token}`;
+    try {
+      const { data } = await chatAPI.getConnectTicket(this.ticketRooms(roomId));
+      auth = `ticket=${encodeURIComponent(data.ticket)}`;
+    } catch (_) {
+      // Fall back to the access token
+    }
+    // disconnect() or a newer connect() happened while fetching the ticket
+    if (attempt !== this.connectSeq) return;
+
+    const wsUrl = `${process.env.REACT_APP_WS_URL || 'ws://localhost:8000'}${this.pathFor(roomId)}?${auth}${this.batched ? '&batch=1' : ''}`;
     
     try {
-      this.socket = new WebSocket(wsUrl);
+      this.socket = this.subprotocols.length ? new WebSocket(wsUrl, this.subprotocols) : new WebSocket(wsUrl);
+      this.socket.binaryType = 'arraybuffer';
       
       this.socket.onopen = () => {
         console.log('WebSocket connected');
         this.reconnectAttempts = 0;
+        this.onOpen();
         this.emit('connected');
       };
 
       this.socket.onmessage = (event) => {
         try {
-          const data = JSON.parse(event.data);
-          this.emit(data.type, data);
+          const data = typeof event.data === 'string' ? JSON.parse(event.data) : decodeFrame(event.data);
+          (Array.isArray(data) ? data : [data]).forEach((item) => this.emit(item.type, item));
         } catch (error) {
           console.error('Error parsing WebSocket message:', error);
         }
@@ -30,7 +56,14 @@ class WebSocketService {
 
       this.socket.onclose = (event) => {
         console.log('WebSocket disconnected:', event.code, event.reason);
+        this.onClose();
         this.emit('disconnected');
+
+        // Dropped by the server for falling behind, right after a 'resync'
+        // event: come straight back rather than give up
+        if (event.code === RESYNC_CLOSE_CODE) {
+          this.reconnectAttempts = 0;
+        }
         
         if (event.code !== 1000 && this.reconnectAttempts < this.maxReconnectAttempts) {
           this.reconnect(roomId, token);
@@ -56,7 +89,25 @@ class WebSocketService {
     }, this.reconnectInterval);
   }
 
+  // Rooms the connect ticket should vouch for
+  ticketRooms(roomId) {
+    return roomId ? [roomId] : [];
+  }
+
+  onOpen() {}
+
+  onClose() {}
+
+  send(payload) {
+    if (this.socket && this.socket.readyState === WebSocket.OPEN) {
+      this.socket.send(
+        this.socket.protocol === MSGPACK_SUBPROTOCOL ? encodeFrame(payload) : JSON.stringify(payload)
+      );
+    }
+  }
+
   disconnect() {
+    this.connectSeq++;
     if (this.socket) {
       this.socket.close(1000, 'User disconnected');
       this.socket = null;
@@ -65,32 +116,37 @@ class WebSocketService {
   }
 
   sendMessage(message, firebaseMessageId) {
-    if (this.socket && this.socket.readyState === WebSocket.OPEN) {
-      this.socket.send(JSON.stringify({
-        type: 'chat_message',
-        message,
-        firebase_message_id: firebaseMessageId,
-        timestamp: new Date().toISOString()
-      }));
-    }
+    this.send({
+      type: 'chat_message',
+      message,
+      firebase_message_id: firebaseMessageId,
+      timestamp: new Date().toISOString()
+    });
   }
 
   sendTyping(isTyping) {
-    if (this.socket && this.socket.readyState === WebSocket.OPEN) {
-      this.socket.send(JSON.stringify({
-        type: 'typing',
-        is_typing: isTyping
-      }));
-    }
+    this.send({
+      type: 'typing',
+      is_typing: isTyping
+    });
   }
 
   sendReadReceipt(firebaseMessageId) {
-    if (this.socket && this.socket.readyState === WebSocket.OPEN) {
-      this.socket.send(JSON.stringify({
-        type: 'read_receipt',
-        firebase_message_id: firebaseMessageId
-      }));
-    }
+    this.send({
+      type: 'read_receipt',
+      firebase_message_id: firebaseMessageId
+    });
+  }
+
+  // Watermark receipt: everything up to and including this message has been read.
+  // The server coalesces these per room and answers with 'read_receipts' events;
+  // the message's timestamp (ms) keeps an older report from another tab from winning.
+  sendReadUpTo(firebaseMessageId, timestamp) {
+    this.send({
+      type: 'read_up_to',
+      firebase_message_id: firebaseMessageId,
+      ...(typeof timestamp === 'number' ? { timestamp } : {})
+    });
   }
 
   on(event, callback) {
@@ -127,5 +183,79 @@ class WebSocketService {
   }
 }
 
-const websocketInstance = new WebSocketService();
+// One socket for every room the client has open (ws/chat/): rooms are joined
+// and left with subscribe/unsubscribe messages instead of reconnecting, and
+// sends target the most recently joined room
+class RoomSocketService extends WebSocketService {
+  constructor() {
+    // REACT_APP_WS_MSGPACK=true asks for compact binary frames
+    super(() => '/ws/chat/', process.env.REACT_APP_WS_MSGPACK === 'true' ? [MSGPACK_SUBPROTOCOL, JSON_SUBPROTOCOL] : []);
+    this.batched = true;
+    this.rooms = new Set();
+    this.activeRoomId = null;
+    this.opening = null;
+    // Renews the server-side presence lease (PRESENCE_LEASE_TTL, 90s by default)
+    this.heartbeatInterval = 30000;
+    this.heartbeatTimer = null;
+  }
+
+  joinRoom(roomId, token) {
+    this.rooms.add(roomId);
+    this.activeRoomId = roomId;
+    if (this.socket || this.opening) {
+      // Sent once open otherwise: onOpen() subscribes every joined room
+      super.send({ type: 'subscribe', room_ids: [roomId] });
+    } else {
+      this.opening = this.connect(null, token).finally(() => {
+        this.opening = null;
+      });
+    }
+  }
+
+  leaveRoom(roomId) {
+    this.rooms.delete(roomId);
+    if (this.activeRoomId === roomId) this.activeRoomId = null;
+    super.send({ type: 'unsubscribe', room_ids: [roomId] });
+  }
+
+  ticketRooms() {
+    return [...this.rooms];
+  }
+
+  onOpen() {
+    if (this.rooms.size) {
+      super.send({ type: 'subscribe', room_ids: [...this.rooms] });
+    }
+    this.stopHeartbeat();
+    this.heartbeatTimer = setInterval(() => super.send({ type: 'heartbeat' }), this.heartbeatInterval);
+  }
+
+  onClose() {
+    this.stopHeartbeat();
+  }
+
+  stopHeartbeat() {
+    if (this.heartbeatTimer) {
+      clearInterval(this.heartbeatTimer);
+      this.heartbeatTimer = null;
+    }
+  }
+
+  send(payload) {
+    super.send({ room_id: this.activeRoomId, ...payload });
+  }
+
+  disconnect() {
+    this.stopHeartbeat();
+    this.rooms.clear();
+    this.activeRoomId = null;
+    super.disconnect();
+  }
+}
+
+const websocketInstance = new RoomSocketService();
+
+// Per-user notification socket: pushes `inbox_update` events when the rooms list changes
+export const inboxSocket = new WebSocketService(() => '/ws/user/');
+
 export default websocketInstance;
@@ -0,0 +1,171 @@
+// Frame encodings for the chat socket (see backend/chat/wire.py). With the
+// `flowchat.msgpack.v1` subprotocol, frames are binary MessagePack maps whose
+// top-level keys use the short codes below; otherwise they are JSON text.
+
+export const MSGPACK_SUBPROTOCOL = 'flowchat.msgpack.v1';
+export const JSON_SUBPROTOCOL = 'flowchat.json.v1';
+
+// Must match FIELD_CODES on the server
+const FIELD_CODES = {
+  type: 't',
+  room_id: 'r',
+  room_ids: 'rs',
+  rejected: 'rj',
+  message: 'm',
+  message_type: 'mt',
+  firebase_message_id: 'f',
+  sender_id: 's',
+  sender_name: 'sn',
+  user_id: 'u',
+  user_name: 'un',
+  timestamp: 'ts',
+  is_typing: 'it',
+  expires_in: 'x',
+  receipts: 'rc',
+  preview: 'p',
+  persist: 'ps',
+  event: 'ev',
+  error: 'e',
+};
+const FIELD_NAMES = Object.fromEntries(Object.entries(FIELD_CODES).map(([name, code]) => [code, name]));
+
+const renameKeys = (payload, names) =>
+  Object.fromEntries(Object.entries(payload).map(([key, value]) => [names[key] || key, value]));
+
+export function encodeFrame(payload) {
+  return encode(renameKeys(payload, FIELD_CODES));
+}
+
+// A single event, or an array of them when the server batches
+export function decodeFrame(data) {
+  const frame = decode(new Uint8Array(data));
+  const expand = (event) => (event && typeof event === 'object' && !Array.isArray(event) ? renameKeys(event, FIELD_NAMES) : event);
+  return Array.isArray(frame) ? frame.map(expand) : expand(frame);
+}
+
+// Minimal MessagePack: nil, booleans, numbers, strings, binary, arrays and maps
+
+const textEncoder = new TextEncoder();
+const textDecoder = new TextDecoder();
+
+function encode(value) {
+  const bytes = [];
+  const pushUint = (number, size) => {
+    for (let shift = (size - 1) * 8; shift >= 0; shift -= 8) {
+      bytes.push(Math.floor(number / 2 ** shift) & 0xff);
+    }
+  };
+  const pushHeader = (length, fix, fixMax, codes) => {
+    if (length <= fixMax) bytes.push(fix | length);
+    else if (codes[0] && length < 0x100) bytes.push(codes[0], length);
+    else if (length < 0x10000) { bytes.push(codes[1]); pushUint(length, 2); }
+    else { bytes.push(codes[2]); pushUint(length, 4); }
+  };
+  const write = (item) => {
+    if (item === null || item === undefined) {
+      bytes.push(0xc0);
+    } else if (typeof item === 'boolean') {
+      bytes.push(item ? 0xc3 : 0xc2);
+    } else if (typeof item === 'number') {
+      if (Number.isSafeInteger(item) && item >= 0) {
+        if (item < 0x80) bytes.push(item);
+        else if (item < 0x100) bytes.push(0xcc, item);
+        else if (item < 0x10000) { bytes.push(0xcd); pushUint(item, 2); }
+        else if (item < 0x100000000) { bytes.push(0xce); pushUint(item, 4); }
+        else { bytes.push(0xcf); pushUint(item, 8); }
+      } else if (Number.isInteger(item) && item >= -0x80000000) {
+        if (item >= -0x20) bytes.push(item & 0xff);
+        else { bytes.push(0xd2); pushUint(item >>> 0, 4); }
+      } else {
+        const view = new DataView(new ArrayBuffer(8));
+        view.setFloat64(0, item);
+        bytes.push(0xcb, ...new Uint8Array(view.buffer));
+      }
+    } else if (typeof item === 'string') {
+      const utf8 = textEncoder.encode(item);
+      pushHeader(utf8.length, 0xa0, 31, [0xd9, 0xda, 0xdb]);
+      bytes.push(...utf8);
+    } else if (item instanceof Uint8Array) {
+      pushHeader(item.length, 0, -1, [0xc4, 0xc5, 0xc6]);
+      bytes.push(...item);
+    } else if (Array.isArray(item)) {
+      pushHeader(item.length, 0x90, 15, [null, 0xdc, 0xdd]);
+      item.forEach(write);
+    } else if (item instanceof Date) {
+      write(item.toISOString());
+    } else {
+      const entries = Object.entries(item).filter(([, entry]) => entry !== undefined);
+      pushHeader(entries.length, 0x80, 15, [null, 0xde, 0xdf]);
+      entries.forEach(([key, entry]) => { write(key); write(entry); });
+    }
+  };
+  write(value);
+  return new Uint8Array(bytes);
+}
+
+function decode(bytes) {
+  const view = new DataView(bytes.buffer, bytes.byteOffset, bytes.byteLength);
+  let offset = 0;
+  const take = (size) => {
+    if (offset + size > bytes.length) throw new Error('Truncated MessagePack frame');
+    const start = offset;
+    offset += size;
+    return start;
+  };
+  const uint = (size) => {
+    const at = take(size);
+    if (size === 1) return view.getUint8(at);
+    if (size === 2) return view.getUint16(at);
+    if (size === 4) return view.getUint32(at);
+    return view.getUint32(at) * 2 ** 32 + view.getUint32(at + 4);
+  };
+  const str = (length) => textDecoder.decode(bytes.subarray(take(length), offset));
+  const array = (length) => Array.from({ length }, read);
+  const map = (length) => {
+    const result = {};
+    for (let i = 0; i < length; i++) {
+      const key = read();
+      result[key] = read();
+    }
+    return result;
+  };
+  function read() {
+    const code = uint(1);
+    if (code < 0x80) return code;
+    if (code < 0x90) return map(code & 0x0f);
+    if (code < 0xa0) return array(code & 0x0f);
+    if (code < 0xc0) return str(code & 0x1f);
+    if (code >= 0xe0) return code - 0x100;
+    switch (code) {
+      case 0xc0: return null;
+      case 0xc2: return false;
+      case 0xc3: return true;
+      case 0xc4: case 0xc5: case 0xc6: {
+        const length = uint(2 ** (code - 0xc4));
+        return bytes.slice(take(length), offset);
+      }
+      case 0xca: return view.getFloat32(take(4));
+      case 0xcb: return view.getFloat64(take(8));
+      case 0xcc: return uint(1);
+      case 0xcd: return uint(2);
+      case 0xce: return uint(4);
+      case 0xcf: return uint(8);
+      case 0xd0: return view.getInt8(take(1));
+      case 0xd1: return view.getInt16(take(2));
+      case 0xd2: return view.getInt32(take(4));
+      case 0xd3: {
+        const at = take(8);
+        return view.getInt32(at) * 2 ** 32 + view.getUint32(at + 4);
+      }
+      case 0xd9: return str(uint(1));
+      case 0xda: return str(uint(2));
+      case 0xdb: return str(uint(4));
+      case 0xdc: return array(uint(2));
+      case 0xdd: return array(uint(4));
+      case 0xde: return map(uint(2));
+      case 0xdf: return map(uint(4));
+      default: throw new Error(`Unsupported MessagePack type 0x${code.toString(16)}`);
+    }
+  }
+  return read();
+}